@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013-2014 Germain Z. <germanosz@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Benchmarks for weechat-vimode.
+
+Micro-benchmarks time the helpers behind motions and text objects on a short
+input line and on long ones, with the cursor in the middle of the line, :s
+commands on a 100 KB input line, and the bar items redrawn when windows are
+resized.
+
+Startup benchmarks time loading the script the way WeeChat does: compiling it
+from source (WeeChat doesn't use .pyc files), running the module's body, and
+setting it up (options, hooks, warnings about key bindings) against a stand-in
+for WeeChat's API.
+
+Keystroke benchmarks press keys the way WeeChat would, through
+`cb_key_pressed()`, `cb_key_combo_default()` and the timers they set (e.g.
+`cb_exec_cmd()`), with the test harness' in-memory `MemoryBackend` (see
+harness.py) standing in for WeeChat. They report the per-key latency
+(p50/p99) and throughput of key streams on short and 50 KB input lines, with 0
+and 1000 user mappings, with long counts and in command-line mode.
+
+Usage:
+    python bench.py [--json FILE] [--keys-only | --startup-only]
+
+With --json, results are also written to FILE along with the commit and
+Python version, to compare them across commits.
+"""
+
+
+import argparse
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import harness
+import vimode
+
+
+SHORT_LINE = "Hello, this is a (short) test line! Nothing to see here... "
+LONG_LINE = (SHORT_LINE * (50 * 1024 // len(SHORT_LINE) + 1))[:50 * 1024]
+ESC = "\x01["
+RETURN = "\x01M"
+
+# Clock used to time key presses.
+clock = getattr(time, "perf_counter", time.time)
+
+# Results, by benchmark name.
+results = {}
+
+
+# Micro-benchmarks.
+# =================
+
+def bench(name, func, number):
+    """Print the best time per call of `func` over a few runs."""
+    best = min(timeit.repeat(func, number=number, repeat=5)) / number
+    results[name] = {'best_us': best * 1e6}
+    print("{:<40} {:>12.2f} µs".format(name, best * 1e6))
+
+
+def bench_get_pos(label, line):
+    """Benchmark `get_pos()` searches from the middle of `line`."""
+    cur = len(line) // 2
+    char = re.escape("!")
+    bench("get_pos {} (next)".format(label),
+          lambda: vimode.get_pos(line, char, cur, True, 1), 10000)
+    bench("get_pos {} (3rd next)".format(label),
+          lambda: vimode.get_pos(line, char, cur, True, 3), 10000)
+    bench("get_pos {} (previous)".format(label),
+          lambda: vimode.get_pos(line, char, cur, True, 1, True), 10000)
+    bench("get_pos {} (no match)".format(label),
+          lambda: vimode.get_pos(line, "#", cur, True, 1), 100)
+    bench("get_pos {} (no match, backward)".format(label),
+          lambda: vimode.get_pos(line, "#", cur, True, 1, True), 100)
+
+
+def bench_motions(label, line):
+    """Benchmark word motions from the middle of `line`."""
+    cur = len(line) // 2
+    for motion in ["w", "b", "e", "ge", "W", "B"]:
+        func = getattr(vimode, "motion_{}".format(motion))
+        bench("motion_{} {}".format(motion, label),
+              lambda: func(line, cur, 1), 10000)
+
+
+def bench_text_objects(label, line):
+    """Benchmark text objects around the middle of `line`."""
+    cur = len(line) // 2
+    for obj in ["iw", "aW", 'i"', "a(", "it"]:
+        bench("text object {} {}".format(obj, label),
+              lambda: vimode.select_text_object(obj, line, cur, 1), 1000)
+
+
+def bench_substitute():
+    """Benchmark :s commands on a 100 KB input line (of 100 lines)."""
+    line = LONG_LINE * 2
+    lines = "\n".join([line[i:i + 1024] for i in range(0, len(line), 1024)])
+    for label, text in [("100 KB", line), ("100 KB, 100 lines", lines)]:
+        for cmd in [r"%s/\bis\b/IS/g", r"%s/(\w+) (\w+)/\2 \1/g",
+                    "%s/Nothing/&!/"]:
+            bench(":{} {}".format(cmd, label),
+                  lambda: vimode.substitute(text, 0,
+                                            vimode.parse_substitute(cmd)),
+                  10)
+
+
+def bench_bar_items():
+    """Benchmark redrawing the bar items of 20 windows, resized back and forth
+    between 10 heights."""
+    windows = ["window{}".format(i) for i in range(20)]
+    heights = {}
+    vimode.weechat.window_get_integer = lambda window, name: heights[window]
+
+    def resize(cached):
+        for height in list(range(30, 40)) * 3:
+            for window in windows:
+                heights[window] = height
+                if not cached:
+                    vimode.bar_items_cache.clear()
+                vimode.cb_line_numbers("", "line_numbers", window)
+                vimode.cb_mode_indicator("", "mode_indicator", window)
+
+    bench("bar items, 20 windows (uncached)", lambda: resize(False), 10)
+    bench("bar items, 20 windows", lambda: resize(True), 10)
+
+
+def run_micro_benchmarks():
+    """Run all of the micro-benchmarks."""
+    harness.ViEngine()
+    json_line = '{"items": [' + ", ".join(
+        '{{"id": {0}, "name": "item ({0})", "tags": ["<b>x</b>"]}}'.format(i)
+        for i in range(1000)) + "]}"
+    for label, line in [("short", SHORT_LINE), ("50 KB", LONG_LINE)]:
+        bench_get_pos(label, line)
+        bench_motions(label, line)
+    for label, line in [("short", SHORT_LINE), ("50 KB", LONG_LINE),
+                        ("JSON", json_line)]:
+        bench_text_objects(label, line)
+    bench_substitute()
+    bench_bar_items()
+
+
+# Keystroke benchmarks.
+# =====================
+
+# Key streams: Normal mode motions, edits (undone, so that the line keeps its
+# size), typing in Insert mode, long counts and command-line mode.
+MOTIONS = "wwwbbeeWBE$0fxFx;,tT10l5h^ge"
+EDITS = "xuddudwucwfoo" + ESC + "u~uyyPudfsuciwbar" + ESC + "u"
+TYPING = "a" + "hello world, this is vimode typing " * 2 + ESC + "u"
+COUNTS = "9999l500h50xu20dwu300Xu"
+COMMANDS = (":s/is/IS/g" + RETURN + "u:%s/(\\w+) (\\w+)/\\2 \\1/g" + RETURN +
+            "u:nmap ,b dw" + RETURN + ":nunmap ,b" + RETURN)
+
+
+def press(backend, keys):
+    """Press `keys` (a key combo) like WeeChat would, and return how long
+    vimode took to handle it, in seconds.
+
+    WeeChat sends key_pressed, then key_combo_default once the combo is
+    complete, except for Esc which is detected with a timer. Keys vimode
+    doesn't eat are then inserted, or run the command they're bound to.
+    Timers due within a millisecond (e.g. `cb_exec_cmd()`) run as well.
+    """
+    start = clock()
+    vimode.cb_key_pressed("", "key_pressed", keys)
+    if keys == ESC:
+        backend.run_timers(backend.now + vimode.get_esc_timeout())
+        return clock() - start
+    rc = vimode.cb_key_combo_default("", "key_combo_default", keys)
+    if rc != backend.WEECHAT_RC_OK_EAT:
+        if not keys.startswith("\x01"):
+            line, cur = backend.input_line, backend.cur
+            backend.input_line = line[:cur] + keys + line[cur:]
+            backend.cur = cur + len(keys)
+        elif keys in backend.KEY_BINDINGS:
+            backend.command("", backend.KEY_BINDINGS[keys])
+    backend.run_timers(backend.now + 1)
+    return clock() - start
+
+
+def percentile(samples, fraction):
+    """Return the `fraction` percentile of the sorted `samples`."""
+    return samples[int(round(fraction * (len(samples) - 1)))]
+
+
+def bench_keys(name, line, keys, rounds, settings=None):
+    """Press `keys` `rounds` times in Normal mode, with the cursor in the
+    middle of `line`, and print the latency per key and the throughput."""
+    keys = re.findall(vimode.REGEX_KEY_COMBOS, keys)
+    backend = harness.ViEngine(mode="NORMAL", settings=settings).backend
+    samples = []
+    total = 0
+    for _ in range(rounds):
+        vimode.set_mode("NORMAL")
+        backend.input_line = line
+        backend.cur = len(line) // 2
+        for combo in keys:
+            samples.append(press(backend, combo))
+        total += sum(samples[-len(keys):])
+    samples.sort()
+    result = results[name] = {
+        'keys': len(samples),
+        'p50_us': percentile(samples, 0.5) * 1e6,
+        'p99_us': percentile(samples, 0.99) * 1e6,
+        'keys_per_s': len(samples) / total,
+    }
+    print("{:<40} p50 {:>9.2f} µs  p99 {:>9.2f} µs  {:>8.0f} keys/s".format(
+        name, result['p50_us'], result['p99_us'], result['keys_per_s']))
+
+
+def user_mappings(amount):
+    """Return the user_mappings option for `amount` mappings (",000"...)."""
+    return json.dumps(dict((",{:03}".format(i), "{}l".format(i % 9 + 1))
+                           for i in range(amount)))
+
+
+def run_keystroke_benchmarks():
+    """Run all of the keystroke benchmarks."""
+    for label, line, rounds in [("short", SHORT_LINE, 200),
+                                ("50 KB", LONG_LINE, 20)]:
+        for amount in [0, 1000]:
+            settings = {'user_mappings': user_mappings(amount)}
+            suffix = "{}, {} mappings".format(label, amount)
+            bench_keys("motions, " + suffix, line, MOTIONS, rounds, settings)
+            bench_keys("edits, " + suffix, line, EDITS, rounds, settings)
+        bench_keys("typing, " + label, line, TYPING, rounds)
+        bench_keys("counts, " + label, line, COUNTS, rounds)
+        bench_keys("command-line, " + label, line, COMMANDS, rounds)
+    bench_keys("mapped keys, short, 1000 mappings", SHORT_LINE,
+               ",001,002,500,9990", 200,
+               {'user_mappings': user_mappings(1000)})
+
+
+# Startup benchmarks.
+# ===================
+
+class StartupBackend(harness.MemoryBackend):
+    """`MemoryBackend` standing in for the `weechat` module while the script
+    is loaded, with WeeChat's default key bindings (looked up by
+    `check_warnings()`) and a temporary WeeChat directory. API calls only
+    made when loading the script (to register it, create bar items, hooks...)
+    do nothing."""
+
+    weechat_dir = None
+
+    KEY_BINDINGS = dict(harness.MemoryBackend.KEY_BINDINGS, **dict(
+        ("meta-j{:02}".format(i), "/buffer {}".format(i))
+        for i in range(1, 100)))
+
+    def __getattr__(self, name):
+        return lambda *args: ""
+
+    def info_get(self, name, arguments):
+        if name == "version_number":
+            return str(0x04000000)
+        if name == "weechat_dir":
+            return self.weechat_dir
+        return ""
+
+    def config_set_plugin(self, option, value):
+        self.options[option] = value
+
+    def infolist_get(self, name, pointer, arguments):
+        infolist = harness.MemoryBackend.infolist_get(self, name, pointer,
+                                                      arguments)
+        for item in infolist[0]:
+            item['key'] = item['key_internal']
+        return infolist
+
+
+def load_script(code, name):
+    """Run the compiled script `code` as module `name` ("__main__" to set it
+    up as WeeChat would), with a `StartupBackend` as the weechat module.
+
+    Regexes cached by the `re` module are cleared first, as they would be
+    compiled again in WeeChat's interpreter for the script.
+    """
+    re.purge()
+    sys.modules['weechat'] = StartupBackend()
+    try:
+        exec(code, {'__name__': name})
+    finally:
+        del sys.modules['weechat']
+
+
+def run_startup_benchmarks():
+    """Run all of the startup benchmarks."""
+    path = vimode.__file__.replace(".pyc", ".py")
+    with io.open(path, encoding="utf-8") as f:
+        source = f.read()
+    code = compile(source, path, "exec")
+    StartupBackend.weechat_dir = tempfile.mkdtemp()
+    with open(os.path.join(StartupBackend.weechat_dir, "weechat.conf"),
+              "w") as f:
+        f.write("[key]\n")
+    bench("startup: compile", lambda: compile(source, path, "exec"), 5)
+    bench("startup: module body", lambda: load_script(code, "vimode"), 5)
+    bench("startup: module body + setup",
+          lambda: load_script(code, "__main__"), 5)
+    bench("startup: total", lambda: load_script(
+        compile(source, path, "exec"), "__main__"), 5)
+    shutil.rmtree(StartupBackend.weechat_dir)
+
+
+def get_commit():
+    """Return the current git commit, if any."""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         stderr=subprocess.STDOUT)
+        return commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark vimode.")
+    parser.add_argument("--json", metavar="FILE",
+                        help="also write the results to FILE")
+    parser.add_argument("--keys-only", action="store_true",
+                        help="only run the keystroke benchmarks")
+    parser.add_argument("--startup-only", action="store_true",
+                        help="only run the startup benchmarks")
+    args = parser.parse_args()
+    if not args.keys_only:
+        run_startup_benchmarks()
+    if not args.keys_only and not args.startup_only:
+        run_micro_benchmarks()
+    if not args.startup_only:
+        run_keystroke_benchmarks()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'commit': get_commit(),
+                       'python': platform.python_version(),
+                       'version': vimode.SCRIPT_VERSION,
+                       'results': results}, f, indent=2, sort_keys=True)
+            f.write("\n")
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013-2014 Germain Z. <germanosz@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Differential fuzzer for weechat-vimode. Compares the behavior of our
+implementation to vim's on random input.
+
+Batches of random cases are generated for the keys tested by test.py (motions,
+operators followed by a motion, and other keys): input lines made of ASCII
+letters and punctuation, letters from the À-ÿ range, runs of spaces and tabs
+and, now and then, very long lines, with random cursor positions and counts.
+Each batch runs in a worker process, in vimode (see harness.py) and in a
+headless vim (see test.py). When vimode and vim differ, the first failing case
+of the batch is minimized, by dropping parts of its line and lowering its count
+for as long as they still differ, and reported once per group of keys. Known
+differences (see `test.KNOWN_DIFFERENCES`) aren't failures.
+
+Fuzzing, minimization included, stops once the time budget is spent, so that
+it can gate merges. Batches are generated from the seed alone, and can be
+reproduced with it.
+
+Usage:
+    python fuzz.py [-t SECONDS] [-j JOBS] [-s SEED] [-n CASES] [GROUP...]
+"""
+
+
+import argparse
+import multiprocessing
+import random
+import string
+import sys
+import time
+
+import test
+
+
+# Alphabets input lines are made from.
+ALPHABETS = [string.ascii_letters + string.digits + "_",
+             string.punctuation,
+             bytearray(range(0xc0, 0x100)).decode("latin-1"),
+             " ",
+             " \t"]
+# Probability of generating a very long line, and its length.
+LONG_LINE_RATE = 0.02
+LONG_LINE_LENGTH = 5000
+# Keys whose count is a number of lines (see `test.get_cases()`).
+LINEWISE_KEYS = ["D", "dd"]
+
+
+def get_groups(names):
+    """Return the groups of keys to fuzz, as (keys, kind) tuples, restricted
+    to `names` if any."""
+    return [(keys, kind) for keys, kind in test.get_groups()
+            if not names or keys in names]
+
+
+def random_line(rand):
+    """Return a random input line, made of runs of characters from one of
+    `ALPHABETS` each."""
+    if rand.random() < LONG_LINE_RATE:
+        length = LONG_LINE_LENGTH
+    else:
+        length = rand.randint(1, 60)
+    line = []
+    while len(line) < length:
+        alphabet = rand.choice(ALPHABETS)
+        line += [rand.choice(alphabet) for _ in range(rand.randint(1, 8))]
+    return u"".join(line[:length])
+
+
+def random_char(rand, keys):
+    """Return a random character for f/F/t/T to catch, if `keys` end with one
+    (test.py makes them catch "!")."""
+    if keys.endswith("!") and keys[-2:-1] in "fFtT":
+        return rand.choice(rand.choice(ALPHABETS))
+    return None
+
+
+def random_batch(rand, group, size):
+    """Return a batch of `size` random cases for `group`, as a (group, keys,
+    cases) tuple."""
+    keys, kind = group
+    char = random_char(rand, keys)
+    if char is not None:
+        keys = keys[:-1] + char
+    linewise = "$" in keys or keys in LINEWISE_KEYS
+    cases = []
+    for _ in range(size):
+        line = random_line(rand)
+        # Make sure there's something to catch.
+        if char is not None and char not in line:
+            pos = rand.randrange(len(line))
+            line = line[:pos] + char + line[pos + 1:]
+        cur = rand.randrange(len(line))
+        count = 1 if linewise else rand.choice([1, 1, 2, 3, 5])
+        cases.append((line, cur, count))
+    return group, keys, cases
+
+
+def failures(group, keys, cases):
+    """Run `cases` in vimode and vim, and return the (case, ours, vims)
+    tuples of those where they differ, other than known differences of
+    `group` (see `test.KNOWN_DIFFERENCES`)."""
+    kind = group[1]
+    got = test.run_vimode(keys, cases)
+    expected = test.run_vim(keys, cases)
+    found = []
+    for case, ours, vims in zip(cases, got, expected):
+        ours, vims = test.checked(kind, ours), test.checked(kind, vims)
+        if (ours != vims and
+                test.known_difference(group[0], case, ours, vims) is None):
+            found.append((case, ours, vims))
+    return found
+
+
+def shrink_candidates(case, size):
+    """Return the cases made by dropping `size` characters from the line of
+    `case` (other than the one under the cursor), or by lowering its count."""
+    line, cur, count = case
+    candidates = []
+    if count > 1:
+        candidates += [(line, cur, 1), (line, cur, count - 1)]
+    for start in range(0, len(line) - size + 1, size):
+        end = start + size
+        if start <= cur < end:
+            continue
+        new_cur = cur - size if start < cur else cur
+        candidates.append((line[:start] + line[end:], new_cur, count))
+    return candidates
+
+
+def minimize(group, keys, failure, deadline):
+    """Shrink a failing case for as long as vimode and vim differ on it, and
+    return the smallest failure found.
+
+    Candidates of a same size are run in a single vim process. Sizes are
+    halved until single characters can't be dropped anymore, or until the
+    `deadline` (a `time.time()` value) has passed.
+    """
+    size = len(failure[0][0]) // 2
+    while size >= 1 and time.time() < deadline:
+        candidates = shrink_candidates(failure[0], size)
+        smaller = failures(group, keys, candidates) if candidates else []
+        if smaller:
+            failure = smaller[0]
+            size = min(size, len(failure[0][0]) // 2)
+        else:
+            size //= 2
+    return failure
+
+
+def run_batch(batch, deadline):
+    """Run a batch of cases, and return its group, keys and first failure
+    (minimized until `deadline`), or None if vimode and vim agree."""
+    group, keys, cases = batch
+    found = failures(group, keys, cases)
+    if not found:
+        return None
+    return group, keys, minimize(group, keys, found[0], deadline)
+
+
+def report(result, failed):
+    """Print the failure of a batch, unless its group already failed."""
+    if result is None or result[0] in failed:
+        return
+    group, keys, ((line, cur, count), ours, vims) = result
+    failed[group] = result
+    print("• {} \033[33m{}\033[0m: {!r}, cur: {}, count: {}: "
+          "\033[31m{!r} ≠ {!r}\033[0m".format(group[1], keys, line, cur,
+                                              count, ours, vims))
+
+
+def batches(groups, seed, size):
+    """Yield random batches of cases for `groups`, forever."""
+    rand = random.Random(seed)
+    while True:
+        for group in groups:
+            yield random_batch(rand, group, size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzz vimode against vim.")
+    parser.add_argument("-t", "--time", type=float, default=60,
+                        help="time budget in seconds (default: 60)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument("-s", "--seed", type=int, default=None,
+                        help="seed of the random cases")
+    parser.add_argument("-n", "--cases", type=int, default=200,
+                        help="cases per batch (default: 200)")
+    parser.add_argument("groups", nargs="*", metavar="GROUP",
+                        help="only fuzz these keys (e.g. dw)")
+    args = parser.parse_args()
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    groups = get_groups(args.groups)
+    print("Fuzzing {} groups for {:g}s with seed {}…".format(
+        len(groups), args.time, seed))
+    deadline = time.time() + args.time
+    jobs = args.jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(jobs)
+    pending = []
+    failed = {}
+    done = 0
+    source = batches(groups, seed, args.cases)
+    try:
+        while time.time() < deadline:
+            # Keep every worker busy, skipping groups that already failed.
+            while len(pending) < 2 * jobs and len(failed) < len(groups):
+                batch = next(source)
+                while batch[0] in failed:
+                    batch = next(source)
+                pending.append(
+                    pool.apply_async(run_batch, (batch, deadline)))
+            ready = [result for result in pending if result.ready()]
+            if not pending:
+                break
+            if not ready:
+                time.sleep(0.05)
+                continue
+            for result in ready:
+                pending.remove(result)
+                done += 1
+                report(result.get(), failed)
+    finally:
+        pool.terminate()
+    print("{} batches of {} cases run, {} groups differ from vim.".format(
+        done, args.cases, len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
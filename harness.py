@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013-2014 Germain Z. <germanosz@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Test harness for weechat-vimode: runs vimode's key handling outside
+WeeChat, for tests and benchmarks.
+
+`MemoryBackend` stands in for the `weechat` module, with an input line held
+in memory, and `ViEngine` feeds keys to vimode through it. Each engine has
+its own core editing state (a `vimode.ViState`: mode, registers, undo
+history, ...), swapped in along with its backend whenever it's fed keys, so
+several engines can be used side by side. The rest of vimode's state (macros,
+., command-line mode, histories, bar items) is still module-global and reset
+when an engine is created, and vimode talks to WeeChat through the
+module-global `weechat`: engines must not be used inside WeeChat, where they
+would break the running script.
+
+Example:
+    >>> engine = ViEngine("hello world", mode="NORMAL")
+    >>> engine.feed("dwAthere\x01[")  # \x01[ is Esc.
+    >>> engine.input_line, engine.cur, engine.mode
+    ('worldthere', 9, 'NORMAL')
+"""
+
+
+import re
+
+import vimode
+
+
+# Default value of each option, as `vimode.vimode_settings` holds the values
+# in use once options are loaded.
+DEFAULT_SETTINGS = dict((name, value[0])
+                        for name, value in vimode.vimode_settings.items())
+
+
+class MemoryBackend(object):
+    """Stand-in for the `weechat` module.
+
+    It provides the parts of WeeChat's API vimode uses, for a single buffer
+    whose input line is held in memory. Commands that edit the input line
+    (`/input delete_next_char`, etc.) are applied to it; other commands are
+    only recorded in `commands`. Timers run on a virtual clock (see
+    `run_timers()`), and text "sent" with Return is added to `sent`.
+    """
+
+    WEECHAT_RC_OK = 0
+    WEECHAT_RC_OK_EAT = 2
+    WEECHAT_RC_ERROR = -1
+    WEECHAT_HOOK_PROCESS_ERROR = -1
+
+    # Key bindings used when vimode doesn't eat a key (see
+    # `vimode.feed_key()`).
+    KEY_BINDINGS = {
+        '\x01?': "/input delete_previous_char",
+        '\x01H': "/input delete_previous_char",
+        '\x01[[3~': "/input delete_next_char",
+        '\x01[[D': "/input move_previous_char",
+        '\x01[[C': "/input move_next_char",
+        '\x01[[H': "/input move_beginning_of_line",
+        '\x01[[F': "/input move_end_of_line",
+        '\x01A': "/input move_beginning_of_line",
+        '\x01E': "/input move_end_of_line",
+        '\x01M': "/input return",
+        '\x01J': "/input return",
+    }
+
+    def __init__(self, input_line="", cur=0):
+        self.input_line = input_line
+        self.cur = cur
+        self.commands = []
+        self.sent = []
+        self.printed = []
+        self.options = {}
+        self.now = 0
+        self.timers = {}
+        self.hooks = 0
+
+    # Buffers and windows.
+    def current_buffer(self):
+        return "buffer"
+
+    def current_window(self):
+        return "window"
+
+    def buffer_get_string(self, buf, prop):
+        if prop == "input":
+            return self.input_line
+        if prop in ["name", "full_name", "short_name"]:
+            return "vimode"
+        return ""
+
+    def buffer_get_integer(self, buf, prop):
+        if prop == "input_pos":
+            return self.cur
+        if prop == "input_length":
+            return len(self.input_line)
+        return 0
+
+    def buffer_set(self, buf, prop, value):
+        if prop == "input":
+            self.input_line = value
+            self.cur = min(self.cur, len(value))
+            # The input_text_changed signal.
+            if vimode.cmd_mode_hook:
+                vimode.cb_check_cmd_mode("", "input_text_changed", buf)
+        elif prop == "input_pos":
+            self.cur = max(0, min(int(value), len(self.input_line)))
+
+    def window_get_integer(self, window, prop):
+        return 0
+
+    def hdata_get(self, name):
+        return ""
+
+    def hdata_integer(self, hdata, pointer, name):
+        return 0
+
+    def command(self, buf, command):
+        self.commands.append(command)
+        line, cur = self.input_line, self.cur
+        if command == "/input delete_next_char":
+            line = line[:cur] + line[cur + 1:]
+        elif command == "/input delete_previous_char" and cur:
+            line, cur = line[:cur - 1] + line[cur:], cur - 1
+        elif command == "/input move_next_char":
+            cur = min(cur + 1, len(line))
+        elif command == "/input move_previous_char":
+            cur = max(cur - 1, 0)
+        elif command == "/input move_beginning_of_line":
+            cur = 0
+        elif command == "/input move_end_of_line":
+            cur = len(line)
+        elif command == "/input return":
+            self.sent.append(line)
+            line, cur = "", 0
+        self.input_line, self.cur = line, cur
+        return self.WEECHAT_RC_OK
+
+    # Output.
+    def prnt(self, buf, message):
+        self.printed.append(message)
+
+    def color(self, name):
+        return ""
+
+    def bar_item_update(self, item):
+        pass
+
+    # Options.
+    def config_string_to_boolean(self, value):
+        return int(value.lower() in ["on", "yes", "y", "true", "t", "1"])
+
+    def config_is_set_plugin(self, option):
+        return option in self.options
+
+    def config_get_plugin(self, option):
+        return self.options.get(option, "")
+
+    def config_set_plugin(self, option, value):
+        self.options[option] = value
+        vimode.cb_config("", "plugins.var.python.%s.%s" % (vimode.SCRIPT_NAME,
+                                                           option), value)
+
+    def info_get(self, name, arguments):
+        return ""
+
+    # Infolists, as a list of dicts and the index of the current item.
+    def infolist_get(self, name, pointer, arguments):
+        items = []
+        if name == "key" and arguments in ["", "default"]:
+            items = [{'key_internal': key, 'command': command}
+                     for key, command in self.KEY_BINDINGS.items()]
+        return [items, -1]
+
+    def infolist_next(self, infolist):
+        infolist[1] += 1
+        return int(infolist[1] < len(infolist[0]))
+
+    def infolist_reset_item_cursor(self, infolist):
+        infolist[1] = -1
+
+    def infolist_string(self, infolist, name):
+        return infolist[0][infolist[1]].get(name, "")
+
+    def infolist_pointer(self, infolist, name):
+        return infolist[0][infolist[1]].get(name, "")
+
+    def infolist_free(self, infolist):
+        pass
+
+    # Hooks.
+    def hook_timer(self, interval, align_second, max_calls, callback,
+                   callback_data):
+        self.hooks += 1
+        hook = "timer%d" % self.hooks
+        self.timers[hook] = [self.now + interval, interval, max_calls,
+                             callback, callback_data]
+        return hook
+
+    def hook_signal(self, signal, callback, callback_data):
+        self.hooks += 1
+        return "signal%d" % self.hooks
+
+    def hook_process(self, command, timeout, callback, callback_data):
+        return ""
+
+    def hook_process_hashtable(self, command, options, timeout, callback,
+                               callback_data):
+        return ""
+
+    def unhook(self, hook):
+        self.timers.pop(hook, None)
+
+    def run_timers(self, until=None):
+        """Run the timers due by `until` (in ms on the virtual clock, which
+        is then moved to it), or until there are none left."""
+        while self.timers:
+            hook = min(self.timers, key=lambda hook: self.timers[hook][0])
+            due, interval, max_calls, callback, data = self.timers[hook]
+            if until is not None and due > until:
+                break
+            self.now = max(self.now, due)
+            if max_calls == 1:
+                del self.timers[hook]
+            else:
+                self.timers[hook] = [due + interval, interval,
+                                     max(max_calls - 1, 0), callback, data]
+            # Callbacks are looked up by name, like WeeChat does.
+            getattr(vimode, callback)(data, max_calls - 1)
+        if until is not None:
+            self.now = max(self.now, until)
+
+
+class ViEngine(object):
+    """vimode's key handling on a `MemoryBackend`.
+
+    Keys are handled by the same code as in WeeChat, with the backend (or
+    `backend`) as vimode's `weechat` module and `state` as vimode's core
+    editing state. Creating an engine resets the rest of vimode's state (see
+    `reset_state()`).
+    """
+
+    def __init__(self, input_line="", cur=0, mode="INSERT", settings=None,
+                 backend=None):
+        """Set up the engine.
+
+        Args:
+            input_line (str, optional): initial content of the input line.
+            cur (int, optional): initial position of the cursor.
+            mode (str, optional): initial mode. Defaults to "INSERT", as in
+                WeeChat.
+            settings (dict, optional): option values, e.g.
+                `{'imap_esc': "jk"}`. Others use their default value.
+            backend (object, optional): used instead of a `MemoryBackend`.
+        """
+        # Profiling would keep wrapping the previous backend.
+        vimode.stop_profiling()
+        self.backend = backend or MemoryBackend(input_line, cur)
+        self.state = vimode.ViState(mode)
+        vimode.weechat = self.backend
+        vimode.state = self.state
+        reset_state()
+        settings_ = vimode.vimode_settings
+        settings_.clear()
+        settings_.update(DEFAULT_SETTINGS)
+        settings_.update(settings or {})
+        vimode.load_user_mappings()
+        vimode.load_mode_colors()
+        vimode.load_is_keyword_regexes()
+
+    @property
+    def input_line(self):
+        return self.backend.input_line
+
+    @property
+    def cur(self):
+        return self.backend.cur
+
+    @property
+    def mode(self):
+        return self.state.mode
+
+    def activate(self):
+        """Make vimode use this engine's backend and state, unless it already
+        does (the backend may then be wrapped for profiling)."""
+        if vimode.state is not self.state:
+            vimode.weechat = self.backend
+            vimode.state = self.state
+
+    def feed(self, keys):
+        """Handle `keys`, a string of key combos (see
+        `vimode.REGEX_KEY_COMBOS`) or a list of them.
+
+        Each key moves the virtual clock by 1 ms, running the timers that are
+        due. Esc goes through `vimode.cb_key_pressed()` like in WeeChat, and
+        is only handled once the Esc timeout has passed without another key
+        (the next key combo then starts with it, as WeeChat sends it). Once
+        all keys are handled, macros being played are played until they're
+        done.
+        """
+        self.activate()
+        if isinstance(keys, str):
+            keys = re.findall(vimode.REGEX_KEY_COMBOS, keys)
+        for combo in keys:
+            vimode.cb_key_pressed("", "key_pressed", combo)
+            if combo == "\x01[":
+                self.backend.run_timers(self.backend.now +
+                                        vimode.get_esc_timeout())
+                continue
+            if vimode.esc_pressed > 0:
+                combo = "\x01[" * vimode.esc_pressed + combo
+            with vimode.edit_transaction():
+                vimode.feed_key(combo)
+            self.backend.run_timers(self.backend.now + 1)
+        while vimode.macro_replay:
+            self.backend.run_timers(self.backend.now + 1)
+
+
+# vimode's state, as the value it's reset to by `reset_state()` (as
+# functions, for mutable values).
+STATE = {
+    'esc_pressed': lambda: 0,
+    'key_sequence': lambda: 0,
+    'esc_timer': lambda: None,
+    'last_key_time': lambda: 0,
+    'last_key_was_esc': lambda: False,
+    'last_search_motion': lambda: {'motion': None, 'data': None},
+    'last_change': lambda: None,
+    'change_tick': lambda: 0,
+    'insert_start': lambda: None,
+    'recording_register': lambda: None,
+    'recorded_keys': lambda: [],
+    'last_macro': lambda: None,
+    'macro_replay': lambda: None,
+    'cmd_mode_hook': lambda: None,
+    'cmd_compl_text': lambda: "",
+    'cmd_text_orig': lambda: None,
+    'cmd_compl_pos': lambda: 0,
+    'cmd_compl_list': lambda: [],
+    'history_matches': lambda: None,
+    'cmd_history': lambda: vimode.History(":"),
+    'search_history': lambda: vimode.History("/"),
+    'history_loaded': lambda: False,
+    'history_file_lines': lambda: 0,
+    'problematic_keys': lambda: None,
+    'profile': lambda: None,
+}
+# Containers of vimode's state, emptied by `reset_state()`.
+STATE_CONTAINERS = ["macros", "pending_input", "input_line_backup",
+                    "bar_items_dirty", "bar_items_shown", "bar_items_cache",
+                    "key_bindings", "word_boundaries_cache", "alt_key_gaps"]
+
+
+def reset_state():
+    """Reset vimode's module-global state, for a new `ViEngine`."""
+    for name, value in STATE.items():
+        setattr(vimode, name, value())
+    for name in STATE_CONTAINERS:
+        getattr(vimode, name).clear()
+    # Forget user mappings.
+    vimode.VI_KEYS.clear()
+    vimode.VI_KEYS.update(vimode.VI_DEFAULT_KEYS)
+    vimode.build_key_index()
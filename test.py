@@ -16,29 +16,44 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-"""Tests for weechat-vimode. Uses a gvim instance as a server to compare the
-behavior of our custom implementation to vim's.
+"""Tests for weechat-vimode. Compares the behavior of our implementation to
+vim's.
 
-Note that a full test takes a fair bit of time.
+Keys are tested in groups: a motion (e.g. "w"), an operator followed by a
+motion (e.g. "dw") or other keys (e.g. "x"). Each group is run on every test
+line, from every cursor position and with a few counts, both in vimode's
+test harness (see `harness.ViEngine`) and in vim. Vim runs headless
+(`vim -Es`), once per group, from a generated script that saves the results
+of all of the group's cases; groups are spread over a process pool.
+
+Motions are checked for the cursor's position, operators for the resulting
+line and the unnamed register, and other keys for the resulting line and the
+cursor's position. The exit status is 1 if any group differs from vim, so that
+it can gate merges. Known differences (see `KNOWN_DIFFERENCES`) are reported,
+but don't count.
 
 Usage:
-    python2 py.test
+    python test.py [-j JOBS] [GROUP...]
 """
 
 
-from mock import Mock
+import argparse
+import io
+import json
+import multiprocessing
+import os
 import subprocess
 import sys
-import time
-
-sys.modules['weechat'] = Mock()
+import tempfile
 
+import harness
 import vimode
 
 
-SERVER_NAME = "WEECHAT-VIMODE-TEST"
 TEST_LINES = ["    This is a test! Hello! ",
               " !olleH !tset a si sihT    ",
+              'call(foo, "bar baz", [1, (2, 3)]) <b>x</b>',
+              'say "a \\"b\\" c", \'\\\\\' and ""',
               # I don't think those are necessary to support in real life
               # usage (if the above tests pass), but it would be nice to have
               # 100% support if it's  possible without writing a parser from
@@ -47,81 +62,195 @@ TEST_LINES = ["    This is a test! Hello! ",
               "^#!)^)*%421!\\4`;l41;l3;l;l#!?#?!?!",
               "^#!)^\")*%421!\\4`;l'1;l3;';l#!?#?!?\"!",
               "^#!)^)*%\"4'1!\\4`;l41;l3;l;l#!?\"#'!?!"]
+COUNTS = [1, 3]
+ESC = "\x01["
+# Text typed after changes.
+INSERTED = "X" + ESC
+
+# Motions used after operators, and other keys to test.
+OPERATOR_MOTIONS = ["w", "W", "e", "E", "b", "B", "ge", "$", "0", "^", "h",
+                    "l", "f!", "t!", "F!", "T!", "iw", "aw", "iW", "aW", 'i"',
+                    'a"', "i(", "a(", "i[", "a]"]
+KEYS = ["x", "X", "~", "rZ", "D", "dd"]
+
+
+def ge_failed(line, cur, count, ours, vims):
+    """Return True if "ge" or "gE" failed: vim moves to the start of the line
+    before it beeps, vimode's motion fails and the cursor doesn't move."""
+    return ours == cur and vims == 0
+
+
+# Known differences from vim, by group: why, and a function telling if a
+# differing case is one, from the case (line, cur, count) and the checked
+# results (see `checked()`). Those cases are reported but don't fail.
+KNOWN_DIFFERENCES = {
+    'ge': ("count past the first word", ge_failed),
+    'gE': ("count past the first WORD", ge_failed),
+}
+
+
+def get_groups():
+    """Return the groups of keys to test, as (keys, kind) tuples where kind
+    is "motion", "operator" or "key"."""
+    groups = []
+    for motion in vimode.VI_MOTIONS:
+        # Catching motions look for a character found in every test line.
+        if motion in ["f", "F", "t", "T"]:
+            motion += "!"
+        groups.append((motion, "motion"))
+    for operator in vimode.VI_OPERATORS:
+        for motion in OPERATOR_MOTIONS:
+            groups.append((operator + motion, "operator"))
+    for keys in KEYS:
+        groups.append((keys, "key"))
+    return groups
+
+
+def get_cases(keys):
+    """Return the (line, cur, count) of each test case of a group.
+
+    Keys whose count is a number of lines are only tested without a count, as
+    the input line is a single line.
+    """
+    counts = [1] if "$" in keys or keys in ["D", "dd"] else COUNTS
+    return [(line, cur, count)
+            for line in TEST_LINES
+            for cur in range(len(line))
+            for count in counts]
+
+
+def get_keys(keys, count):
+    """Return the keys to press for `keys` with `count`. Changes are followed
+    by text typed in Insert mode."""
+    keys = "{}{}".format(count if count > 1 else "", keys)
+    if keys.lstrip("0123456789").startswith("c"):
+        keys += INSERTED
+    return keys
+
+
+def vim_script(keys, cases, output):
+    """Return a vim script running `keys` for each case, saving the results
+    to `output`."""
+    lines = ["set nocompatible", "set encoding=utf-8", "let s:results = []"]
+    for line, cur, count in cases:
+        vim_keys = get_keys(keys, count).replace(ESC, "\x1b")
+        lines += [
+            "call setline(1, {})".format(json.dumps(line)),
+            "call setcursorcharpos(1, {})".format(cur + 1),
+            "let @\" = ''",
+            "execute \"normal! \" . {}".format(json.dumps(vim_keys)),
+            "call add(s:results, [getline(1), charcol('.') - 1, @\"])",
+        ]
+    lines += ["call writefile([json_encode(s:results)], {})".format(
+        json.dumps(output)), "qall!"]
+    return "\n".join(lines) + "\n"
+
+
+def run_vim(keys, cases):
+    """Run `keys` in vim for each case, and return the results."""
+    fd, script = tempfile.mkstemp(suffix=".vim")
+    output = script + ".json"
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(vim_script(keys, cases, output))
+        subprocess.call(["vim", "-Es", "-N", "-u", "NONE", "-i", "NONE",
+                         "-S", script])
+        with io.open(output, encoding="utf-8") as f:
+            return [tuple(result) for result in json.load(f)]
+    finally:
+        for path in [script, output]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def run_vimode(keys, cases):
+    """Run `keys` in vimode for each case, and return the results."""
+    results = []
+    for line, cur, count in cases:
+        engine = harness.ViEngine(line, cur, mode="NORMAL")
+        pressed = get_keys(keys, count)
+        if pressed.endswith(INSERTED):
+            engine.feed(pressed[:-len(INSERTED)])
+            # Vim stops running keys once a change fails (it beeps), and
+            # doesn't type the text.
+            if engine.mode == "INSERT":
+                engine.feed(INSERTED)
+        else:
+            engine.feed(pressed)
+        results.append((engine.input_line, engine.cur,
+                        engine.state.registers.get('"', "")))
+    return results
+
+
+def checked(kind, result):
+    """Return the part of a (line, cur, register) result checked for `kind`
+    of keys."""
+    if kind == "motion":
+        return result[1]
+    if kind == "operator":
+        return result[0], result[2]
+    return result[:2]
+
+
+def known_difference(keys, case, ours, vims):
+    """Return why vimode and vim differ on a case of the `keys` group, if
+    it's a known difference (see `KNOWN_DIFFERENCES`), or None."""
+    if keys not in KNOWN_DIFFERENCES:
+        return None
+    reason, is_known = KNOWN_DIFFERENCES[keys]
+    line, cur, count = case
+    if is_known(line, cur, count, ours, vims):
+        return reason
+    return None
+
+
+def compare(keys, kind, got, expected):
+    """Print the cases of a group where vimode and vim differ, and return how
+    many there are, not counting known differences."""
+    errors = 0
+    for case, ours, vims in zip(get_cases(keys), got, expected):
+        ours, vims = checked(kind, ours), checked(kind, vims)
+        if ours == vims:
+            continue
+        reason = known_difference(keys, case, ours, vims)
+        if reason is None:
+            errors += 1
+            color = "31"
+        else:
+            color = "33"
+        print(("    \"{}\", cur: {}, count: {}: \033[{}m{!r} ≠ {!r}\033[0m"
+               "{}").format(case[0], case[1], case[2], color, ours, vims,
+                            " (known: {})".format(reason) if reason else ""))
+    return errors
+
+
+def run_group(keys):
+    """Run a group of keys in vim, and return the results of its cases."""
+    return run_vim(keys, get_cases(keys))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare vimode to vim.")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of vim processes to run at once")
+    parser.add_argument("groups", nargs="*", metavar="GROUP",
+                        help="only test these keys (e.g. dw)")
+    args = parser.parse_args()
+    groups = [(keys, kind) for keys, kind in get_groups()
+              if not args.groups or keys in args.groups]
+    pool = multiprocessing.Pool(args.jobs)
+    expected = pool.map_async(run_group, [keys for keys, _ in groups])
+    got = [run_vimode(keys, get_cases(keys)) for keys, _ in groups]
+    expected = expected.get()
+    pool.close()
+    failed = 0
+    for (keys, kind), ours, vims in zip(groups, got, expected):
+        print("• Testing {} \033[33m{}\033[0m…".format(kind, keys))
+        if compare(keys, kind, ours, vims):
+            failed += 1
+    print("{} of {} groups differ from vim.".format(failed, len(groups)))
+    return 1 if failed else 0
 
 
-def vim_send(keys):
-    """Send {keys} to vim server."""
-    subprocess.Popen(["vim", "--servername", SERVER_NAME, "--remote-send",
-                      keys], stdout=subprocess.PIPE).wait()
-
-def vim_expr(expr):
-    """Evaluate {expr} in vim server."""
-    subprocess.Popen(["vim", "--servername", SERVER_NAME, "vim",
-                      "--remote-expr", expr], stdout=subprocess.PIPE).wait()
-
-def vim_get_cur():
-    """Get the column of the cursor on the vim server."""
-    process = subprocess.Popen(["vim", "--servername", SERVER_NAME,
-                                "--remote-expr", "col('.')"],
-                               stdout=subprocess.PIPE)
-    out = process.communicate()[0].strip()
-    return int(out)
-
-def test_motion(motion_func, motion_keys):
-    """Compare a custom function's behavior to the vim server's to test it."""
-    count = 1
-    for line in TEST_LINES:
-        # Clear the buffer and insert our test line.
-        vim_send("<Esc>ggdGi{}<Esc>".format(line))
-        print(("• Testing motion \033[33m{}\033[0m with data "
-               "\033[33m\"{}\"\033[0m…").format(motion_keys, line))
-        # Check the behavior of our function for each possible cursor position.
-        for cur in range(0, len(line)):
-            # Get the cursor position, as returned by our function.
-            got, _, catching = motion_func(line, cur, count)
-            # Out of bound positions are corrected anyway, so we don't mind
-            # those inaccuracies.
-            got = max(1, min(len(line), got + 1))
-            # If it's a catching motion (e.g. "f"), it's not done yet.
-            if catching:
-                vimode.catching_keys_data['keys'] = "a"
-                vimode.catching_keys_data['amount'] = 0
-                callback = vimode.catching_keys_data['callback']
-                getattr(vimode, callback)()
-                got, _, _ = motion_func(line, cur, count)
-                got = max(1, min(len(line), cur + 1 if got == -1 else got + 1))
-
-            # Set the cursor's position on the vim server.
-            vim_expr("setpos('.', [0, 1, {}, 0])".format(cur + 1))
-            # Do the motion on the vim server.
-            vim_send(motion_keys)
-            # Complete the motion if it's catching (e.g. "f").
-            if catching:
-                vim_send("a")
-            # Get the cursor's position on the vim server.
-            expected = vim_get_cur()
-            # Print errors, if any.
-            if got != expected:
-                print("    cur: {}, count: {}: \033[31m{} ≠ {}\033[0m".format(
-                    cur, count, got, expected))
-
-
-# Start a vim server (we use gvim because it forks directly).
-SERVERS = subprocess.Popen(["gvim", "--serverlist"], stdout=subprocess.PIPE).communicate()[0]
-if not (SERVERS and SERVER_NAME in SERVERS.split()):
-    subprocess.Popen(["gvim", "--servername", SERVER_NAME]).wait()
-    time.sleep(0.5)  # To make sure it's completely ready.
-
-# Test each of weechat-vimode's custom motion implementations.
-for motion in vimode.VI_MOTIONS:
-    # Get the function's name (special characters need to be replaced; for
-    # example, "^"'s function is called "motion_carret" and not "motion_^").
-    if motion in vimode.SPECIAL_CHARS:
-        func = "motion_{}".format(vimode.SPECIAL_CHARS[motion])
-    else:
-        func = "motion_{}".format(motion)
-    # Test it!
-    test_motion(getattr(vimode, func), motion)
-
-# Exit the vim server.
-vim_send("<Esc>ZQ")
+if __name__ == "__main__":
+    sys.exit(main())
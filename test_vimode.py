@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013-2014 Germain Z. <germanosz@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Unit tests for weechat-vimode, for behavior that can't be compared to vim's
+(see test.py). They run on the test harness (see harness.py).
+
+Usage:
+    python -m unittest test_vimode
+"""
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import harness
+import vimode
+
+
+class SearchBackend(harness.MemoryBackend):
+    """`MemoryBackend` with WeeChat's text search."""
+
+    text_search = 0
+
+    def command(self, buf, command):
+        if command == "/input search_text_here":
+            self.text_search = 1
+        elif command == "/input search_stop_here":
+            self.text_search = 0
+        return harness.MemoryBackend.command(self, buf, command)
+
+    def buffer_get_integer(self, buf, prop):
+        if prop == "text_search":
+            return self.text_search
+        return harness.MemoryBackend.buffer_get_integer(self, buf, prop)
+
+
+class KeysBackend(harness.MemoryBackend):
+    """`MemoryBackend` with WeeChat's directories and key bindings listed by
+    name."""
+
+    def __init__(self, directory, bindings):
+        harness.MemoryBackend.__init__(self)
+        self.directory = directory
+        self.bindings = bindings
+        self.lookups = 0
+
+    def info_get(self, name, arguments):
+        if name in ["weechat_data_dir", "weechat_config_dir"]:
+            return self.directory
+        return harness.MemoryBackend.info_get(self, name, arguments)
+
+    def infolist_get(self, name, pointer, arguments):
+        if name == "key":
+            self.lookups += 1
+            return [[{'key': key, 'command': command}
+                     for key, command in self.bindings], -1]
+        return harness.MemoryBackend.infolist_get(self, name, pointer,
+                                                  arguments)
+
+
+class KeyWarningsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        with open(os.path.join(self.directory, "weechat.conf"), "w") as f:
+            f.write("[key]\n")
+        self.path = os.path.join(self.directory, "vimode_key_warnings")
+        self.backend = KeysBackend(self.directory,
+                                   [("meta-jmeta-x", "/foo"),
+                                    ("ctrl-A", "/bar")])
+        harness.ViEngine(mode="NORMAL", backend=self.backend)
+
+    def test_cached(self):
+        self.assertEqual(vimode.get_problematic_keys(),
+                         [("meta-jmeta-x", "/foo")])
+        vimode.problematic_keys = None
+        with open(self.path, "a") as f:
+            f.write("meta-jctrl-b\t/baz\n")
+        self.assertEqual(vimode.get_problematic_keys(),
+                         [("meta-jmeta-x", "/foo"), ("meta-jctrl-b", "/baz")])
+
+    def test_lines_without_tab(self):
+        vimode.get_problematic_keys()
+        vimode.problematic_keys = None
+        with open(self.path, "a") as f:
+            f.write("\nmeta-jctrl-b\n")
+        self.assertEqual(vimode.get_problematic_keys(),
+                         [("meta-jmeta-x", "/foo")])
+        vimode.check_warnings()
+
+    def test_reload(self):
+        vimode.get_problematic_keys()
+        vimode.problematic_keys = None
+        vimode.get_problematic_keys()
+        self.assertEqual(self.backend.lookups, 1)
+
+    def test_config_saved(self):
+        vimode.get_problematic_keys()
+        vimode.problematic_keys = None
+        self.backend.bindings.append(("meta-jctrl-b", "/baz"))
+        with open(os.path.join(self.directory, "weechat.conf"), "a") as f:
+            f.write("meta-jctrl-b = \"/baz\"\n")
+        self.assertEqual(vimode.get_problematic_keys(),
+                         [("meta-jmeta-x", "/foo"), ("meta-jctrl-b", "/baz")])
+
+    def test_bind_keys(self):
+        vimode.get_problematic_keys()
+        self.backend.bindings[0] = ("meta-jctrl-b", "/baz")
+        vimode.cb_vimode_cmd("", "", "bind_keys --list")
+        self.assertEqual(self.backend.lookups, 1)
+        self.assertIn("    /key unbind meta-jmeta-x", self.backend.printed)
+        vimode.cb_vimode_cmd("", "", "bind_keys")
+        self.assertEqual(self.backend.lookups, 2)
+        self.assertIn("/key unbind meta-jctrl-b", self.backend.commands)
+        self.assertNotIn("/key unbind meta-jmeta-x", self.backend.commands)
+
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = harness.ViEngine("hello world", 0, mode="NORMAL")
+        self.addCleanup(vimode.stop_profiling)
+
+    def test_start_stop(self):
+        handle_key_combo = vimode.handle_key_combo
+        vimode.cb_vimode_cmd("", "", "profile start")
+        self.assertIsNot(vimode.handle_key_combo, handle_key_combo)
+        self.assertIsNot(vimode.weechat, self.engine.backend)
+        self.engine.feed("wx")
+        self.assertEqual(self.engine.input_line, "hello orld")
+        vimode.cb_vimode_cmd("", "", "profile stop")
+        self.assertIs(vimode.handle_key_combo, handle_key_combo)
+        self.assertIs(vimode.weechat, self.engine.backend)
+        report = vimode.profile_report()
+        self.assertEqual(report['functions']['handle_key_combo']['calls'], 2)
+        self.assertGreater(report['weechat']['buffer_get_string'], 0)
+
+    def test_stop_unwraps_recorded(self):
+        vimode.exec_cmd(":nnoremap Q dw")
+        vimode.cb_vimode_cmd("", "", "profile start")
+        self.engine.feed("dwQ")
+        vimode.cb_vimode_cmd("", "", "profile stop")
+        functions = vimode.profile_report()['functions']
+        self.assertEqual(functions['do_operator']['calls'], 2)
+        self.assertEqual(functions['UserMapping']['calls'], 1)
+        self.engine.feed("..Q")
+        self.assertEqual(vimode.profile_report()['functions'], functions)
+
+    def test_report(self):
+        vimode.cb_vimode_cmd("", "", "profile report")
+        self.assertEqual(len(self.engine.backend.printed), 1)
+        vimode.cb_vimode_cmd("", "", "profile start")
+        self.engine.feed("x")
+        vimode.cb_vimode_cmd("", "", "profile report")
+        self.assertTrue(any("handle_key_combo" in line
+                            for line in self.engine.backend.printed))
+
+    def test_report_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "profile.json")
+        vimode.cb_vimode_cmd("", "", "profile start")
+        self.engine.feed("x")
+        vimode.cb_vimode_cmd("", "", "profile report " + path)
+        with open(path) as f:
+            self.assertIn("handle_key_combo", json.load(f)['functions'])
+        printed = len(self.engine.backend.printed)
+        vimode.cb_vimode_cmd("", "", "profile report " +
+                             os.path.join(path, "missing"))
+        self.assertEqual(len(self.engine.backend.printed), printed + 1)
+        self.assertIn("Failed", self.engine.backend.printed[-1])
+
+
+class UndoTest(unittest.TestCase):
+
+    def test_redo_at_newest_change(self):
+        engine = harness.ViEngine("hello world foo", 0, mode="NORMAL")
+        engine.feed("x")
+        engine.feed("\x01R")
+        self.assertEqual(engine.input_line, "ello world foo")
+        engine.feed("3\x01R")
+        self.assertEqual(engine.input_line, "ello world foo")
+
+    def test_undo_at_oldest_change(self):
+        engine = harness.ViEngine("hello world foo", 0, mode="NORMAL")
+        engine.feed("xx")
+        engine.feed("9u")
+        line = engine.input_line
+        engine.feed("u")
+        self.assertEqual(engine.input_line, line)
+        engine.feed("\x01R")
+        self.assertNotEqual(engine.input_line, line)
+
+    def test_without_history(self):
+        engine = harness.ViEngine("hello world foo", 3, mode="NORMAL")
+        engine.feed("u\x01R")
+        self.assertEqual(engine.input_line, "hello world foo")
+
+
+class MotionTest(unittest.TestCase):
+
+    def check(self, line, cur, keys, expected):
+        engine = harness.ViEngine(line, cur, mode="NORMAL")
+        engine.feed(keys)
+        self.assertEqual(engine.cur, expected)
+
+    def test_repeat_t(self):
+        self.check("ab!c!d", 0, "t!", 1)
+        self.check("ab!c!d", 0, "t!;", 3)
+        self.check("ab!c!d", 0, "t!;,", 3)
+        self.check("d!c!ba", 5, "T!;", 2)
+
+    def test_catch_command_keys(self):
+        self.check("a:b/c", 0, "f:", 1)
+        self.check("a:b/c", 0, "f/", 3)
+
+    def test_backward_count(self):
+        self.check("ab cd", 3, "3b", 0)
+        self.check("ab cd", 4, "5ge", 0)
+        self.check("  ab", 3, "2ge", 0)
+
+    def test_failed_change(self):
+        engine = harness.ViEngine("abc", 1, mode="NORMAL")
+        engine.feed("cfz")
+        self.assertEqual((engine.input_line, engine.mode), ("abc", "NORMAL"))
+        engine.feed("0cb")
+        self.assertEqual((engine.input_line, engine.mode), ("abc", "NORMAL"))
+
+
+class TextObjectTest(unittest.TestCase):
+
+    def check(self, line, cur, keys, expected, register):
+        engine = harness.ViEngine(line, cur, mode="NORMAL")
+        engine.feed(keys)
+        self.assertEqual((engine.input_line,
+                          engine.state.registers.get('"', "")),
+                         (expected, register))
+
+    def test_count_too_large(self):
+        self.check("ab c", 0, "3diw", "", "ab c")
+        self.check("ab c", 0, "4diw", "ab c", "")
+        self.check("ab c", 0, "3daw", "ab c", "")
+        self.check("a b", 0, "3daW", "a b", "")
+        self.check("x (a (b)) y", 6, "3di(", "x (a (b)) y", "")
+
+    def test_quote_count(self):
+        self.check('" "', 1, '2di"', "", '" "')
+        self.check('a "b" c', 0, '3di"', "a  c", '"b"')
+        self.check('a "b" c', 0, '2da"', "a c", '"b" ')
+
+    def test_escaped_quotes(self):
+        self.check('\\""', 1, 'da"', "\\", '""')
+        self.check('"a\\"b"', 0, 'di"', '""', 'a\\"b')
+        self.check('"a\\\\"b"', 0, 'di"', '""b"', "a\\\\")
+        self.check('\\\\"a"', 3, 'di"', '\\\\""', "a")
+
+    def test_quote_pairs(self):
+        self.check('"a" "b"', 3, 'di"', '"a""b"', " ")
+        self.check('"a" "b"', 4, 'di"', '"a" ""', "b")
+
+    def test_block_after_cursor(self):
+        self.check("x (a) b", 0, "di(", "x () b", "a")
+        self.check("x [a] b", 0, "da]", "x  b", "[a]")
+        self.check("x (a (b)) y", 0, "2di(", "x (a ()) y", "b")
+        self.check("x (a) (b)", 0, "2di(", "x (a) (b)", "")
+
+    def test_brackets_skipped(self):
+        self.check("[\\]a]", 3, "da]", "", "[\\]a]")
+        self.check("(\\)", 1, "da(", "(\\)", "")
+        self.check('("a)" b)', 1, "di(", "()", '"a)" b')
+        self.check("(')' b)", 1, "di(", "()", "')' b")
+
+
+class RegisterTest(unittest.TestCase):
+
+    def test_size_limit(self):
+        engine = harness.ViEngine("ab" * 1024, 0, mode="NORMAL",
+                                  settings={'register_size': "1"})
+        engine.feed('"ay$')
+        self.assertEqual(engine.state.registers['a'], "ab" * 512)
+        self.assertEqual(engine.state.registers['"'], "ab" * 512)
+        engine.feed('"Ayl')
+        self.assertEqual(len(engine.state.registers['a']), 1024)
+        engine.feed('ylyy')
+        self.assertEqual(engine.state.registers['0'], "ab" * 512)
+
+    def test_macro_size_limit(self):
+        engine = harness.ViEngine("abc", 0, mode="NORMAL",
+                                  settings={'register_size': "1"})
+        engine.feed("qa" + "l" * 1500 + "q")
+        self.assertEqual(engine.state.registers['a'], "l" * 1024)
+        engine.feed("qA" + "h" * 10 + "q")
+        self.assertEqual(engine.state.registers['a'], "l" * 1024)
+        engine.feed("0@a")
+        self.assertEqual(engine.cur, 2)
+
+
+class MacroTest(unittest.TestCase):
+
+    def test_esc_recorded(self):
+        engine = harness.ViEngine("ab", 0, mode="NORMAL")
+        engine.feed("qaAxy\x01[q")
+        self.assertEqual(engine.state.registers['a'], "Axy\x01[")
+        engine.feed("@a")
+        self.assertEqual((engine.input_line, engine.mode),
+                         ("abxyxy", "NORMAL"))
+        engine.feed(".")
+        self.assertEqual((engine.input_line, engine.mode),
+                         ("abxyxyxy", "NORMAL"))
+
+
+class EngineTest(unittest.TestCase):
+
+    def test_separate_state(self):
+        first = harness.ViEngine("hello", 0, mode="NORMAL")
+        second = harness.ViEngine("world", 0, mode="NORMAL")
+        first.feed("yyi")
+        second.feed("x")
+        self.assertEqual((first.mode, first.state.registers['"']),
+                         ("INSERT", "hello"))
+        self.assertEqual((second.mode, second.state.registers['"']),
+                         ("NORMAL", "w"))
+
+
+class SubstituteTest(unittest.TestCase):
+
+    def test_groups(self):
+        engine = harness.ViEngine("foo bar", 0, mode="NORMAL")
+        vimode.exec_cmd(":s/(foo) (bar)/\\2 \\1 &/")
+        self.assertEqual(engine.input_line, "bar foo foo bar")
+
+    def test_invalid_group_reference(self):
+        for cmd in [":s/foo/\\1/", ":s/(foo)/\\2/"]:
+            engine = harness.ViEngine("foo bar", 0, mode="NORMAL")
+            vimode.exec_cmd(cmd)
+            self.assertEqual(engine.input_line, "foo bar")
+            self.assertEqual(len(engine.backend.printed), 1)
+
+
+class CommandModeTest(unittest.TestCase):
+
+    def test_erase_colon(self):
+        engine = harness.ViEngine("hello", 0, mode="NORMAL")
+        engine.feed(":")
+        self.assertEqual(engine.mode, "COMMAND")
+        engine.backend.buffer_set("buffer", "input", "")
+        self.assertEqual(engine.mode, "NORMAL")
+
+    def test_empty_search(self):
+        engine = harness.ViEngine(mode="NORMAL",
+                                  settings={'search_vim': "on"},
+                                  backend=SearchBackend())
+        engine.feed("/ab")
+        engine.backend.buffer_set("buffer", "input", "")
+        self.assertEqual(engine.mode, "COMMAND")
+        engine.feed("x\x01M")
+        self.assertEqual(engine.mode, "SEARCH")
+
+
+if __name__ == "__main__":
+    unittest.main()
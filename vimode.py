@@ -22,21 +22,22 @@
 
 
 from abc import ABCMeta, abstractproperty
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque, namedtuple
 from contextlib import contextmanager
-import csv
 import functools
+import itertools
 import json
 import os
 import re
-import subprocess
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
-import sys
 import time
 
-import weechat
+try:
+    import weechat
+except ImportError:
+    # Outside WeeChat (e.g. in tests, see harness.py), `weechat` is replaced
+    # with a stand-in before use.
+    weechat = None
 
 
 # Script info.
@@ -55,6 +56,35 @@ SCRIPT_DESC = ("Add vi/vim-like modes and keybindings to WeeChat.")
 # General.
 # --------
 
+class ViState(object):
+    """Core editing state, kept together so it can be swapped out (e.g. by
+    the test harness).
+
+    Attributes:
+        mode (str): mode we're in. One of INSERT, NORMAL, REPLACE, COMMAND or
+            SEARCH. SEARCH is only used if search_vim is enabled.
+        vi_buffer (str): normal commands typed so far (e.g. "d" for "dd").
+        catching_keys_data (dict): see `start_catching_keys()`.
+        registers (dict): in-memory registers, by name. See
+            `store_register()`.
+        register_name (str): register selected with "{register} for the next
+            yank/delete/put, if any.
+        undo_history (dict): `UndoHistory` objects by buffer.
+        undo_history_size (int): total size of `undo_history`.
+    """
+
+    def __init__(self, mode="INSERT"):
+        self.mode = mode
+        self.vi_buffer = ""
+        self.catching_keys_data = {'amount': 0}
+        self.registers = {}
+        self.register_name = None
+        self.undo_history = {}
+        self.undo_history_size = 0
+
+
+state = ViState()
+
 # Halp! Halp! Halp!
 GITHUB_BASE = "https://github.com/GermainZ/weechat-vimode/blob/master/"
 README_URL = GITHUB_BASE + "README.md"
@@ -67,29 +97,76 @@ cmd_compl_text = ""
 cmd_text_orig = None
 # Index of current suggestion, used for completion.
 cmd_compl_pos = 0
-# Used for command-line mode history.
-cmd_history = []
+# Suggestions for the text being completed.
+cmd_compl_list = []
+# Used for command-line mode history (see `recall_history()`): the entries
+# matching the text typed before recalling them, this text, and the position
+# of the one shown.
+history_matches = None
+history_prefix = ""
 cmd_history_index = 0
 # Used to store the content of the input line when going into COMMAND mode.
 input_line_backup = {}
-# Mode we're in. One of INSERT, NORMAL, REPLACE, COMMAND or SEARCH.
-# SEARCH is only used if search_vim is enabled.
-mode = "INSERT"
-# Holds normal commands (e.g. "dd").
-vi_buffer = ""
+# Hook on the input_text_changed signal, while in COMMAND mode.
+cmd_mode_hook = None
+# Input line writes not sent to WeeChat yet, by buffer: [text, cursor], either
+# of which can be None. See `edit_transaction()`.
+pending_input = {}
+# Number of nested `edit_transaction()`s.
+edit_depth = 0
+# Bar items to refresh at the end of the current event, and the last value we
+# refreshed them with. See `update_bar_item()`.
+bar_items_dirty = set()
+bar_items_shown = {}
+# Rendered content of the mode_indicator and line_numbers bar items, by what
+# it depends on. Cleared when options change.
+bar_items_cache = {}
 # See `cb_key_combo_default()`.
 esc_pressed = 0
-# See `cb_key_pressed()`.
-last_signal_time = 0
-# See `start_catching_keys()` for more info.
-catching_keys_data = {'amount': 0}
+# Clock used to time key presses (`time.monotonic()` isn't available on
+# python 2).
+monotonic = getattr(time, "monotonic", time.time)
+# See `cb_key_pressed()`: number of keys pressed so far, the pending Esc
+# detection timer, when the last key was pressed (and whether it was "\x01["),
+# and the last gaps (in seconds) seen between "\x01[" and the next key.
+key_sequence = 0
+esc_timer = None
+last_key_time = 0
+last_key_was_esc = False
+alt_key_gaps = deque(maxlen=20)
 # Used for ; and , to store the last f/F/t/T motion.
 last_search_motion = {'motion': None, 'data': None}
-# Used for undo history.
-undo_history = {}
-undo_history_index = {}
+# Used for . to store the last change (see `record_change()`), the number of
+# changes recorded so far, and the input line when Insert mode was entered
+# along with the change it belongs to.
+last_change = None
+change_tick = 0
+insert_start = None
+replaying_change = False
+# Used for macros: the register being recorded and the keys recorded so far,
+# the keys of recorded macros by register, the last macro played (for @@) and
+# the macro being played, if any (see `play_macro()`).
+recording_register = None
+recorded_keys = []
+macros = {}
+last_macro = None
+macro_replay = None
+replaying_macro = False
 # Holds mode colors (loaded from vimode_settings).
 mode_colors = {}
+# `WordBoundaries` of recently seen input lines, by content.
+word_boundaries_cache = {}
+# WeeChat's key bindings by key combo, by context (e.g. "default"), used to
+# handle keys vimode doesn't eat when playing macros. See `feed_key()`.
+key_bindings = {}
+# Problematic key bindings, as (key, command) tuples, or None if they haven't
+# been looked up since the script was loaded or keys were (un)bound. See
+# `get_problematic_keys()`.
+problematic_keys = None
+# Profiling data while profiling (see `/vimode profile`), or None. The
+# original of each function wrapped for profiling is kept, to restore it.
+profile = None
+profiled_functions = {}
 
 # Script options.
 vimode_settings = {
@@ -101,11 +178,33 @@ vimode_settings = {
     'paste_clipboard_cmd': ("xclip -selection c -o",
                             ("command used to paste clipboard; must output "
                              "content to stdout")),
+    'clipboard': ("", ("set to 'unnamedplus' to yank, delete and put using "
+                       "the clipboard (the \"+ register) by default instead "
+                       "of the in-memory registers, like vim's clipboard "
+                       "option")),
     'imap_esc': ("", ("use alternate mapping to enter Normal mode while in "
                       "Insert mode; having it set to 'jk' is similar to "
                       "`:imap jk <Esc>` in vim")),
+    'esc_timeout': ("50", ("time in ms to wait after Esc for another key, "
+                           "before deciding that Esc (and not Alt) was "
+                           "pressed")),
+    'esc_timeout_adaptive': ("off", ("wait less than esc_timeout after Esc "
+                                     "once vimode has learned how fast your "
+                                     "terminal sends Alt+key sequences")),
     'imap_esc_timeout': ("1000", ("time in ms to wait for the imap_esc "
                                   "sequence to complete")),
+    'undo_levels': ("1000", ("maximum number of changes that can be undone "
+                             "in each buffer's input line")),
+    'undo_memory': ("1024", ("maximum size (in KB) of the undo history of all "
+                             "buffers; the oldest changes of the least "
+                             "recently edited buffers are dropped first")),
+    'register_size': ("1024", ("maximum size (in KB) of the text in each "
+                               "register; longer text (e.g. appended with "
+                               "\"A) is truncated")),
+    'history_size': ("100", ("number of command-line and search history "
+                             "entries to remember (and save to the "
+                             "vimode_history file in WeeChat's data "
+                             "directory)")),
     'search_vim': ("off", ("allow n/N usage after searching (requires an extra"
                            " <Enter> to return to normal mode)")),
     'user_mappings': ("", ("see the `:nmap` command in the README for more "
@@ -151,7 +250,18 @@ vimode_settings = {
 # Regex patterns.
 # ---------------
 
-WHITESPACE = re.compile(r"\s")
+# Patterns only used by some commands are kept as strings, and compiled (then
+# cached by the `re` module) on first use rather than when loading the script.
+
+# Splits text into key combos, e.g. to play a register's text as a macro when
+# it wasn't recorded with q. "\x01[" is always Esc, rather than Alt+key.
+REGEX_KEY_COMBOS = r"(?s)\x01\[\[[0-9;]*.|\x01\[|\x01.|."
+
+# Opening, closing or self-closing tag, for "it"/"at".
+REGEX_TAG = r"<(/?)([^\s<>/]+)[^<>]*?(/?)>"
+# Alt-j followed by the number of the buffer to jump to, received as a single
+# key combo (e.g. "\x01[j11"), or the start of one.
+REGEX_ALT_J_BUFFER = r"\x01\[j[0-9]{1,2}$"
 REGEX_MOTION_UPPERCASE_W = re.compile(r"(?<=\s)\S")
 REGEX_MOTION_UPPERCASE_E = re.compile(r"\S(?!\S)")
 REGEX_MOTION_UPPERCASE_B = REGEX_MOTION_UPPERCASE_E
@@ -160,22 +270,27 @@ REGEX_MOTION_CARRET = re.compile(r"\S")
 REGEX_INT = r"[0-9]"
 keyword_regexes = {}  # Loaded on runtime (uses the is_keyword config option).
 REGEX_MAP_KEYS_1 = {
-    re.compile("<([^>]*-)Left>", re.IGNORECASE): '<\\1\x01[[D>',
-    re.compile("<([^>]*-)Right>", re.IGNORECASE): '<\\1\x01[[C>',
-    re.compile("<([^>]*-)Up>", re.IGNORECASE): '<\\1\x01[[A>',
-    re.compile("<([^>]*-)Down>", re.IGNORECASE): '<\\1\x01[[B>',
-    re.compile("<Left>", re.IGNORECASE): '\x01[[D',
-    re.compile("<Right>", re.IGNORECASE): '\x01[[C',
-    re.compile("<Up>", re.IGNORECASE): '\x01[[A',
-    re.compile("<Down>", re.IGNORECASE): '\x01[[B'
+    r"(?i)<([^>]*-)Left>": '<\\1\x01[[D>',
+    r"(?i)<([^>]*-)Right>": '<\\1\x01[[C>',
+    r"(?i)<([^>]*-)Up>": '<\\1\x01[[A>',
+    r"(?i)<([^>]*-)Down>": '<\\1\x01[[B>',
+    r"(?i)<Left>": '\x01[[D',
+    r"(?i)<Right>": '\x01[[C',
+    r"(?i)<Up>": '\x01[[A',
+    r"(?i)<Down>": '\x01[[B'
 }
 REGEX_MAP_KEYS_2 = {
     # Python's regex doesn't support \U1, but we're using a simple hack when
     # replacing to fix this.
-    re.compile(r"<C-([^>]*)>", re.IGNORECASE): '\x01\\U1',
-    re.compile(r"<M-([^>]*)>", re.IGNORECASE): '\x01[\\1'
+    r"(?i)<C-([^>]*)>": '\x01\\U1',
+    r"(?i)<M-([^>]*)>": '\x01[\\1'
 }
 
+# Regex for the :s command: [range]s{delimiter}pattern{delimiter}... where the
+# range is "%" or "{line}[,{line}]". See `parse_substitute()`.
+REGEX_SUBSTITUTE = (
+    r"(%|([.$]|\d+)(?:,([.$]|\d+))?)?s(?:ubstitute)?([^\w\s\\\"|])")
+
 # Regex used to detect problematic keybindings.
 # For example: meta-wmeta-s is bound by default to ``/window swap``.
 #    If the user pressed Esc-w, WeeChat will detect it as meta-w and will not
@@ -183,12 +298,19 @@ REGEX_MAP_KEYS_2 = {
 #    beginning of a known key combo.
 #    Instead, `cb_key_combo_default()` will receive the Esc-ws signal, which
 #    becomes "ws" after removing the Esc part, and won't know how to handle it.
-REGEX_PROBLEMATIC_KEYBINDINGS = re.compile(r"meta-\w(meta|ctrl)")
+REGEX_PROBLEMATIC_KEYBINDINGS = r"meta-\w(meta|ctrl)"
 
 
 # Vi commands.
 # ------------
 
+# Registers that can be selected with "{register}, in the order they are
+# listed by `:registers`. "A-"Z are also accepted, to append to "a-"z.
+REGISTER_NAMES = '"0123456789abcdefghijklmnopqrstuvwxyz+'
+# Number of keys of a macro played at once, before giving WeeChat a chance to
+# handle other events (e.g. Esc, to abort it).
+MACRO_CHUNK_SIZE = 100
+
 def add_mapping(args, key):
     """Add a user-defined key mapping.
 
@@ -235,23 +357,24 @@ def add_mapping(args, key):
     elif " " not in args:
         weechat.prnt("", "nmap syntax -> :nmap {lhs} {rhs}")
     else:
-        key, mapping = args.split(" ", 1)
+        keys, mapping = args.split(" ", 1)
         # First pass of replacements. We perform two passes as a simple way to
         # avoid incorrect replacements due to dictionaries not being
         # insertion-ordered prior to Python 3.7.
         for regex, repl in REGEX_MAP_KEYS_1.items():
-            key = regex.sub(repl, key)
-            mapping = regex.sub(repl, mapping)
+            keys = re.sub(regex, repl, keys)
+            mapping = re.sub(regex, repl, mapping)
         # Second pass of replacements.
         for regex, repl in REGEX_MAP_KEYS_2.items():
             if '\\U' in repl:  # Hack, but works well for our simple case.
                 repl = repl.replace('\\U', '\\')
-                key = regex.sub(lambda pat: pat.expand(repl).upper(), key)
+                keys = re.sub(regex, lambda pat: pat.expand(repl).upper(),
+                              keys)
             else:
-                key = regex.sub(repl, key)
-            mapping = regex.sub(repl, mapping)
+                keys = re.sub(regex, repl, keys)
+            mapping = re.sub(regex, repl, mapping)
         mappings = vimode_settings[key]
-        mappings[key] = mapping
+        mappings[keys] = mapping
         weechat.config_set_plugin(key, json.dumps(mappings))
         vimode_settings[key] = mappings
 
@@ -275,31 +398,46 @@ def cmd_nunmap(args):
     else:
         key = args
         for regex, repl in REGEX_MAP_KEYS_1.items():
-            key = regex.sub(repl, key)
+            key = re.sub(regex, repl, key)
         for regex, repl in REGEX_MAP_KEYS_2.items():
             if '\\U' in repl:  # Hack, but works well for our simple case.
                 repl = repl.replace('\\U', '\\')
-                key = regex.sub(lambda pat: pat.expand(repl).upper(), key)
+                key = re.sub(regex, lambda pat: pat.expand(repl).upper(), key)
             else:
-                key = regex.sub(repl, key)
+                key = re.sub(regex, repl, key)
         found = False
         for setting in ['user_mappings', 'user_mappings_noremap']:
             mappings = vimode_settings[setting]
             if key in mappings:
                 found = True
                 del mappings[key]
-                del VI_KEYS[key]
+                VI_KEYS.pop(key, None)
 
                 # restore default keys
                 if key in VI_DEFAULT_KEYS:
                     VI_KEYS[key] = VI_DEFAULT_KEYS[key]
+                update_key_index(key)
 
                 weechat.config_set_plugin(setting, json.dumps(mappings))
                 vimode_settings[setting] = mappings
         if not found:
             weechat.prnt("", "nunmap: No such mapping")
 
-# See Also: `cb_exec_cmd()`.
+def cmd_registers(args):
+    """List the content of registers (or only those in `args`)."""
+    names = [name for name in REGISTER_NAMES if name in state.registers and
+             (not args.strip() or name in args)]
+    weechat.prnt("", "--- Registers ---")
+    for name in names:
+        text = state.registers[name]
+        # Show control characters (e.g. from key mappings) like vim does.
+        text = re.sub(r"[\x00-\x1f]",
+                      lambda match: "^" + chr(ord(match.group()) + 64), text)
+        if len(text) > 80:
+            text = text[:79] + "…"
+        weechat.prnt("", '"{}   {}'.format(name, text))
+
+# See Also: `exec_cmd()`.
 VI_COMMAND_GROUPS = {('h', 'help'): "/help",
                      ('qa', 'qall', 'quita', 'quitall'): "/exit",
                      ('q', 'quit'): "/close",
@@ -313,7 +451,8 @@ VI_COMMAND_GROUPS = {('h', 'help'): "/help",
                      ('vs', 'vsplit'): "/window splitv",
                      ('nm', 'nmap'): cmd_nmap,
                      ('nn', 'nnoremap'): cmd_nnoremap,
-                     ('nun', 'nunmap'): cmd_nunmap}
+                     ('nun', 'nunmap'): cmd_nunmap,
+                     ('reg', 'registers', 'di', 'display'): cmd_registers}
 
 VI_COMMANDS = dict()
 for T, v in VI_COMMAND_GROUPS.items():
@@ -335,7 +474,16 @@ VI_OPERATORS = ["c", "d", "y"]
 # "motion_X" where X is the motion (e.g. `motion_w()`).
 # See Also: `SPECIAL_CHARS`.
 VI_MOTIONS = ["w", "e", "b", "^", "$", "h", "l", "W", "E", "B", "f", "F", "t",
-              "T", "ge", "gE", "0", "iw"]
+              "T", "ge", "gE", "0"]
+
+# Vi text objects, which can follow an operator (e.g. "ci("). "i" selects the
+# inner object and "a" the object along with its delimiters or white space.
+# See `select_text_object()`.
+TEXT_OBJECT_BRACKETS = {'(': "()", ')': "()", 'b': "()", '[': "[]", ']': "[]",
+                        '{': "{}", '}': "{}", 'B': "{}", '<': "<>", '>': "<>"}
+VI_TEXT_OBJECTS = [prefix + obj for prefix in "ia"
+                   for obj in ["w", "W", '"', "'", "`", "t"] +
+                   sorted(TEXT_OBJECT_BRACKETS)]
 
 # Special characters for motions. The corresponding function's name is
 # converted before calling. For example, "^" will call `motion_carret` instead
@@ -390,7 +538,9 @@ def motion_base(input_line, cur, count):
         A tuple containing four values:
             int: the starting position of the selection. Usually the cursor's
                 position.
-            int: the ending position of the motion.
+            int: the ending position of the motion, or None if the motion
+                fails (e.g. "f" with no character to go to), in which case
+                the cursor doesn't move and operators do nothing.
             bool: True if the motion is inclusive, False otherwise.
             bool: True if the motion is catching, False otherwise.
                 See `start_catching_keys()` for more info on catching motions.
@@ -448,11 +598,12 @@ def operator_d(buf, input_line, pos1, pos2, overwrite=False):
     end = max(pos1, pos2)
     if overwrite:
         end += 1
+    store_register(input_line[start:end], True)
     input_line = list(input_line)
     del input_line[start:end]
     input_line = "".join(input_line)
-    weechat.buffer_set(buf, "input", input_line)
-    set_cur(buf, input_line, pos2)
+    set_input(buf, input_line)
+    set_cur(buf, input_line, start)
 
 def operator_c(buf, input_line, pos1, pos2, overwrite=False):
     """Delete text from `pos1` to `pos2` from the input and enter Insert mode.
@@ -465,22 +616,22 @@ def operator_c(buf, input_line, pos1, pos2, overwrite=False):
     """
     operator_d(buf, input_line, pos1, pos2, overwrite)
     set_mode("INSERT")
-    set_cur(buf, input_line, pos1)
+    set_cur(buf, input_line, min(pos1, pos2))
 
-def operator_y(buf, input_line, pos1, pos2, _):
+def operator_y(buf, input_line, pos1, pos2, overwrite=False):
     """Yank text from `pos1` to `pos2` from the input line.
 
+    If `overwrite` is set to True, the character at the cursor's new position
+    is yanked as well (the motion is inclusive).
+
     See Also:
         `operator_base()`.
     """
     start = min(pos1, pos2)
     end = max(pos1, pos2)
-    cmd = vimode_settings['copy_clipboard_cmd']
-    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
-    if sys.version_info > (3,):
-        proc.communicate(input=input_line[start:end].encode())
-    else:
-        proc.communicate(input=input_line[start:end])
+    if overwrite:
+        end += 1
+    store_register(input_line[start:end])
 
 
 # Motions:
@@ -500,10 +651,11 @@ def motion_w(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    pos = get_pos(input_line, keyword_regexes['w'], cur, True, count)
+    pos = get_word_boundaries(input_line).next(keyword_regexes['w'], cur,
+                                               count)
     if pos == -1:
         return cur, len(input_line), False, False
-    return cur, cur + pos, False, False
+    return cur, pos, False, False
 
 def motion_W(input_line, cur, count):
     """Go `count` WORDS forward and return position.
@@ -511,10 +663,11 @@ def motion_W(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    pos = get_pos(input_line, REGEX_MOTION_UPPERCASE_W, cur, True, count)
+    pos = get_word_boundaries(input_line).next(REGEX_MOTION_UPPERCASE_W, cur,
+                                               count)
     if pos == -1:
         return cur, len(input_line), False, False
-    return cur, cur + pos, False, False
+    return cur, pos, False, False
 
 def motion_e(input_line, cur, count):
     """Go to the end of `count` words and return position.
@@ -522,10 +675,11 @@ def motion_e(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    pos = get_pos(input_line, keyword_regexes['e'], cur, True, count)
+    pos = get_word_boundaries(input_line).next(keyword_regexes['e'], cur,
+                                               count)
     if pos == -1:
         return cur, len(input_line), True, False
-    return cur, cur + pos, True, False
+    return cur, pos, True, False
 
 def motion_E(input_line, cur, count):
     """Go to the end of `count` WORDS and return cusor position.
@@ -533,10 +687,11 @@ def motion_E(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    pos = get_pos(input_line, REGEX_MOTION_UPPERCASE_E, cur, True, count)
+    pos = get_word_boundaries(input_line).next(REGEX_MOTION_UPPERCASE_E, cur,
+                                               count)
     if pos == -1:
         return cur, len(input_line), False, False
-    return cur, cur + pos, True, False
+    return cur, pos, True, False
 
 def motion_b(input_line, cur, count):
     """Go `count` words backwards and return position.
@@ -545,9 +700,9 @@ def motion_b(input_line, cur, count):
         `motion_base()`.
     """
     # "b" is just "e" on inverted data (e.g. "olleH" instead of "Hello").
-    pos_inv = motion_e(input_line[::-1], len(input_line) - cur - 1, count)[1]
-    pos = len(input_line) - pos_inv - 1
-    return cur, max(0, pos), True, False
+    pos = get_word_boundaries(input_line).backward(keyword_regexes['e'], cur,
+                                                   count)
+    return cur, pos, False, False
 
 def motion_B(input_line, cur, count):
     """Go `count` WORDS backwards and return position.
@@ -555,13 +710,9 @@ def motion_B(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    new_cur = len(input_line) - cur
-    pos = get_pos(input_line[::-1], REGEX_MOTION_UPPERCASE_B, new_cur,
-                  count=count)
-    if pos == -1:
-        return cur, 0, False, False
-    pos = len(input_line) - (pos + new_cur + 1)
-    return cur, pos, True, False
+    pos = get_word_boundaries(input_line).backward(REGEX_MOTION_UPPERCASE_B,
+                                                   cur, count)
+    return cur, pos, False, False
 
 def motion_ge(input_line, cur, count):
     """Go to end of `count` words backwards and return position.
@@ -570,8 +721,8 @@ def motion_ge(input_line, cur, count):
         `motion_base()`.
     """
     # "ge is just "w" on inverted data (e.g. "olleH" instead of "Hello").
-    pos_inv = motion_w(input_line[::-1], len(input_line) - cur - 1, count)[1]
-    pos = len(input_line) - pos_inv - 1
+    pos = get_word_boundaries(input_line).backward(keyword_regexes['w'], cur,
+                                                   count, True)
     return cur, pos, True, False
 
 def motion_gE(input_line, cur, count):
@@ -580,12 +731,8 @@ def motion_gE(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    new_cur = len(input_line) - cur - 1
-    pos = get_pos(input_line[::-1], REGEX_MOTION_G_UPPERCASE_E, new_cur,
-                  True, count)
-    if pos == -1:
-        return cur, 0, False, False
-    pos = len(input_line) - (pos + new_cur + 1)
+    pos = get_word_boundaries(input_line).backward(
+        REGEX_MOTION_G_UPPERCASE_E, cur, count, True)
     return cur, pos, True, False
 
 def motion_h(input_line, cur, count):
@@ -611,6 +758,9 @@ def motion_carret(input_line, cur, count):
         `motion_base()`.
     """
     pos = get_pos(input_line, REGEX_MOTION_CARRET, 0)
+    if pos == -1:
+        # Like in Vim, stop on the last character of a blank line.
+        pos = max(0, len(input_line) - 1)
     return cur, pos, False, False
 
 def motion_dollar(input_line, cur, count):
@@ -622,18 +772,323 @@ def motion_dollar(input_line, cur, count):
     pos = len(input_line)
     return cur, pos, False, False
 
-def motion_iw(input_line, cur, count):
-    """Select `count` inner words, returning starting/ending positions.
+def select_text_object(keys, input_line, cur, count):
+    """Select `count` text objects `keys` (e.g. "aw", "i(") around the cursor.
+
+    Objects are found by scanning outwards from the cursor, so this only
+    depends on the distance to their boundaries rather than the length of the
+    input line (for blocks, only brackets are scanned, but all of those
+    before the cursor are when it isn't in a block). If there's no such
+    object, the motion fails.
 
     See Also:
         `motion_base()`.
     """
-    pos_inv = get_pos(input_line[::-1], keyword_regexes['iw'],
-                      len(input_line) - cur - 1, False, 1)
-    start_pos = cur - pos_inv
-    end_pos = start_pos + get_pos(input_line, keyword_regexes['iw'],
-                                  start_pos, False, count)
-    return start_pos, end_pos, True, False
+    if not input_line:
+        return cur, None, False, False
+    cur = min(cur, len(input_line) - 1)
+    inner = keys[0] == "i"
+    obj = keys[1]
+    count = max(count, 1)
+    if obj in "wW":
+        bounds = word_object_bounds(input_line, cur, count, inner, obj == "W")
+    elif obj in "\"'`":
+        bounds = quote_object_bounds(input_line, cur, count, inner, obj)
+    elif obj == "t":
+        bounds = tag_object_bounds(input_line, cur, count, inner)
+    else:
+        bounds = bracket_object_bounds(input_line, cur, count, inner,
+                                       TEXT_OBJECT_BRACKETS[obj])
+    if bounds is None:
+        return cur, None, False, False
+    if bounds[0] == bounds[1]:
+        return bounds[0], bounds[0], False, False
+    return bounds[0], bounds[1] - 1, True, False
+
+def word_object_bounds(input_line, cur, count, inner, big_word):
+    """Return the bounds of `count` words (WORDs if `big_word` is True)
+    around `cur`, for `select_text_object()`.
+
+    "iw" selects words and the white space between them. "aw" selects words
+    with the white space that follows them, or the white space before them if
+    there's none after the last word. Returns None if there aren't `count`
+    words, like Vim which then doesn't select anything.
+    """
+    length = len(input_line)
+    keyword = keyword_regexes['keyword']
+
+    def char_class(pos):
+        char = input_line[pos]
+        if char.isspace():
+            return 0
+        if big_word or keyword.match(char):
+            return 1
+        return 2
+
+    def run_end(pos):
+        cls = char_class(pos)
+        while pos < length and char_class(pos) == cls:
+            pos += 1
+        return pos
+
+    cls = char_class(cur)
+    start = cur
+    while start > 0 and char_class(start - 1) == cls:
+        start -= 1
+    end = run_end(cur)
+    if inner:
+        for _ in range(count - 1):
+            if end == length:
+                return None
+            end = run_end(end)
+        return start, end
+    # Each word comes with the white space before it if the selection is on
+    # white space, or with the white space after it otherwise.
+    for i in range(count):
+        if i and end == length:
+            return None
+        if char_class(end if i else cur) == 0:
+            if i:
+                end = run_end(end)
+            if end == length:
+                return None
+            end = run_end(end)
+        else:
+            if i:
+                end = run_end(end)
+            if end < length and char_class(end) == 0:
+                end = run_end(end)
+    # Without white space after the last word, take the one before the first
+    # word, unless it's indentation.
+    if cls and char_class(end - 1):
+        before = start
+        while before > 0 and char_class(before - 1) == 0:
+            before -= 1
+        if before:
+            start = before
+    return start, end
+
+def quote_object_bounds(input_line, cur, count, inner, quote):
+    """Return the bounds of the quoted string around `cur`, for
+    `select_text_object()`.
+
+    Strings are found like in Vim: a backslash escapes the character after
+    it, except before an opening quote. If the cursor is on a quote, strings
+    pair up from the start of the line to know whether it opens or closes one
+    (see `WordBoundaries.quoted_strings()`). Otherwise, the closest quote
+    before the cursor opens the string, or the first one after it if there's
+    none. "a" objects include the white space that follows the string, or the
+    white space before it if there's none. With a `count` of 2 or more, "i"
+    objects include the quotes, but no white space.
+    """
+    if input_line[cur] == quote:
+        starts, ends = get_word_boundaries(input_line).quoted_strings(quote)
+        index = bisect_right(starts, cur) - 1
+        if index < 0 or ends[index] < cur:
+            return None
+        start, end = starts[index], ends[index]
+    else:
+        start = input_line.rfind(quote, 0, cur)
+        while start != -1 and is_escaped(input_line, start):
+            start = input_line.rfind(quote, 0, start)
+        if start == -1:
+            start = input_line.find(quote)
+            if start == -1:
+                return None
+        end = find_closing_quote(input_line, start + 1, quote)
+        if end == -1:
+            return None
+    if inner:
+        if count < 2:
+            start += 1
+        else:
+            end += 1
+        return start, end
+    end += 1
+    if end < len(input_line) and input_line[end] in " \t":
+        while end < len(input_line) and input_line[end] in " \t":
+            end += 1
+    else:
+        while start > 0 and input_line[start - 1] in " \t":
+            start -= 1
+    return start, end
+
+def is_escaped(input_line, pos):
+    """Return True if the character at `pos` follows an odd number of
+    backslashes."""
+    backslashes = 0
+    while pos > backslashes and input_line[pos - backslashes - 1] == "\\":
+        backslashes += 1
+    return backslashes % 2 == 1
+
+def find_closing_quote(input_line, pos, quote):
+    """Return the position of the first `quote` from `pos` that isn't escaped
+    by a backslash (backslashes from `pos` on escape the character after
+    them), or -1."""
+    regex = re.compile(r"\\[\s\S]|" + re.escape(quote))
+    for match in regex.finditer(input_line, pos):
+        if match.group() == quote:
+            return match.start()
+    return -1
+
+def bracket_object_bounds(input_line, cur, count, inner, brackets):
+    """Return the bounds of the `count`'th block delimited by `brackets`
+    (e.g. "()") around `cur`, for `select_text_object()`.
+
+    Nested blocks are skipped. If the cursor isn't in a block, the `count`'th
+    next one is used instead, like in Vim. Brackets escaped by a backslash
+    are ignored, see `find_closing_bracket()` for the closing bracket.
+    """
+    opening, closing = brackets
+    # Like in Vim, a block starting at the cursor is around it.
+    pos = cur if input_line[cur] == opening else cur - 1
+    start = -1
+    depth = 0
+    remaining = count
+    for pos in bracket_positions(input_line, pos, brackets, True):
+        if input_line[pos] == closing:
+            depth += 1
+        elif depth:
+            depth -= 1
+        else:
+            remaining -= 1
+            if not remaining:
+                start = pos
+                break
+    if start < 0 and remaining < count:
+        return None
+    if start < 0:
+        # Each block starts at the next opening bracket that isn't preceded
+        # by an unmatched closing one.
+        start = cur
+        for _ in range(count):
+            depth = 0
+            for start in bracket_positions(input_line, start + 1, brackets):
+                if input_line[start] == closing:
+                    depth += 1
+                elif not depth:
+                    break
+                else:
+                    depth -= 1
+            else:
+                return None
+    end = find_closing_bracket(input_line, start, brackets)
+    if end == -1:
+        return None
+    if inner:
+        return start + 1, end
+    return start, end + 1
+
+def bracket_positions(input_line, pos, brackets, backward=False):
+    """Yield the positions of the `brackets` not escaped by a backslash, from
+    `pos` on (or going left from it, if `backward` is True).
+
+    Brackets are found with `str.find()`, so that the text between them costs
+    little to skip.
+    """
+    if backward:
+        found = [input_line.rfind(bracket, 0, pos + 1) for bracket in brackets]
+        while max(found) >= 0:
+            i = 0 if found[0] > found[1] else 1
+            pos = found[i]
+            if not is_escaped(input_line, pos):
+                yield pos
+            found[i] = input_line.rfind(brackets[i], 0, pos)
+    else:
+        length = len(input_line)
+        found = [input_line.find(bracket, pos) % (length + 1)
+                 for bracket in brackets]
+        while min(found) < length:
+            i = 0 if found[0] < found[1] else 1
+            pos = found[i]
+            if not is_escaped(input_line, pos):
+                yield pos
+            found[i] = input_line.find(brackets[i], pos + 1) % (length + 1)
+
+def find_closing_bracket(input_line, start, brackets):
+    """Return the position of the bracket closing the one at `start`, or -1.
+
+    This follows Vim's "%" matching: nested blocks are skipped, and so are
+    brackets escaped by a backslash, in double-quoted strings (if the line
+    has an even number of double quotes) and in character literals (e.g. '('
+    or '\\)').
+    """
+    opening, closing = brackets
+    length = len(input_line)
+    # Whether double quotes delimit strings is only looked up once one is
+    # found, so that this depends on the distance to the closing bracket.
+    smart_quotes = None
+    in_quotes = start_in_quotes = False
+    depth = 0
+    skip_to = 0
+    regex = re.compile("[\"'%s]" % re.escape(brackets))
+    for match in regex.finditer(input_line, start + 1):
+        pos = match.start()
+        char = match.group()
+        if pos < skip_to:
+            continue
+        if char == '"':
+            if smart_quotes is None:
+                smart_quotes = get_word_boundaries(input_line).even_quotes()
+                # A string can go on after a line ending with a backslash,
+                # brackets before the first double quote match then.
+                if not smart_quotes and input_line.endswith("\\"):
+                    smart_quotes = in_quotes = start_in_quotes = True
+            if smart_quotes and not is_escaped(input_line, pos):
+                in_quotes = not in_quotes
+                start_in_quotes = False
+        elif char == "'":
+            if (input_line[pos + 1:pos + 2] == "\\" and pos + 2 < length and
+                    input_line[pos + 3:pos + 4] == "'"):
+                skip_to = pos + 4
+            elif input_line[pos + 2:pos + 3] == "'":
+                skip_to = pos + 3
+        elif ((not in_quotes or start_in_quotes) and
+                not is_escaped(input_line, pos)):
+            if char == opening:
+                depth += 1
+            elif not depth:
+                return pos
+            else:
+                depth -= 1
+    return -1
+
+def tag_object_bounds(input_line, cur, count, inner):
+    """Return the bounds of the `count`'th tag block (e.g. "<b>...</b>")
+    around `cur`, for `select_text_object()`."""
+    regex = re.compile(REGEX_TAG)
+    pos = cur + 1
+    while True:
+        pos = input_line.rfind("<", 0, pos)
+        if pos == -1:
+            return None
+        opening = regex.match(input_line, pos)
+        # Skip closing and self-closing tags.
+        if not opening or opening.group(1) or opening.group(3):
+            continue
+        closing = find_closing_tag(input_line, opening, regex)
+        if closing and closing.end() > cur:
+            count -= 1
+            if not count:
+                break
+    if inner:
+        return opening.end(), closing.start()
+    return opening.start(), closing.end()
+
+def find_closing_tag(input_line, opening, regex):
+    """Return the match of the tag closing the `opening` tag match, if any,
+    with `regex` the compiled `REGEX_TAG`."""
+    depth = 0
+    for match in regex.finditer(input_line, opening.end()):
+        if match.group(2) != opening.group(2) or match.group(3):
+            continue
+        if not match.group(1):
+            depth += 1
+        elif depth:
+            depth -= 1
+        else:
+            return match
+    return None
 
 def motion_f(input_line, cur, count):
     """Go to `count`'th occurence of character and return position.
@@ -656,11 +1111,10 @@ def cb_motion_f(update_last=True):
         `start_catching_keys()`.
     """
     global last_search_motion
-    pattern = catching_keys_data['keys']
-    pos = get_pos(catching_keys_data['input_line'], re.escape(pattern),
-                  catching_keys_data['cur'], True,
-                  catching_keys_data['count'])
-    catching_keys_data['new_cur'] = max(0, pos) + catching_keys_data['cur']
+    pattern = state.catching_keys_data['keys']
+    state.catching_keys_data['new_cur'] = find_char(
+        "f", pattern, state.catching_keys_data['input_line'],
+        state.catching_keys_data['cur'], state.catching_keys_data['count'])
     if update_last:
         last_search_motion = {'motion': "f", 'data': pattern}
     cb_key_combo_default(None, None, "")
@@ -686,14 +1140,10 @@ def cb_motion_F(update_last=True):
         `start_catching_keys()`.
     """
     global last_search_motion
-    pattern = catching_keys_data['keys']
-    cur = len(catching_keys_data['input_line']) - catching_keys_data['cur']
-    pos = get_pos(catching_keys_data['input_line'][::-1],
-                  re.escape(pattern),
-                  cur,
-                  False,
-                  catching_keys_data['count'])
-    catching_keys_data['new_cur'] = catching_keys_data['cur'] - max(0, pos + 1)
+    pattern = state.catching_keys_data['keys']
+    state.catching_keys_data['new_cur'] = find_char(
+        "F", pattern, state.catching_keys_data['input_line'],
+        state.catching_keys_data['cur'], state.catching_keys_data['count'])
     if update_last:
         last_search_motion = {'motion': "F", 'data': pattern}
     cb_key_combo_default(None, None, "")
@@ -721,15 +1171,16 @@ def cb_motion_t(update_last=True):
         `start_catching_keys()`.
     """
     global last_search_motion
-    pattern = catching_keys_data['keys']
-    pos = get_pos(catching_keys_data['input_line'], re.escape(pattern),
-                  catching_keys_data['cur'] + 1,
-                  True, catching_keys_data['count'])
-    pos += 1
-    if pos > 0:
-        catching_keys_data['new_cur'] = pos + catching_keys_data['cur'] - 1
-    else:
-        catching_keys_data['new_cur'] = catching_keys_data['cur']
+    data = state.catching_keys_data
+    pattern = data['keys']
+    input_line = data['input_line']
+    cur, count = data['cur'], data['count']
+    new_cur = find_char("t", pattern, input_line, cur, count)
+    # When repeated with ; or , the motion doesn't get stuck next to the
+    # character, like in Vim.
+    if not update_last and new_cur == cur:
+        new_cur = find_char("t", pattern, input_line, cur, max(count, 1) + 1)
+    state.catching_keys_data['new_cur'] = new_cur
     if update_last:
         last_search_motion = {'motion': "t", 'data': pattern}
     cb_key_combo_default(None, None, "")
@@ -758,16 +1209,16 @@ def cb_motion_T(update_last=True):
         `start_catching_keys()`.
     """
     global last_search_motion
-    pattern = catching_keys_data['keys']
-    pos = get_pos(catching_keys_data['input_line'][::-1], re.escape(pattern),
-                  (len(catching_keys_data['input_line']) -
-                   (catching_keys_data['cur'] + 1)) + 1,
-                  True, catching_keys_data['count'])
-    pos += 1
-    if pos > 0:
-        catching_keys_data['new_cur'] = catching_keys_data['cur'] - pos + 1
-    else:
-        catching_keys_data['new_cur'] = catching_keys_data['cur']
+    data = state.catching_keys_data
+    pattern = data['keys']
+    input_line = data['input_line']
+    cur, count = data['cur'], data['count']
+    new_cur = find_char("T", pattern, input_line, cur, count)
+    # When repeated with ; or , the motion doesn't get stuck next to the
+    # character, like in Vim.
+    if not update_last and new_cur == cur:
+        new_cur = find_char("T", pattern, input_line, cur, max(count, 1) + 1)
+    state.catching_keys_data['new_cur'] = new_cur
     if update_last:
         last_search_motion = {'motion': "T", 'data': pattern}
     cb_key_combo_default(None, None, "")
@@ -782,7 +1233,9 @@ def key_cc(buf, input_line, cur, count):
     See Also:
         `key_base()`.
     """
-    weechat.command("", "/input delete_line")
+    store_register(input_line, True)
+    set_input(buf, "")
+    set_cur(buf, "", 0, False)
     set_mode("INSERT")
 
 def key_C(buf, input_line, cur, count):
@@ -791,46 +1244,168 @@ def key_C(buf, input_line, cur, count):
     See Also:
         `key_base()`.
     """
-    weechat.command("", "/input delete_end_of_line")
+    store_register(input_line[cur:], True)
+    set_input(buf, input_line[:cur])
+    set_cur(buf, input_line[:cur], cur)
     set_mode("INSERT")
 
+def key_dd(buf, input_line, cur, count):
+    """Delete line.
+
+    See Also:
+        `key_base()`.
+    """
+    store_register(input_line, True)
+    set_input(buf, "")
+    set_cur(buf, "", 0, False)
+
+def key_D(buf, input_line, cur, count):
+    """Delete from cursor to end of line.
+
+    See Also:
+        `key_base()`.
+    """
+    store_register(input_line[cur:], True)
+    set_input(buf, input_line[:cur])
+    set_cur(buf, input_line[:cur], cur)
+
+def key_x(buf, input_line, cur, count):
+    """Delete `count` characters under and after the cursor.
+
+    See Also:
+        `key_base()`.
+    """
+    end = cur + max(count, 1)
+    store_register(input_line[cur:end], True)
+    input_line = input_line[:cur] + input_line[end:]
+    set_input(buf, input_line)
+    set_cur(buf, input_line, cur)
+
+def key_X(buf, input_line, cur, count):
+    """Delete `count` characters before the cursor.
+
+    See Also:
+        `key_base()`.
+    """
+    start = max(0, cur - max(count, 1))
+    store_register(input_line[start:cur], True)
+    input_line = input_line[:start] + input_line[cur:]
+    set_input(buf, input_line)
+    set_cur(buf, input_line, start)
+
 def key_yy(buf, input_line, cur, count):
     """Yank line.
 
     See Also:
         `key_base()`.
     """
-    cmd = vimode_settings['copy_clipboard_cmd']
-    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
-    if sys.version_info > (3,):
-        proc.communicate(input=input_line.encode())
-    else:
-        proc.communicate(input=input_line)
+    store_register(input_line)
 
 def key_p(buf, input_line, cur, count):
-    """Paste text.
+    """Put text after the cursor `count` times.
 
     See Also:
         `key_base()`.
     """
-    cmd = vimode_settings['paste_clipboard_cmd']
-    weechat.hook_process(cmd, 10 * 1000, "cb_key_p", weechat.current_buffer())
+    put_register(buf, input_line, cur, count, True)
+
+def key_P(buf, input_line, cur, count):
+    """Put text before the cursor `count` times.
+
+    See Also:
+        `key_base()`.
+    """
+    put_register(buf, input_line, cur, count, False)
 
 def cb_key_p(data, command, return_code, output, err):
     """Callback for fetching clipboard text and pasting it."""
-    buf = ""
-    this_buffer = data
-    if output != "":
-        buf += output.strip()
     if return_code == 0:
-        my_input = weechat.buffer_get_string(this_buffer, "input")
-        pos = weechat.buffer_get_integer(this_buffer, "input_pos") + 1
-        my_input = my_input[:pos] + buf + my_input[pos:]
-        pos += len(buf)
-        weechat.buffer_set(this_buffer, "input", my_input)
-        weechat.buffer_set(this_buffer, "input_pos", str(pos))
+        this_buffer, after, count = data.split(" ")
+        my_input = get_input(this_buffer)
+        pos = get_cur(this_buffer)
+        put_text(this_buffer, my_input, pos, output.strip() * int(count),
+                 after == "1")
     return weechat.WEECHAT_RC_OK
 
+def key_quote(buf, input_line, cur, count):
+    """Use a register for the next yank, delete or put.
+
+    See Also:
+        `key_base()`.
+    """
+    start_catching_keys(1, "cb_key_quote", input_line, cur, count, buf)
+
+def cb_key_quote():
+    """Callback for `key_quote()`.
+
+    See Also:
+        `start_catching_keys()`.
+    """
+    name = state.catching_keys_data['keys']
+    if name == "*":
+        name = "+"
+    if name.lower() in REGISTER_NAMES or name == "_":
+        state.register_name = name
+    state.catching_keys_data = {'amount': 0}
+
+def key_q(buf, input_line, cur, count):
+    """Start recording a macro into a register, or stop recording.
+
+    See Also:
+        `key_base()`, `record_key()`.
+    """
+    global recording_register
+    if recording_register is None:
+        start_catching_keys(1, "cb_key_q", input_line, cur, count, buf)
+        return
+    # Don't record the q that stops the recording.
+    keys = recorded_keys[:-1]
+    name = recording_register.lower()
+    if recording_register.isupper() and name in macros:
+        keys = macros[name] + keys
+    text = "".join(keys)
+    state.registers[name] = truncate_register(text)
+    if state.registers[name] != text:
+        keys = re.findall(REGEX_KEY_COMBOS, state.registers[name])
+    macros[name] = keys
+    recording_register = None
+    update_bar_item("vi_buffer")
+
+def cb_key_q():
+    """Callback for `key_q()`.
+
+    See Also:
+        `start_catching_keys()`.
+    """
+    global recording_register, recorded_keys
+    name = state.catching_keys_data['keys']
+    if name.lower() in REGISTER_NAMES[:-1]:
+        recording_register = name
+        recorded_keys = []
+    state.catching_keys_data = {'amount': 0}
+
+def key_at(buf, input_line, cur, count):
+    """Play the macro in a register **[count]** times (@@ plays the last one).
+
+    See Also:
+        `key_base()`, `play_macro()`.
+    """
+    start_catching_keys(1, "cb_key_at", input_line, cur, count, buf)
+
+def cb_key_at():
+    """Callback for `key_at()`.
+
+    See Also:
+        `start_catching_keys()`.
+    """
+    name = state.catching_keys_data['keys']
+    count = state.catching_keys_data['count']
+    state.catching_keys_data = {'amount': 0}
+    if name == "@":
+        name = last_macro
+    if name is not None:
+        play_macro(name.lower(), count)
+
 def key_i(buf, input_line, cur, count):
     """Start Insert mode.
 
@@ -894,18 +1469,27 @@ def cb_key_r():
     See Also:
         `start_catching_keys()`.
     """
-    global catching_keys_data
-    input_line = list(catching_keys_data['input_line'])
-    count = max(catching_keys_data['count'], 1)
-    cur = catching_keys_data['cur']
+    data = state.catching_keys_data
+    replace = functools.partial(replace_chars, data['keys'])
+    record_change(replace, data['count'])
+    replace(data['buf'], data['input_line'], data['cur'], data['count'])
+    state.catching_keys_data = {'amount': 0}
+
+def replace_chars(char, buf, input_line, cur, count):
+    """Replace `count` characters under the cursor with `char`.
+
+    See Also:
+        `key_r()`.
+    """
+    input_line = list(input_line)
+    count = max(count, 1)
     if cur + count <= len(input_line):
         for _ in range(count):
-            input_line[cur] = catching_keys_data['keys']
+            input_line[cur] = char
             cur += 1
         input_line = "".join(input_line)
-        weechat.buffer_set(catching_keys_data['buf'], "input", input_line)
-        set_cur(catching_keys_data['buf'], input_line, cur - 1)
-    catching_keys_data = {'amount': 0}
+        set_input(buf, input_line)
+        set_cur(buf, input_line, cur - 1)
 
 def key_R(buf, input_line, cur, count):
     """Start Replace mode.
@@ -924,11 +1508,15 @@ def key_tilda(buf, input_line, cur, count):
     input_line = list(input_line)
     count = max(1, count)
     while count and cur < len(input_line):
-        input_line[cur] = input_line[cur].swapcase()
+        # Characters whose case is more than one character (e.g. "ß") are
+        # left alone, like in Vim.
+        swapped = input_line[cur].swapcase()
+        if len(swapped) == 1:
+            input_line[cur] = swapped
         count -= 1
         cur += 1
     input_line = "".join(input_line)
-    weechat.buffer_set(buf, "input", input_line)
+    set_input(buf, input_line)
     set_cur(buf, input_line, cur)
 
 def key_alt_j(buf, input_line, cur, count):
@@ -950,9 +1538,8 @@ def cb_key_alt_j():
     See Also:
         `start_catching_keys()`.
     """
-    global catching_keys_data
-    weechat.command("", "/buffer " + catching_keys_data['keys'])
-    catching_keys_data = {'amount': 0}
+    weechat.command("", "/buffer " + state.catching_keys_data['keys'])
+    state.catching_keys_data = {'amount': 0}
 
 def key_semicolon(buf, input_line, cur, count, swap=False):
     """Repeat last f, t, F, T `count` times.
@@ -964,14 +1551,13 @@ def key_semicolon(buf, input_line, cur, count, swap=False):
     See Also:
         `key_base()`.
     """
-    global catching_keys_data, vi_buffer
-    catching_keys_data = ({'amount': 0,
-                           'input_line': input_line,
-                           'cur': cur,
-                           'keys': last_search_motion['data'],
-                           'count': count,
-                           'new_cur': 0,
-                           'buf': buf})
+    state.catching_keys_data = ({'amount': 0,
+                                 'input_line': input_line,
+                                 'cur': cur,
+                                 'keys': last_search_motion['data'],
+                                 'count': count,
+                                 'new_cur': 0,
+                                 'buf': buf})
     if not last_search_motion['motion']:
         return
     # Swap the motion's case if called from key_comma.
@@ -980,7 +1566,7 @@ def key_semicolon(buf, input_line, cur, count, swap=False):
     else:
         motion = last_search_motion['motion']
     func = "cb_motion_%s" % motion
-    vi_buffer = motion
+    state.vi_buffer = motion
     globals()[func](False)
 
 def key_comma(buf, input_line, cur, count):
@@ -997,16 +1583,17 @@ def key_u(buf, input_line, cur, count):
     See Also:
         `key_base()`.
     """
-    buf = weechat.current_buffer()
-    if buf not in undo_history:
+    history = state.undo_history.get(buf)
+    if history is None:
         return
+    line = None
     for _ in range(max(count, 1)):
-        if undo_history_index[buf] > -len(undo_history[buf]):
-            undo_history_index[buf] -= 1
-            input_line = undo_history[buf][undo_history_index[buf]]
-            weechat.buffer_set(buf, "input", input_line)
-        else:
+        text = history.undo()
+        if text is None:
             break
+        line = text
+    if line is not None and line != input_line:
+        set_input(buf, line)
 
 def key_ctrl_r(buf, input_line, cur, count):
     """Redo change `count` times.
@@ -1014,15 +1601,45 @@ def key_ctrl_r(buf, input_line, cur, count):
     See Also:
         `key_base()`.
     """
-    if buf not in undo_history:
+    history = state.undo_history.get(buf)
+    if history is None:
         return
+    line = None
     for _ in range(max(count, 1)):
-        if undo_history_index[buf] < -1:
-            undo_history_index[buf] += 1
-            input_line = undo_history[buf][undo_history_index[buf]]
-            weechat.buffer_set(buf, "input", input_line)
-        else:
+        text = history.redo()
+        if text is None:
             break
+        line = text
+    if line is not None and line != input_line:
+        set_input(buf, line)
+
+def key_dot(buf, input_line, cur, count):
+    """Repeat the last change, with `count` replacing its count if given.
+
+    The change is replayed directly (see `record_change()`), along with the
+    text inserted if it ended in Insert mode.
+
+    See Also:
+        `key_base()`.
+    """
+    global replaying_change
+    if last_change is None:
+        return
+    if count:
+        last_change['count'] = count
+    action, count = last_change['action'], last_change['count']
+    replaying_change = True
+    try:
+        action(buf, input_line, cur, count)
+        if state.mode == "INSERT":
+            text = last_change['text'] or ""
+            input_line, cur = get_input(buf), get_cur(buf)
+            input_line = input_line[:cur] + text + input_line[cur:]
+            set_input(buf, input_line)
+            set_cur(buf, input_line, cur + len(text), False)
+            set_mode("NORMAL")
+    finally:
+        replaying_change = False
 
 
 # Vi key bindings.
@@ -1032,10 +1649,10 @@ def key_ctrl_r(buf, input_line, cur, count):
 # For functions, see `key_base()` for reference.
 VI_DEFAULT_KEYS = {'G': key_G,
                    'gg': "/window scroll_top",
-                   'x': "/input delete_next_char",
-                   'X': "/input delete_previous_char",
-                   'dd': "/input delete_line",
-                   'D': "/input delete_end_of_line",
+                   'x': key_x,
+                   'X': key_X,
+                   'dd': key_dd,
+                   'D': key_D,
                    'cc': key_cc,
                    'S': key_cc,
                    'C': key_C,
@@ -1045,6 +1662,10 @@ VI_DEFAULT_KEYS = {'G': key_G,
                    'I': key_I,
                    'yy': key_yy,
                    'p': key_p,
+                   'P': key_P,
+                   '"': key_quote,
+                   'q': key_q,
+                   '@': key_at,
                    'gt': "/buffer -1",
                    'K': "/buffer -1",
                    'H': "/buffer -1",
@@ -1054,6 +1675,7 @@ VI_DEFAULT_KEYS = {'G': key_G,
                    'r': key_r,
                    'R': key_R,
                    '~': key_tilda,
+                   '.': key_dot,
                    'nt': "/bar scroll nicklist * -100%",
                    'nT': "/bar scroll nicklist * +100%",
                    '\x01[[A': "/input history_previous",
@@ -1103,14 +1725,40 @@ VI_DEFAULT_KEYS = {'G': key_G,
                    'u': key_u,
                    '\x01R': key_ctrl_r}
 
-# Add alt-j<number> bindings.
-for i in range(10, 99):
-    VI_DEFAULT_KEYS['\x01[j%s' % i] = "/buffer %s" % i
-
 # VI_DEFAULT_KEYS are kept in a separate data structure to ensure
 # that they can not be permenantly deleted by the `:nunmap` command.
 VI_KEYS = VI_DEFAULT_KEYS.copy()
 
+# Keys that take us from Normal mode to Insert mode. Used to predict the mode
+# a user mapping will be in at each step when compiling it (see
+# `UMParser.compile()`).
+INSERT_MODE_KEYS = (key_cc, key_C, key_i, key_a, key_A, key_I)
+# Keys that change the input line, repeated by . (see `record_change()`).
+CHANGE_KEYS = INSERT_MODE_KEYS + (key_x, key_X, key_dd, key_D, key_tilda,
+                                  key_p, key_P)
+
+# A compiled step of a user mapping (see `UMParser.compile()`):
+#     index (int): where parsing of the step started in the mapping's rhs.
+#     insert (bool): whether the step was parsed for Insert mode, or None if
+#         the mode doesn't matter.
+#     count (int): count to add before calling the action.
+#     action (callable): action(buf, input_line, cur, count), or None if
+#         there is only `bad_sequence` left to report.
+#     leave_insert (bool): whether to go to Normal mode before the action
+#         (Insert mode sequence ending with <Esc> or <CR>).
+#     bad_sequence (str): unparsable keys found before the action.
+MappingStep = namedtuple("MappingStep", ["index", "insert", "count", "action",
+                                         "leave_insert", "bad_sequence"])
+
+# Incremented every time `VI_KEYS` or `VI_COMMANDS` change, so that compiled
+# user mappings know when they are out of date.
+key_tables_version = 0
+
+def key_tables_changed():
+    """Invalidate compiled user mappings."""
+    global key_tables_version
+    key_tables_version += 1
+
 class UMParser:
     """User Mapping Parser
 
@@ -1126,91 +1774,120 @@ class UMParser:
     def noremap(self):
         """Required Attribute"""
 
-    def parse(self, vi_keys):
-        """Vi_Keys parser that generates callable actions.
+    def compile(self, vi_keys, index=0, insert=False):
+        """Vi_Keys compiler that generates a list of steps.
+
+        Parsing depends on the mode the mapping is in when reaching each
+        action, so we predict it from the actions themselves (e.g. "i" enters
+        Insert mode) starting from `insert`. The caller is expected to compile
+        the rest of the mapping again if the actual mode turns out to differ.
 
-        Yields:
-            Callable object: action(buf, input_line, cur, count)
+        Args:
+            vi_keys (str): the mapping's rhs.
+            index (int, optional): where to start parsing. Defaults to 0.
+            insert (bool, optional): whether we're in Insert mode at `index`.
+                Defaults to False.
+
+        Returns:
+            list: `MappingStep` tuples.
         """
         old_style_cmd_conditions = [
-            vi_keys[0] == '/',
+            index == 0,
+            vi_keys[:1] == '/',
             re.search('<cr>', vi_keys.lower()) is None,
         ]
 
         # >>> OLD-STYLE USER MAPPING
         if all(old_style_cmd_conditions):
-            yield functools.partial(do_command, vi_keys)
+            action = functools.partial(do_command, vi_keys)
+            return [MappingStep(0, None, 0, action, False, "")]
         # >>> NEW-STYLE USER MAPPING
-        else:
-            for action in self.new_style(vi_keys):
-                yield action
+        return self.new_style(vi_keys, index, insert)
 
-    def new_style(self, vi_keys):
-        """Parse New-Style User Mapping
+    def new_style(self, vi_keys, index, insert):
+        """Compile New-Style User Mapping
 
-        Yields:
-            Callable object: action(buf, input_line, cur, count)
+        Returns:
+            list: `MappingStep` tuples.
         """
-        index = 0
+        steps = []
+        start = index
+        count = 0
+        bad_sequence = ""
         while index < len(vi_keys):
             # >>> COUNT
             match = re.match('^[1-9][0-9]*', vi_keys[index:])
             if match:
-                end = match.end() + index
-                self.count += int(vi_keys[index:end])
+                count += int(match.group())
                 index += match.end()
 
             # >>> ACTION SPECIFIER
-            action, i = self.action_spec(vi_keys[index:])
-            index += i
+            action, i, leave_insert = self.action_spec(vi_keys[index:], insert)
             if action is None:
+                bad_sequence += vi_keys[index:index + i]
+                index += i
                 continue
-            else:
-                yield action
+            index += i
+            steps.append(MappingStep(start, insert, count, action,
+                                     leave_insert, bad_sequence))
+            if leave_insert:
+                insert = False
+            elif not insert:
+                insert = self.enters_insert(action)
+            start = index
+            count = 0
+            bad_sequence = ""
+        if bad_sequence:
+            steps.append(MappingStep(start, insert, count, None, False,
+                                     bad_sequence))
+        return steps
 
-    def action_spec(self, vi_keys):
+    def action_spec(self, vi_keys, insert):
         """Parse Action Specifier
 
         Returns:
-            2-tuple: (Callable_Action, Index_Where_Parsing_Stoped)
+            3-tuple: (Callable_Action, Index_Where_Parsing_Stoped,
+                      Leaves_Insert_Mode)
         """
         # >>> INSERT MODE SEQUENCE
-        if mode == 'INSERT':
+        if insert:
             match = re.search('<(cr|esc)>', vi_keys.lower())
             enter = False
 
             if match:
-                set_mode('NORMAL')
                 index = match.end()
                 if match.group() == '<cr>':
                     enter = True
             else:
-                index = start = len(vi_keys)
+                index = len(vi_keys)
 
             start = match.start() if match else len(vi_keys)
-            return self.imode_capture(vi_keys[:start], enter=enter), index
+            return (self.imode_capture(vi_keys[:start], enter=enter), index,
+                    match is not None)
 
         # >>> VI_KEY
         key_map = VI_DEFAULT_KEYS if self.noremap else VI_KEYS
         for keys, command in key_map.items():
             if vi_keys.startswith(keys):
                 if isinstance(command, str):
-                    return functools.partial(do_command, command), len(keys)
+                    action = functools.partial(do_command, command)
+                    return action, len(keys), False
                 else:
-                    return command, len(keys)
+                    return command, len(keys), False
 
         # >>> VI_MOTION
         for motion in VI_MOTIONS:
             if vi_keys.startswith(motion):
-                return functools.partial(do_motion, motion), len(motion)
+                action = functools.partial(do_motion, motion)
+                return action, len(motion), False
 
         # >>> VI_OPERATOR
         if len(vi_keys) > 1 and vi_keys[0] in VI_OPERATORS:
-            for motion in VI_MOTIONS:
+            for motion in VI_MOTIONS + VI_TEXT_OBJECTS:
                 if vi_keys[1:].startswith(motion):
                     action = functools.partial(do_operator,
                                                vi_keys[:len(motion) + 1])
-                    return action, len(motion) + 1
+                    return action, len(motion) + 1, False
 
         # >>> WEECHAT COMMAND
         match = re.search('^[:/](.*?)<(CR|cr)>', vi_keys)
@@ -1234,15 +1911,20 @@ class UMParser:
             else:
                 action = functools.partial(do_command,
                                            '/{}'.format(vi_keys[1:end - 4]))
-            return action, end
+            return action, end, False
 
         # >>> PARSING ERROR
         if vi_keys[0] in (':', '/'):
-            self.bad_sequence += vi_keys
-            return None, len(vi_keys)
+            return None, len(vi_keys), False
         else:
-            self.bad_sequence += vi_keys[0]
-            return None, 1
+            return None, 1, False
+
+    @staticmethod
+    def enters_insert(action):
+        """Predict whether `action` takes us from Normal to Insert mode."""
+        if isinstance(action, functools.partial):
+            return action.func is do_operator and action.args[0][0] == 'c'
+        return action in INSERT_MODE_KEYS
 
     def vi_cmd_action(self, cmd, args):
         """Factory for VI_COMMAND Action"""
@@ -1259,17 +1941,16 @@ class UMParser:
         def action(buf, input_line, cur, count):
             for _ in range(max(int(count), 1)):
                 p = int(cur)
-                final_input = '{}{}{}'.format(input_line[:p],
-                                              new_input,
-                                              input_line[p:])
-                weechat.buffer_set(buf, "input", final_input)
-                new_pos = str(len(new_input) + p)
-                weechat.buffer_set(buf, "input_pos", new_pos)
-
-                input_line = weechat.buffer_get_string(buf, "input")
-                cur = weechat.buffer_get_integer(buf, "input_pos")
+                input_line = '{}{}{}'.format(input_line[:p],
+                                             new_input,
+                                             input_line[p:])
+                cur = len(new_input) + p
+                set_input(buf, input_line)
+                set_cur(buf, input_line, cur, False)
                 if enter:
                     do_command('/input return', buf, input_line, cur, 0)
+                    input_line = get_input(buf)
+                    cur = get_cur(buf)
         return action
 
 class UserMapping(UMParser):
@@ -1282,6 +1963,12 @@ class UserMapping(UMParser):
         self.lhs = lhs
         self.rhs = rhs
         self.noremap = noremap
+        self.has_count_tag = re.search(r'#{\d+}', rhs) is not None
+        self.default_rhs = re.sub(r'#{(\d+)}', r'\1', rhs)
+        # Compiled steps, by rhs (count tags make the rhs depend on the
+        # count). See `program()`.
+        self.programs = {}
+        self.programs_version = None
 
     def __call__(self, buf, input_line, cur, count):
         if self.locked:
@@ -1290,35 +1977,74 @@ class UserMapping(UMParser):
             print_warning(error_fmt.format(self.lhs, self.rhs))
             return
 
+        global insert_start
+        self.run(buf, input_line, cur, count)
+        # If the mapping changed the input line, it's what . repeats, along
+        # with the text typed if it left us in Insert mode.
+        buf = weechat.current_buffer()
+        if state.mode == 'INSERT' or get_input(buf) != input_line:
+            record_change(self, count)
+            if state.mode == 'INSERT' and not replaying_change:
+                insert_start = (get_input(buf), change_tick)
+
+    def run(self, buf, input_line, cur, count):
+        """Run the mapping's compiled steps."""
         rhs, count = self.process_count(count)
-        self.bad_sequence = ""
         with self.lock():
             for _ in range(count):
                 bad_seq_list = []
-                for action in self.parse(rhs):
-                    if self.bad_sequence:
-                        bad_seq_list.append(self.bad_sequence)
-
-                    action(buf, input_line, cur, self.count)
+                steps = self.program(rhs)
+                i = 0
+                while i < len(steps):
+                    step = steps[i]
+                    i += 1
+                    # The mode differs from the one we predicted (e.g. a
+                    # nested mapping entered Insert mode), so the rest of the
+                    # mapping needs to be parsed differently.
+                    insert = state.mode == 'INSERT'
+                    if step.insert is not None and step.insert != insert:
+                        steps = self.compile(rhs, step.index, insert)
+                        i = 0
+                        continue
+
+                    self.count += step.count
+                    if step.bad_sequence:
+                        bad_seq_list.append(step.bad_sequence)
+                    if step.action is None:
+                        continue
+                    if step.leave_insert:
+                        set_mode('NORMAL')
+
+                    step.action(buf, input_line, cur, self.count)
 
                     # Reset count unless last key triggers
                     # INSERT mode ('i', 'a', 'I', 'A', ...).
-                    if mode != 'INSERT':
+                    if state.mode != 'INSERT':
                         self.count = 0
 
-                    self.bad_sequence = ""
-
                     buf = weechat.current_buffer()
-                    input_line = weechat.buffer_get_string(buf, "input")
-                    cur = weechat.buffer_get_integer(buf, "input_pos")
+                    input_line = get_input(buf)
+                    cur = get_cur(buf)
 
                 self.count = 0
-                if self.bad_sequence:
-                    bad_seq_list.append(self.bad_sequence)
-                    self.bad_sequence = ""
-
                 self.report_errors(bad_seq_list)
 
+    def program(self, rhs=None):
+        """Return the compiled steps for `rhs` (defaults to the mapping's).
+
+        Steps are compiled once and reused until `VI_KEYS` or `VI_COMMANDS`
+        change.
+        """
+        if rhs is None:
+            rhs = self.process_count(0)[0]
+        if (self.programs_version != key_tables_version or
+                len(self.programs) >= 32):
+            self.programs = {}
+            self.programs_version = key_tables_version
+        if rhs not in self.programs:
+            self.programs[rhs] = self.compile(rhs)
+        return self.programs[rhs]
+
     @contextmanager
     def lock(self):
         """ Access Lock
@@ -1338,11 +2064,11 @@ class UserMapping(UMParser):
         If a count tag is found, consume the count by substituting it in place
         of the tag.
         """
-        if re.search(r'#{\d+}', self.rhs) is not None:
+        if self.has_count_tag:
             if count:
                 rhs = re.sub(r'#{\d+}', str(count), self.rhs)
             else:
-                rhs = re.sub(r'#{(\d+)}', r'\1', self.rhs)
+                rhs = self.default_rhs
             new_count = 1
         else:
             rhs = self.rhs
@@ -1358,6 +2084,107 @@ class UserMapping(UMParser):
             print_warning(error_msg)
 
 
+# Key index.
+# ==========
+
+class KeyTrie(object):
+    """Prefix tree over key sequences.
+
+    Each node is a dict mapping the next character to a child node. Nodes that
+    end a known key sequence also hold its value under the `None` key.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, keys, value):
+        """Add (or replace) the `keys` sequence with the given value."""
+        node = self.root
+        for char in keys:
+            node = node.setdefault(char, {})
+        node[None] = value
+
+    def remove(self, keys):
+        """Remove the `keys` sequence, pruning nodes that become empty."""
+        path = [self.root]
+        for char in keys:
+            node = path[-1].get(char)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].pop(None, None)
+        for char in reversed(keys):
+            node = path.pop()
+            if node:
+                break
+            del path[-1][char]
+
+    def clear(self):
+        """Remove all key sequences."""
+        self.root = {}
+
+    def find(self, keys):
+        """Return the node for `keys`, or None if it isn't a known prefix."""
+        node = self.root
+        for char in keys:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    def get(self, keys, default=None):
+        """Return the value of the `keys` sequence if it's a full match."""
+        node = self.find(keys)
+        if node is None:
+            return default
+        return node.get(None, default)
+
+# Index of everything that can be typed in Normal mode: the value of each key
+# sequence is "key" (`VI_KEYS`), "motion" (`VI_MOTIONS`) or "operator" (an
+# operator followed by a motion, e.g. "dw"), in that order of precedence.
+# Used by `get_keys_and_count()` and `cb_key_combo_default()` so we don't
+# have to scan all of the above on every key press.
+key_index = KeyTrie()
+# Index of `VI_MOTIONS` and `VI_TEXT_OBJECTS` alone, for operators with a
+# count before the motion (e.g. "d2w").
+motion_index = KeyTrie()
+
+def key_kind(keys):
+    """Return what `keys` is bound to ("key", "motion", "operator" or None)."""
+    if keys in VI_KEYS:
+        return "key"
+    if keys in VI_MOTIONS:
+        return "motion"
+    if (len(keys) > 1 and keys[0] in VI_OPERATORS and
+            (keys[1:] in VI_MOTIONS or keys[1:] in VI_TEXT_OBJECTS)):
+        return "operator"
+    return None
+
+def update_key_index(keys):
+    """Update the entry for `keys` in `key_index` after `VI_KEYS` changed."""
+    kind = key_kind(keys)
+    if kind is None:
+        key_index.remove(keys)
+    else:
+        key_index.add(keys, kind)
+    key_tables_changed()
+
+def build_key_index():
+    """Rebuild `key_index` and `motion_index` from scratch."""
+    key_index.clear()
+    motion_index.clear()
+    for motion in VI_MOTIONS + VI_TEXT_OBJECTS:
+        motion_index.add(motion, "motion")
+        if motion in VI_MOTIONS:
+            update_key_index(motion)
+        for operator in VI_OPERATORS:
+            update_key_index(operator + motion)
+    for keys in VI_KEYS:
+        update_key_index(keys)
+
+build_key_index()
+
+
 # Key handling.
 # =============
 
@@ -1366,32 +2193,66 @@ def cb_key_pressed(data, signal, signal_data):
 
     Alt and Esc are detected as the same key in most terminals. The difference
     is that Alt signal is sent just before the other pressed key's signal.
-    We therefore use a timeout (50ms) to detect whether Alt or Esc was pressed.
-    """
-    global last_signal_time
-    last_signal_time = time.time()
-    if signal_data == "\x01[":
-        # In 50ms, check if any other keys were pressed. If not, it's Esc!
-        weechat.hook_timer(50, 0, 1, "cb_check_esc",
-                           "{:f}".format(last_signal_time))
+    We therefore use a timeout (see `get_esc_timeout()`) to detect whether Alt
+    or Esc was pressed. Only one timer is pending at a time: any key press
+    cancels it.
+    """
+    global key_sequence, esc_timer, last_key_time, last_key_was_esc
+    key_sequence += 1
+    now = monotonic()
+    if last_key_was_esc:
+        gap = now - last_key_time
+        if gap * 1000 < int(vimode_settings['esc_timeout']):
+            alt_key_gaps.append(gap)
+    last_key_time = now
+    last_key_was_esc = signal_data == "\x01["
+    if esc_timer:
+        weechat.unhook(esc_timer)
+        esc_timer = None
+    if last_key_was_esc:
+        # Unless another key is pressed before the timeout, it's Esc!
+        esc_timer = weechat.hook_timer(get_esc_timeout(), 0, 1,
+                                       "cb_check_esc", str(key_sequence))
     return weechat.WEECHAT_RC_OK
 
+def get_esc_timeout():
+    """Return how long to wait (in ms) for a key after Esc.
+
+    If `esc_timeout_adaptive` is on, this is twice the longest gap recently
+    seen between the two parts of Alt+key sequences (plus a small margin), but
+    never more than `esc_timeout`.
+    """
+    timeout = int(vimode_settings['esc_timeout'])
+    if (len(alt_key_gaps) >= 5 and weechat.config_string_to_boolean(
+            vimode_settings['esc_timeout_adaptive'])):
+        timeout = min(timeout, int(max(alt_key_gaps) * 2000) + 5)
+    return max(timeout, 1)
+
 def cb_check_esc(data, remaining_calls):
     """Check if the Esc key was pressed and change the mode accordingly."""
-    global esc_pressed, vi_buffer, catching_keys_data
-    # Not perfect, would be better to use direct comparison (==) but that only
-    # works for py2 and not for py3.
-    if abs(last_signal_time - float(data)) <= 0.000001:
+    global esc_pressed, esc_timer
+    esc_timer = None
+    # No other key was pressed since Esc.
+    if int(data) == key_sequence:
         esc_pressed += 1
-        if mode == "SEARCH" or mode == "COMMAND":
-            weechat.command("", "/input search_stop_here")
-        set_mode("NORMAL")
-        # Cancel any current partial commands.
-        vi_buffer = ""
-        catching_keys_data = {'amount': 0}
-        weechat.bar_item_update("vi_buffer")
+        # Esc aborts the macro being played.
+        if macro_replay:
+            stop_macro()
+        record_key("\x01[")
+        with edit_transaction():
+            press_esc()
     return weechat.WEECHAT_RC_OK
 
+def press_esc():
+    """Go back to Normal mode and cancel any current partial commands."""
+    if state.mode == "SEARCH" or state.mode == "COMMAND":
+        weechat.command("", "/input search_stop_here")
+    set_mode("NORMAL")
+    state.vi_buffer = ""
+    state.catching_keys_data = {'amount': 0}
+    state.register_name = None
+    update_bar_item("vi_buffer")
+
 def cb_key_combo_default(data, signal, signal_data):
     """Eat and handle key events when in Normal mode, if needed.
 
@@ -1399,9 +2260,17 @@ def cb_key_combo_default(data, signal, signal_data):
     example, alt-k will send the "\x01[k" signal.
 
     Esc is handled a bit differently to avoid delays, see `cb_key_pressed()`.
+
+    Changes to the input line are sent to WeeChat once, when the key combo has
+    been handled (see `edit_transaction()`).
     """
-    global esc_pressed, vi_buffer, cmd_compl_text, cmd_text_orig, \
-        cmd_compl_pos, cmd_history_index
+    with edit_transaction():
+        return handle_key_combo(data, signal, signal_data)
+
+def handle_key_combo(data, signal, signal_data):
+    """Handle a key combo for `cb_key_combo_default()`."""
+    global esc_pressed, cmd_compl_text, cmd_text_orig, cmd_compl_pos, \
+        cmd_compl_list, history_matches
 
     # If Esc was pressed, strip the Esc part from the pressed keys.
     # Example: user presses Esc followed by i. This is detected as "\x01[i",
@@ -1426,8 +2295,10 @@ def cb_key_combo_default(data, signal, signal_data):
         keys = keys.split("\x01[")[-1]  # Remove the "Esc" part(s).
     # Ctrl-Space.
     elif keys == "\x01@":
+        record_key("\x01[")
         set_mode("NORMAL")
         return weechat.WEECHAT_RC_OK_EAT
+    record_key(keys)
 
     # Clear the undo history for this buffer on <Return>.
     if keys == "\x01M":
@@ -1435,40 +2306,41 @@ def cb_key_combo_default(data, signal, signal_data):
         clear_undo_history(buf)
 
     # Detect imap_esc presses if any.
-    if mode == "INSERT":
+    if state.mode == "INSERT":
         imap_esc = vimode_settings['imap_esc']
         if not imap_esc:
             return weechat.WEECHAT_RC_OK
-        if (imap_esc.startswith(vi_buffer) and
-                imap_esc[len(vi_buffer):len(vi_buffer) + 1] == keys):
-            vi_buffer += keys
-            weechat.bar_item_update("vi_buffer")
+        typed = len(state.vi_buffer)
+        if (imap_esc.startswith(state.vi_buffer) and
+                imap_esc[typed:typed + 1] == keys):
+            state.vi_buffer += keys
+            update_bar_item("vi_buffer")
             weechat.hook_timer(int(vimode_settings['imap_esc_timeout']), 0, 1,
-                               "cb_check_imap_esc", vi_buffer)
-        elif (vi_buffer and imap_esc.startswith(vi_buffer) and
-              imap_esc[len(vi_buffer):len(vi_buffer) + 1] != keys):
-            vi_buffer = ""
-            weechat.bar_item_update("vi_buffer")
+                               "cb_check_imap_esc", state.vi_buffer)
+        elif (state.vi_buffer and imap_esc.startswith(state.vi_buffer) and
+              imap_esc[len(state.vi_buffer):len(state.vi_buffer) + 1] != keys):
+            state.vi_buffer = ""
+            update_bar_item("vi_buffer")
         # imap_esc sequence detected -- remove the sequence keys from the
         # Weechat input bar and enter Normal mode.
-        if imap_esc == vi_buffer:
+        if imap_esc == state.vi_buffer:
             buf = weechat.current_buffer()
-            input_line = weechat.buffer_get_string(buf, "input")
-            cur = weechat.buffer_get_integer(buf, "input_pos")
+            input_line = get_input(buf)
+            cur = get_cur(buf)
             input_line = (input_line[:cur - len(imap_esc) + 1] +
                           input_line[cur:])
-            weechat.buffer_set(buf, "input", input_line)
+            set_input(buf, input_line)
             set_cur(buf, input_line, cur - len(imap_esc) + 1, False)
             set_mode("NORMAL")
-            vi_buffer = ""
-            weechat.bar_item_update("vi_buffer")
+            state.vi_buffer = ""
+            update_bar_item("vi_buffer")
             return weechat.WEECHAT_RC_OK_EAT
         return weechat.WEECHAT_RC_OK
 
     # We're in Replace mode — allow "normal" key presses (e.g. "a") and
     # overwrite the next character with them, but let the other key presses
     # pass normally (e.g. backspace, arrow keys, etc).
-    if mode == "REPLACE":
+    if state.mode == "REPLACE":
         if len(keys) == 1:
             weechat.command("", "/input delete_next_char")
         elif keys == "\x01?":
@@ -1477,56 +2349,38 @@ def cb_key_combo_default(data, signal, signal_data):
         return weechat.WEECHAT_RC_OK
 
     # We're in command-line mode.
-    if mode == "COMMAND":
+    if state.mode == "COMMAND":
         buf = weechat.current_buffer()
         cmd_text = weechat.buffer_get_string(buf, "input")
-        weechat.hook_timer(1, 0, 1, "cb_check_cmd_mode", "")
         # Return key.
         if keys == "\x01M":
-            weechat.hook_timer(1, 0, 1, "cb_exec_cmd", cmd_text)
-            if len(cmd_text) > 1 and (not cmd_history or
-                                      cmd_history[-1] != cmd_text):
-                cmd_history.append(cmd_text)
-            cmd_history_index = 0
+            add_history(cmd_history, cmd_text[1:])
+            history_matches = None
             set_mode("NORMAL")
             buf = weechat.current_buffer()
             input_line = input_line_backup[buf]['input_line']
             weechat.buffer_set(buf, "input", input_line)
             set_cur(buf, input_line, input_line_backup[buf]['cur'], False)
-        # Up arrow.
-        elif keys == "\x01[[A":
-            if cmd_history_index > -len(cmd_history):
-                cmd_history_index -= 1
-                cmd_text = cmd_history[cmd_history_index]
-            weechat.buffer_set(buf, "input", cmd_text)
-            set_cur(buf, cmd_text, len(cmd_text), False)
-        # Down arrow.
-        elif keys == "\x01[[B":
-            if cmd_history_index < -1:
-                cmd_history_index += 1
-                cmd_text = cmd_history[cmd_history_index]
-            else:
-                cmd_history_index = 0
-                cmd_text = ":"
+            run_cmd(cmd_text)
+        # Up/Down arrows.
+        elif keys in ["\x01[[A", "\x01[[B"]:
+            cmd_text = ":" + recall_history(cmd_history, cmd_text[1:],
+                                            keys == "\x01[[A")
             weechat.buffer_set(buf, "input", cmd_text)
             set_cur(buf, cmd_text, len(cmd_text), False)
         # Tab key. No completion when searching ("/").
         elif keys == "\x01I" and cmd_text[0] == ":":
             if cmd_text_orig is None:
-                input_ = list(cmd_text)
-                del input_[0]
-                cmd_text_orig = "".join(input_)
-            cmd_compl_list = []
-            for cmd in VI_COMMANDS.keys():
-                if cmd.startswith(cmd_text_orig):
-                    cmd_compl_list.append(cmd)
+                cmd_text_orig = cmd_text[1:]
+                cmd_compl_list = get_cmd_completions(cmd_text_orig)
             if cmd_compl_list:
                 curr_suggestion = cmd_compl_list[cmd_compl_pos]
                 cmd_text = ":%s" % curr_suggestion
-                cmd_compl_list[cmd_compl_pos] = weechat.string_eval_expression(
-                    "${color:bold}%s${color:-bold}" % curr_suggestion,
-                    {}, {}, {})
-                cmd_compl_text = ", ".join(cmd_compl_list)
+                cmd_compl_text = ", ".join(
+                    cmd_compl_list[:cmd_compl_pos] +
+                    [weechat.color("bold") + curr_suggestion +
+                     weechat.color("-bold")] +
+                    cmd_compl_list[cmd_compl_pos + 1:])
                 cmd_compl_pos = (cmd_compl_pos + 1) % len(cmd_compl_list)
                 weechat.buffer_set(buf, "input", cmd_text)
                 set_cur(buf, cmd_text, len(cmd_text), False)
@@ -1535,14 +2389,15 @@ def cb_key_combo_default(data, signal, signal_data):
             cmd_compl_text = ""
             cmd_text_orig = None
             cmd_compl_pos = 0
-        weechat.bar_item_update("cmd_completion")
+            history_matches = None
+        update_bar_item("cmd_completion")
         if keys in ["\x01M", "\x01[[A", "\x01[[B"]:
             cmd_compl_text = ""
             return weechat.WEECHAT_RC_OK_EAT
         else:
             return weechat.WEECHAT_RC_OK
-    # Enter command mode.
-    elif keys in [":", "/"]:
+    # Enter command mode, unless the key is caught (e.g. "f/").
+    elif keys in [":", "/"] and not state.catching_keys_data['amount']:
         if keys == "/":
             weechat.command("", "/input search_text_here")
             if not weechat.config_string_to_boolean(
@@ -1560,12 +2415,13 @@ def cb_key_combo_default(data, signal, signal_data):
         cmd_compl_text = ""
         cmd_text_orig = None
         cmd_compl_pos = 0
+        history_matches = None
         return weechat.WEECHAT_RC_OK_EAT
 
     # Add key to the buffer.
-    vi_buffer += keys
-    weechat.bar_item_update("vi_buffer")
-    if not vi_buffer:
+    state.vi_buffer += keys
+    update_bar_item("vi_buffer")
+    if not state.vi_buffer:
         return weechat.WEECHAT_RC_OK
 
     # Check if the keys have a (partial or full) match. If so, also get the
@@ -1573,89 +2429,109 @@ def cb_key_combo_default(data, signal, signal_data):
     # After that, `vi_buffer` is only used for display purposes — only
     # `vi_keys` is checked for all the handling.
     # If no matches are found, the keys buffer is cleared.
-    matched, vi_keys, count = get_keys_and_count(vi_buffer)
-    if not matched and not catching_keys_data['amount']:
-        vi_buffer = ""
+    matched, vi_keys, count = get_keys_and_count(state.vi_buffer)
+    if not matched and not state.catching_keys_data['amount']:
+        state.vi_buffer = ""
         return weechat.WEECHAT_RC_OK_EAT
     # Check if it's a command (user defined key mapped to a :cmd).
     if vi_keys.startswith(":"):
         weechat.hook_timer(1, 0, 1, "cb_exec_cmd", "{} {}".format(vi_keys,
                                                                   count))
-        vi_buffer = ""
+        state.vi_buffer = ""
         return weechat.WEECHAT_RC_OK_EAT
     # It's a WeeChat command (user defined key mapped to a /cmd).
     if vi_keys.startswith("/"):
         weechat.command("", vi_keys)
-        vi_buffer = ""
+        state.vi_buffer = ""
         return weechat.WEECHAT_RC_OK_EAT
 
     buf = weechat.current_buffer()
-    input_line = weechat.buffer_get_string(buf, "input")
-    cur = weechat.buffer_get_integer(buf, "input_pos")
+    input_line = get_input(buf)
+    cur = get_cur(buf)
 
     # Check if we should catch keys, but don't do anything yet (in case the
     # user remapped this combo, and we shouldn't be calling the callback).
     catching_keys = False
-    if catching_keys_data['amount']:
+    if state.catching_keys_data['amount']:
         catching_keys = True
-        catching_keys_data['keys'] += keys
-        catching_keys_data['amount'] -= 1
+        state.catching_keys_data['keys'] += keys
+        state.catching_keys_data['amount'] -= 1
 
     # It's a default mapping. If the corresponding value is a string, we assume
     # it's a WeeChat command. Otherwise, it's a method we'll call.
-    if vi_keys in VI_KEYS:
+    kind = key_index.get(vi_keys)
+    if kind == "key":
         if vi_keys not in ['u', '\x01R']:
             add_undo_history(buf, input_line)
         if isinstance(VI_KEYS[vi_keys], str):
             do_command(VI_KEYS[vi_keys], buf, input_line, cur, count)
         else:
+            if VI_KEYS[vi_keys] in CHANGE_KEYS:
+                record_change(VI_KEYS[vi_keys], count)
             VI_KEYS[vi_keys](buf, input_line, cur, count)
     # It's a motion (e.g. "w") — call `motion_X()` where X is the motion, then
     # set the cursor's position to what that function returned.
-    elif vi_keys in VI_MOTIONS:
+    elif kind == "motion":
         do_motion(vi_keys, buf, input_line, cur, count)
     # It's an operator + motion (e.g. "dw") — call `motion_X()` (where X is
     # the motion), then we call `operator_Y()` (where Y is the operator)
     # with the position `motion_X()` returned. `operator_Y()` should then
     # handle changing the input line.
-    elif (len(vi_keys) > 1 and
-          vi_keys[0] in VI_OPERATORS and
-          vi_keys[1:] in VI_MOTIONS):
+    elif kind == "operator":
         do_operator(vi_keys, buf, input_line, cur, count)
+    # It's Alt-j followed by a two-digit buffer number (e.g. "\x01[j11"),
+    # which WeeChat sends as a single key combo, and which hasn't been
+    # remapped. Alt-j alone catches the number instead (see `key_alt_j()`).
+    elif (kind is None and vi_keys.startswith("\x01[j") and
+            re.match(REGEX_ALT_J_BUFFER, vi_keys)):
+        do_command("/buffer %s" % vi_keys[3:], buf, input_line, cur, count)
     # Done catching keys, execute the callback.
-    elif catching_keys and catching_keys_data['amount'] == 0:
-        catching_keys_data['amount'] = -1
-        vi_buffer = vi_buffer[:-len(keys)]
-        globals()[catching_keys_data['callback']]()
-        vi_buffer = ""
-        weechat.bar_item_update("vi_buffer")
+    elif catching_keys and state.catching_keys_data['amount'] == 0:
+        state.catching_keys_data['amount'] = -1
+        state.vi_buffer = state.vi_buffer[:-len(keys)]
+        globals()[state.catching_keys_data['callback']]()
+        state.vi_buffer = ""
+        update_bar_item("vi_buffer")
     else:
         return weechat.WEECHAT_RC_OK_EAT
 
     # We've already handled the key combo, so clear the keys buffer.
-    if catching_keys_data['amount'] <= 0:
-        catching_keys_data['amount'] = 0
-        vi_buffer = ""
-        weechat.bar_item_update("vi_buffer")
+    if state.catching_keys_data['amount'] <= 0:
+        state.catching_keys_data['amount'] = 0
+        state.vi_buffer = ""
+        update_bar_item("vi_buffer")
     return weechat.WEECHAT_RC_OK_EAT
 
 def cb_check_imap_esc(data, remaining_calls):
     """Clear the imap_esc sequence after some time if nothing was pressed."""
-    global vi_buffer
-    if vi_buffer == data:
-        vi_buffer = ""
-        weechat.bar_item_update("vi_buffer")
+    if state.vi_buffer == data:
+        state.vi_buffer = ""
+        update_bar_item("vi_buffer")
     return weechat.WEECHAT_RC_OK
 
 def cb_key_combo_search(data, signal, signal_data):
     """Handle keys while search mode is active (if search_vim is enabled)."""
+    global history_matches
     if not weechat.config_string_to_boolean(vimode_settings['search_vim']):
         return weechat.WEECHAT_RC_OK
-    if mode == "COMMAND":
+    if state.mode == "COMMAND":
+        buf = weechat.current_buffer()
         if signal_data == "\x01M":
+            add_history(search_history, weechat.buffer_get_string(buf,
+                                                                  "input"))
+            history_matches = None
             set_mode("SEARCH")
             return weechat.WEECHAT_RC_OK_EAT
-    elif mode == "SEARCH":
+        # Up/Down arrows recall previous searches, like in vim.
+        if signal_data in ["\x01[[A", "\x01[[B"]:
+            text = recall_history(search_history,
+                                  weechat.buffer_get_string(buf, "input"),
+                                  signal_data == "\x01[[A")
+            weechat.buffer_set(buf, "input", text)
+            set_cur(buf, text, len(text), False)
+            return weechat.WEECHAT_RC_OK_EAT
+        history_matches = None
+    elif state.mode == "SEARCH":
         if signal_data == "\x01M":
             set_mode("NORMAL")
         else:
@@ -1678,8 +2554,11 @@ def cb_key_combo_search(data, signal, signal_data):
 # ----------
 
 def cb_vi_buffer(data, item, window):
-    """Return the content of the vi buffer (pressed keys on hold)."""
-    return vi_buffer
+    """Return the content of the vi buffer (pressed keys on hold), and the
+    register a macro is being recorded into, if any."""
+    if recording_register is not None:
+        return "recording @{} {}".format(recording_register, state.vi_buffer)
+    return state.vi_buffer
 
 def cb_cmd_completion(data, item, window):
     """Return the text of the command line."""
@@ -1687,19 +2566,27 @@ def cb_cmd_completion(data, item, window):
 
 def cb_mode_indicator(data, item, window):
     """Return the current mode (INSERT/NORMAL/REPLACE/...)."""
-    return "{}{}{}{}{}".format(
-        weechat.color(mode_colors[mode]),
-        vimode_settings['mode_indicator_prefix'], mode,
-        vimode_settings['mode_indicator_suffix'], weechat.color("reset"))
+    prefix = vimode_settings['mode_indicator_prefix']
+    suffix = vimode_settings['mode_indicator_suffix']
+    key = (item, state.mode, mode_colors[state.mode], prefix, suffix)
+    content = bar_items_cache.get(key)
+    if content is None:
+        content = bar_items_cache[key] = "{}{}{}{}{}".format(
+            weechat.color(mode_colors[state.mode]), prefix, state.mode, suffix,
+            weechat.color("reset"))
+    return content
 
 def cb_line_numbers(data, item, window):
     """Fill the line numbers bar item."""
     bar_height = weechat.window_get_integer(window, "win_chat_height")
-    content = ""
-    for i in range(1, bar_height + 1):
-        content += "{}{:2}{}\n".format(vimode_settings['line_number_prefix'],
-                                       i,
-                                       vimode_settings['line_number_suffix'])
+    prefix = vimode_settings['line_number_prefix']
+    suffix = vimode_settings['line_number_suffix']
+    key = (item, bar_height, prefix, suffix)
+    content = bar_items_cache.get(key)
+    if content is None:
+        content = bar_items_cache[key] = "".join(
+            "{}{:2}{}\n".format(prefix, i, suffix)
+            for i in range(1, bar_height + 1))
     return content
 
 # Callbacks for the line numbers bar.
@@ -1717,7 +2604,37 @@ def cb_update_line_numbers(data, signal, signal_data):
 
 def cb_timer_update_line_numbers(data, remaining_calls):
     """Update the line numbers bar item."""
-    weechat.bar_item_update("line_numbers")
+    update_bar_item("line_numbers")
+    return weechat.WEECHAT_RC_OK
+
+
+# Buffers.
+# --------
+
+def cb_buffer_opened(data, signal, signal_data):
+    """Index the name of a new (or renamed) buffer for completion."""
+    name = buffer_names.pop(signal_data, None)
+    if name is not None:
+        buffers_index.remove(name)
+    buffer_names[signal_data] = weechat.buffer_get_string(signal_data, "name")
+    buffers_index.add(buffer_names[signal_data])
+    return weechat.WEECHAT_RC_OK
+
+def cb_buffer_closed(data, signal, signal_data):
+    """Forget everything we kept about a closed buffer."""
+    history = state.undo_history.pop(signal_data, None)
+    if history is not None:
+        state.undo_history_size -= history.size
+    input_line_backup.pop(signal_data, None)
+    name = buffer_names.pop(signal_data, None)
+    if name is not None:
+        buffers_index.remove(name)
+    return weechat.WEECHAT_RC_OK
+
+def cb_commands_changed(data, signal, signal_data):
+    """Index WeeChat commands again when next needed."""
+    global weechat_commands_index
+    weechat_commands_index = None
     return weechat.WEECHAT_RC_OK
 
 
@@ -1729,6 +2646,8 @@ def cb_config(data, option, value):
     option_name = option.split(".")[-1]
     if option_name in vimode_settings:
         vimode_settings[option_name] = value
+    # Bar items are rendered using the prefix, suffix and color options.
+    bar_items_cache.clear()
     if option_name.startswith('user_mappings'):
         load_user_mappings()
     if "_color" in option_name:
@@ -1738,6 +2657,7 @@ def cb_config(data, option, value):
     return weechat.WEECHAT_RC_OK
 
 def load_mode_colors():
+    bar_items_cache.clear()
     mode_colors.update({
         'NORMAL': "{},{}".format(
             vimode_settings['mode_indicator_normal_color'],
@@ -1768,6 +2688,12 @@ def load_user_mappings():
         vimode_settings[key] = mappings
         for k, v in mappings.items():
             VI_KEYS[k] = UserMapping(k, v, noremap=noremap)
+            update_key_index(k)
+    # Compile mappings now that all of them are known, rather than on their
+    # first use.
+    for command in VI_KEYS.values():
+        if isinstance(command, UserMapping):
+            command.program()
 
 def load_is_keyword_regexes():
     is_keyword = vimode_settings['is_keyword']
@@ -1776,36 +2702,184 @@ def load_is_keyword_regexes():
         r"(?<=[^{0}])[{0}]|(?<![^{0}\s])[^{0}\s]".format(is_keyword))
     keyword_regexes['e'] = re.compile(
         r"[{0}](?=[^{0}])|[^{0}\s](?![^{0}\s])".format(is_keyword))
-    keyword_regexes['iw'] = re.compile(
-        r"[{0}](?=[^{0}])|[^{0}\s](?![^{0}\s])|\s(?!\s)|.$".format(is_keyword))
+    keyword_regexes['keyword'] = re.compile(r"[{0}]".format(is_keyword))
+    word_boundaries_cache.clear()
 
 # Command-line execution.
 # -----------------------
 
+def run_cmd(cmd_text):
+    """Execute a command entered in command-line mode (e.g. ":s/foo/bar").
+
+    Commands that only change the input line or vimode itself run right away.
+    Others run from a timer (see `cb_exec_cmd()`), as WeeChat commands aren't
+    always safe to run from a key callback (e.g. when reloading scripts).
+    """
+    cmd = cmd_text[1:].split(" ", 1)[0]
+    if (re.compile(REGEX_SUBSTITUTE).match(cmd_text, 1) or
+            callable(VI_COMMANDS.get(cmd))):
+        exec_cmd(cmd_text)
+    else:
+        weechat.hook_timer(1, 0, 1, "cb_exec_cmd", cmd_text)
+
+# Parsed :s command. `start` and `end` are the lines of its range (None, "%",
+# ".", "$" or a line number), `count` the number of lines to work on (from
+# `end`) if given, and `regex`/`repl`/`max` the arguments of `regex.sub()`.
+Substitution = namedtuple("Substitution", ["start", "end", "count", "regex",
+                                           "repl", "max"])
+# Recently parsed :s commands, by command.
+substitute_cache = OrderedDict()
+
+def parse_substitute(cmd):
+    """Parse a :s command (without the leading ':').
+
+    Like in vim, the pattern and replacement can be delimited by any
+    non-alphanumeric character (other than '\\', '"' and '|'), which can be
+    escaped with a backslash. Patterns use Python's regex syntax. In the
+    replacement, `&` and `\\0` insert the match, `\\1`-`\\9` a group, and
+    `\\&` a literal '&'. Flags are `g` (all matches in a line), `i` (ignore
+    case) and `I` (don't), and can be followed by a count.
+
+    The last 32 commands parsed are cached, so running one again (e.g. from
+    the history) only costs the substitution itself.
+
+    Returns:
+        Substitution: the parsed command.
+
+    Raises:
+        re.error: the pattern is invalid, or the replacement refers to a group
+            it doesn't have.
+    """
+    substitution = substitute_cache.pop(cmd, None)
+    if substitution is None:
+        match = re.match(REGEX_SUBSTITUTE, cmd)
+        start, end = match.group(2), match.group(3)
+        if match.group(1) == "%":
+            start = end = "%"
+        parts = split_delimited(cmd[match.end():], match.group(4))
+        pattern, repl, flags = (parts + ["", ""])[:3]
+        if not pattern:
+            raise re.error("empty pattern")
+        flags, count = re.match(r"\s*(\D*)\s*(\d*)", flags).groups()
+        # The last of "i" and "I" wins.
+        ignore_case = flags.rfind("i") > flags.rfind("I")
+        regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        substitution = Substitution(
+            start, end or start, int(count or 0), regex,
+            convert_replacement(repl, regex.groups),
+            0 if "g" in flags else 1)
+        if len(substitute_cache) >= 32:
+            substitute_cache.popitem(last=False)
+    substitute_cache[cmd] = substitution
+    return substitution
+
+def split_delimited(text, delimiter):
+    """Split `text` on unescaped `delimiter`s, in at most 3 parts.
+
+    Escaped delimiters lose their backslash, other escapes are kept.
+    """
+    parts = [[]]
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == "\\" and i + 1 < len(text):
+            escaped = text[i + 1]
+            parts[-1].append(escaped if escaped == delimiter else
+                             text[i:i + 2])
+            i += 2
+            continue
+        if char == delimiter and len(parts) < 3:
+            parts.append([])
+        else:
+            parts[-1].append(char)
+        i += 1
+    return ["".join(part) for part in parts]
+
+def convert_replacement(repl, groups):
+    """Convert the replacement of a :s command to a `re.sub()` template.
+
+    Group references are checked against the pattern's number of `groups`
+    here, as `re.sub()` would only fail on them once something matches.
+
+    Raises:
+        re.error: the replacement refers to a group the pattern doesn't have.
+    """
+    template = []
+    i = 0
+    while i < len(repl):
+        char = repl[i]
+        if char == "\\" and i + 1 < len(repl):
+            escaped = repl[i + 1]
+            if escaped.isdigit():
+                if int(escaped) > groups:
+                    raise re.error("invalid group reference {}".format(
+                        escaped))
+                template.append("\\g<{}>".format(escaped))
+            elif escaped in "nt":
+                template.append(repl[i:i + 2])
+            elif escaped == "r":
+                template.append("\\n")
+            else:
+                template.append(escaped.replace("\\", "\\\\"))
+            i += 2
+            continue
+        if char == "&":
+            template.append("\\g<0>")
+        else:
+            template.append(char.replace("\\", "\\\\"))
+        i += 1
+    return "".join(template)
+
+def substitute(input_line, cur, substitution):
+    """Run a parsed :s command on the input line and return the new line.
+
+    Lines of the input line are numbered from 1, and the command works on the
+    line the cursor `cur` is on unless a range is given.
+    """
+    if "\n" not in input_line:
+        lines = [input_line]
+        current = 0
+    else:
+        lines = input_line.split("\n")
+        current = input_line.count("\n", 0, cur)
+    start, end = [
+        current if spec is None or spec == "." else
+        len(lines) - 1 if spec == "$" else
+        0 if spec == "%" else
+        int(spec) - 1
+        for spec in (substitution.start, substitution.end)]
+    if substitution.end == "%":
+        end = len(lines) - 1
+    if substitution.count:
+        start, end = end, end + substitution.count - 1
+    start, end = max(start, 0), min(end, len(lines) - 1)
+    regex, repl, max_count = (substitution.regex, substitution.repl,
+                              substitution.max)
+    lines[start:end + 1] = [regex.sub(repl, line, max_count)
+                            for line in lines[start:end + 1]]
+    return "\n".join(lines)
+
 def cb_exec_cmd(data, remaining_calls):
+    """Execute a command from a timer, see `run_cmd()`."""
+    exec_cmd(data)
+    return weechat.WEECHAT_RC_OK
+
+def exec_cmd(data):
     """Translate and execute our custom commands to WeeChat command."""
     # Process the entered command.
     data = list(data)
     del data[0]
     data = "".join(data)
     # s/foo/bar command.
-    if data.startswith("s/"):
-        cmd = data
-        parsed_cmd = next(csv.reader(StringIO(cmd), delimiter="/",
-                                     escapechar="\\"))
-        pattern = re.escape(parsed_cmd[1])
-        repl = parsed_cmd[2]
-        repl = re.sub(r"([^\\])&", r"\1" + pattern, repl)
-        flag = None
-        if len(parsed_cmd) == 4:
-            flag = parsed_cmd[3]
-        count = 1
-        if flag == "g":
-            count = 0
+    if re.match(REGEX_SUBSTITUTE, data):
+        try:
+            substitution = parse_substitute(data)
+        except re.error as error:
+            print_warning("Invalid pattern: {}".format(error))
+            return
         buf = weechat.current_buffer()
-        input_line = weechat.buffer_get_string(buf, "input")
-        input_line = re.sub(pattern, repl, input_line, count)
-        weechat.buffer_set(buf, "input", input_line)
+        input_line = get_input(buf)
+        set_input(buf, substitute(input_line, get_cur(buf), substitution))
     # Shell command.
     elif data.startswith("!"):
         weechat.command("", "/exec -buffer shell %s" % data[1:])
@@ -1840,12 +2914,239 @@ def cb_exec_cmd(data, remaining_calls):
                 if tmp_cmd in VI_COMMANDS and tmp_args.isdigit():
                     weechat.command("", "%s %s" % (VI_COMMANDS[tmp_cmd],
                                                    tmp_args))
-                    return weechat.WEECHAT_RC_OK
+                    return
             # No vi commands found, run the command as WeeChat command
             # We /wait to avoid crashing WeeChat on script reloads/unloads
             # (see <https://github.com/weechat/weechat/issues/1246>)
             weechat.command("", "/wait 1ms /{} {}".format(cmd, args))
-    return weechat.WEECHAT_RC_OK
+
+
+# Command-line completion.
+# ------------------------
+
+class CompletionIndex(object):
+    """Sorted list of words, for fast prefix lookups with bisect.
+
+    Words can be added more than once (e.g. buffers with the same name), and
+    are kept until removed as many times.
+    """
+
+    def __init__(self, words=()):
+        self.counts = {}
+        self.words = []
+        for word in words:
+            self.counts[word] = self.counts.get(word, 0) + 1
+        self.words = sorted(self.counts)
+
+    def add(self, word):
+        """Add `word` to the index."""
+        if word not in self.counts:
+            self.words.insert(bisect_left(self.words, word), word)
+            self.counts[word] = 0
+        self.counts[word] += 1
+
+    def remove(self, word):
+        """Remove `word` from the index, if it's there."""
+        count = self.counts.pop(word, 0)
+        if count > 1:
+            self.counts[word] = count - 1
+        elif count:
+            del self.words[bisect_left(self.words, word)]
+
+    def find(self, prefix):
+        """Return the words starting with `prefix`, sorted."""
+        start = end = bisect_left(self.words, prefix)
+        while end < len(self.words) and self.words[end].startswith(prefix):
+            end += 1
+        return self.words[start:end]
+
+# Completion indexes for the names of vi commands, WeeChat commands and
+# buffers. WeeChat commands are indexed when first needed, and again after
+# plugins or scripts are (un)loaded.
+vi_commands_index = CompletionIndex(VI_COMMANDS)
+weechat_commands_index = None
+buffers_index = CompletionIndex()
+# Name of each buffer in `buffers_index`, by pointer.
+buffer_names = {}
+
+def get_cmd_completions(text):
+    """Return the completions for `text`, typed in command-line mode.
+
+    Command names are completed using vi commands (first) and WeeChat
+    commands, buffer names are completed for `:b` and its variants.
+    """
+    global weechat_commands_index
+    if " " in text:
+        cmd, arg = text.split(" ", 1)
+        if VI_COMMANDS.get(cmd) != "/buffer":
+            return []
+        return ["{} {}".format(cmd, name)
+                for name in buffers_index.find(arg)]
+    if weechat_commands_index is None:
+        infolist = weechat.infolist_get("hook", "", "command")
+        commands = []
+        while weechat.infolist_next(infolist):
+            commands.append(weechat.infolist_string(infolist, "command"))
+        weechat.infolist_free(infolist)
+        weechat_commands_index = CompletionIndex(commands)
+    completions = vi_commands_index.find(text)
+    return completions + [cmd for cmd in weechat_commands_index.find(text)
+                          if cmd not in VI_COMMANDS]
+
+def index_buffers():
+    """Fill `buffers_index` with the names of all open buffers."""
+    infolist = weechat.infolist_get("buffer", "", "")
+    while weechat.infolist_next(infolist):
+        buf = weechat.infolist_pointer(infolist, "pointer")
+        buffer_names[buf] = weechat.infolist_string(infolist, "name")
+        buffers_index.add(buffer_names[buf])
+    weechat.infolist_free(infolist)
+
+
+# Command-line history.
+# ---------------------
+
+class History(object):
+    """Command-line (":") or search ("/") history.
+
+    Entries are unique and kept from oldest to newest, and are indexed for
+    prefix lookups (see `recall_history()`).
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        # When each entry was last added, by entry.
+        self.entries = OrderedDict()
+        self.index = CompletionIndex()
+        self.counter = 0
+
+    def add(self, text, size):
+        """Add `text` as the newest entry, keeping at most `size` entries."""
+        if text in self.entries:
+            del self.entries[text]
+            self.index.remove(text)
+        self.counter += 1
+        self.entries[text] = self.counter
+        self.index.add(text)
+        while len(self.entries) > size:
+            self.index.remove(self.entries.popitem(last=False)[0])
+
+    def matches(self, prefix):
+        """Return the entries starting with `prefix`, oldest first."""
+        return sorted(self.index.find(prefix), key=self.entries.get)
+
+cmd_history = History(":")
+search_history = History("/")
+# Whether the history file was read yet, and how many lines it has. See
+# `load_history()`.
+history_loaded = False
+history_file_lines = 0
+
+def get_history_file():
+    """Return the path of the file histories are saved to, or None if
+    histories aren't saved (e.g. outside WeeChat)."""
+    data_dir = (weechat.info_get("weechat_data_dir", "") or
+                weechat.info_get("weechat_dir", ""))
+    if not data_dir:
+        return None
+    return os.path.join(data_dir, "vimode_history")
+
+def load_history():
+    """Read the history file, if not done yet.
+
+    This is done when entering command-line mode for the first time, rather
+    than when loading the script.
+    """
+    global history_loaded, history_file_lines
+    if history_loaded:
+        return
+    history_loaded = True
+    histories = {":": cmd_history, "/": search_history}
+    size = int(vimode_settings['history_size'])
+    path = get_history_file()
+    if path is None:
+        return
+    try:
+        with open(path) as f:
+            for line in f:
+                history_file_lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry[:1] in histories:
+                    histories[entry[0]].add(entry[1:], size)
+    except (IOError, OSError):
+        return
+    compact_history()
+
+def add_history(history, text):
+    """Add `text` to `history`, and append it to the history file.
+
+    The file is rewritten with only the current entries once it has grown to
+    more than twice as many lines.
+    """
+    global history_file_lines
+    size = int(vimode_settings['history_size'])
+    if not text or size <= 0:
+        return
+    load_history()
+    history.add(text, size)
+    path = get_history_file()
+    if path is None:
+        return
+    try:
+        with open(path, "a") as f:
+            f.write(json.dumps(history.kind + text) + "\n")
+    except (IOError, OSError):
+        return
+    history_file_lines += 1
+    compact_history()
+
+def compact_history():
+    """Rewrite the history file if it has too many outdated lines."""
+    global history_file_lines
+    entries = sorted(
+        [(counter, history.kind + text)
+         for history in [cmd_history, search_history]
+         for text, counter in history.entries.items()])
+    if history_file_lines <= max(2 * len(entries), 10):
+        return
+    path = get_history_file()
+    try:
+        with open(path + ".tmp", "w") as f:
+            for _, entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError):
+        return
+    history_file_lines = len(entries)
+
+def recall_history(history, text, older):
+    """Return an older (or newer) entry of `history` than the one shown.
+
+    Like in vim, only entries starting with the text typed before recalling
+    entries are used. Once past the newest entry, this text is returned.
+    `history_matches` must be reset to None when another key is pressed.
+
+    Args:
+        history (History): the history to recall entries from.
+        text (str): the text currently shown.
+        older (bool): True for an older entry (Up), False for a newer one.
+    """
+    global history_matches, history_prefix, cmd_history_index
+    load_history()
+    if history_matches is None:
+        history_prefix = text
+        history_matches = history.matches(text)
+        cmd_history_index = len(history_matches)
+    if older:
+        cmd_history_index = max(cmd_history_index - 1, 0)
+    else:
+        cmd_history_index = min(cmd_history_index + 1, len(history_matches))
+    if cmd_history_index == len(history_matches):
+        return history_prefix
+    return history_matches[cmd_history_index]
 
 def cb_vimode_go_to_normal(data, buf, args):
     set_mode("NORMAL")
@@ -1861,8 +3162,6 @@ def cb_vimode_cmd(data, buf, args):
         weechat.prnt("", "[vimode.py] %s" % README_URL)
     # ``/vimode bind_keys`` or ``/vimode bind_keys --list``
     elif args.startswith("bind_keys"):
-        infolist = weechat.infolist_get("key", "", "default")
-        weechat.infolist_reset_item_cursor(infolist)
         commands = ["/key unbind ctrl-W",
                     "/key bind ctrl-W /input delete_previous_word",
                     "/key bind ctrl-^ /input jump_last_buffer_displayed",
@@ -1875,10 +3174,12 @@ def cb_vimode_cmd(data, buf, args):
                     "/key bind ctrl-Ws /window splith",
                     "/key bind ctrl-Wv /window splitv",
                     "/key bind ctrl-Wq /window merge"]
-        while weechat.infolist_next(infolist):
-            key = weechat.infolist_string(infolist, "key")
-            if re.match(REGEX_PROBLEMATIC_KEYBINDINGS, key):
-                commands.append("/key unbind %s" % key)
+        if args == "bind_keys":
+            # Look key bindings up again before unbinding them, in case the
+            # cache is stale (see `get_key_config_fingerprint()`).
+            forget_problematic_keys()
+        for key, _ in get_problematic_keys():
+            commands.append("/key unbind %s" % key)
         if args == "bind_keys":
             weechat.prnt("", "Running commands:")
             for command in commands:
@@ -1889,6 +3190,9 @@ def cb_vimode_cmd(data, buf, args):
             for command in commands:
                 weechat.prnt("", "    %s" % command)
             weechat.prnt("", "Done.")
+    # ``/vimode profile start|stop|report [file]``
+    elif args.startswith("profile"):
+        cmd_profile(args[len("profile"):].strip())
     return weechat.WEECHAT_RC_OK
 
 
@@ -1899,41 +3203,240 @@ def cb_vimode_cmd(data, buf, args):
 # ---------------------
 def do_command(cmd, buf, input_line, cur, count):
     """Execute WeeChat Command"""
+    # The command works on WeeChat's copy of the input line.
+    flush_input()
     for _ in range(max(count, 1)):
         weechat.command("", cmd)
-        current_cur = weechat.buffer_get_integer(buf, "input_pos")
-        set_cur(buf, input_line, current_cur)
+    # Keep the cursor on the line's last character at most.
+    length = weechat.buffer_get_integer(buf, "input_length")
+    if 0 < length <= weechat.buffer_get_integer(buf, "input_pos"):
+        weechat.buffer_set(buf, "input_pos", str(length - 1))
+
+def get_motion(keys):
+    """Return the function for the motion or text object `keys`.
+
+    See Also:
+        `motion_base()`.
+    """
+    if keys in VI_TEXT_OBJECTS:
+        return functools.partial(select_text_object, keys)
+    if keys in SPECIAL_CHARS:
+        return globals()["motion_%s" % SPECIAL_CHARS[keys]]
+    return globals()["motion_%s" % keys]
 
 def do_motion(keys, buf, input_line, cur, count):
     """Perform Vim-like Motion"""
-    if keys in SPECIAL_CHARS:
-        func = "motion_%s" % SPECIAL_CHARS[keys]
-    else:
-        func = "motion_%s" % keys
-    _, end, _, _ = globals()[func](input_line, cur, count)
-    set_cur(buf, input_line, end)
+    _, end, _, _ = get_motion(keys)(input_line, cur, count)
+    if end is not None:
+        set_cur(buf, input_line, end)
+
+def do_operator(keys, buf, input_line, cur, count, char=None):
+    """Perform Vim-like Operator + Motion
 
-def do_operator(keys, buf, input_line, cur, count):
+    `char` is the character for f/F/t/T motions, when repeating a change
+    (see `key_dot()`). Otherwise, it's caught after the motion's key.
+    """
     add_undo_history(buf, input_line)
-    if keys[1:] in SPECIAL_CHARS:
-        func = "motion_%s" % SPECIAL_CHARS[keys[1:]]
+    if char is not None:
+        pos1, pos2, overwrite, catching = (
+            cur, find_char(keys[1], char, input_line, cur, count),
+            keys[1] in "ft", False)
     else:
-        func = "motion_%s" % keys[1:]
-    pos1, pos2, overwrite, catching = globals()[func](input_line, cur, count)
-    # See vim's "Special case" in :help cw
-    is_keyword = vimode_settings['is_keyword']
-    if keys in ["cw", "cW"] and is_keyword.match(input_line[cur]):
-        pos2 -= 1
+        if "new_cur" in state.catching_keys_data:
+            char = state.catching_keys_data['keys']
+        pos1, pos2, overwrite, catching = get_motion(keys[1:])(input_line,
+                                                               cur, count)
+    # See vim's "Special case" in :help cw: on a non-blank, "cw" is "ce",
+    # except that it stays at the end of the current word.
+    if keys in ["cw", "cW"] and input_line[cur:cur + 1] not in ["", " ", "\t"]:
+        regex = (keyword_regexes['e'] if keys == "cw" else
+                 REGEX_MOTION_UPPERCASE_E)
+        pos2 = get_word_boundaries(input_line).next(regex, cur, count, True)
+        if pos2 == -1:
+            pos2 = len(input_line)
+        overwrite = True
     # If it's a catching motion, we don't want to call the operator just
     # yet -- this code will run again when the motion is complete, at which
-    # point we will.
-    if not catching:
+    # point we will. If the motion failed, there's nothing to do.
+    if not catching and pos2 is not None:
+        if keys[0] != "y":
+            record_change(functools.partial(repeat_operator, keys, char=char),
+                          count)
         oper = "operator_%s" % keys[0]
         globals()[oper](buf, input_line, pos1, pos2, overwrite)
 
-def get_pos(data, regex, cur, ignore_cur=False, count=0):
+def repeat_operator(keys, buf, input_line, cur, count, char=None):
+    """Repeat a change made by `do_operator()`, for . (see `record_change()`).
+
+    `do_operator()` is looked up when the change is repeated, so that the
+    recorded change doesn't keep it wrapped once profiling stops (see
+    `start_profiling()`).
+    """
+    do_operator(keys, buf, input_line, cur, count, char)
+
+class WordBoundaries(object):
+    """Sorted offsets of the matches of word regexes (and of quoted strings)
+    in an input line.
+
+    Each regex is run over the whole line (or the reversed line, for backward
+    motions) once, the first time it's needed. Motions then find the
+    `count`'th boundary before/after the cursor with a binary search.
+
+    See Also:
+        `get_word_boundaries()`.
+    """
+
+    def __init__(self, input_line):
+        self.input_line = input_line
+        self.reversed_line = None
+        self.offsets = {}
+
+    def get_offsets(self, regex, backward=False):
+        """Return the sorted offsets of the `regex` matches.
+
+        If `backward` is True, `regex` is matched against the reversed line,
+        but offsets are still relative to the start of the (non-reversed)
+        line.
+        """
+        offsets = self.offsets.get((regex, backward))
+        if offsets is None:
+            if backward:
+                if self.reversed_line is None:
+                    self.reversed_line = self.input_line[::-1]
+                last = len(self.input_line) - 1
+                offsets = [last - m.start()
+                           for m in regex.finditer(self.reversed_line)]
+                offsets.reverse()
+            else:
+                offsets = [m.start() for m in regex.finditer(self.input_line)]
+            self.offsets[(regex, backward)] = offsets
+        return offsets
+
+    def next(self, regex, cur, count, inclusive=False):
+        """Return the `count`'th match of `regex` after `cur`, or -1.
+
+        If `inclusive` is True, a match at `cur` counts as well.
+        """
+        offsets = self.get_offsets(regex)
+        if inclusive:
+            index = bisect_left(offsets, cur)
+        else:
+            index = bisect_right(offsets, cur)
+        index += max(count, 1) - 1
+        if index < len(offsets):
+            return offsets[index]
+        return -1
+
+    def previous(self, regex, cur, count, inclusive=False):
+        """Return the `count`'th match of reversed `regex` before `cur`, or -1.
+
+        If `inclusive` is True, a match at `cur` counts as well.
+        """
+        offsets = self.get_offsets(regex, True)
+        if inclusive:
+            index = bisect_right(offsets, cur)
+        else:
+            index = bisect_left(offsets, cur)
+        index -= max(count, 1)
+        if index >= 0:
+            return offsets[index]
+        return -1
+
+    def backward(self, regex, cur, count, ends=False):
+        """Return where moving `count` words backward from `cur` stops, like
+        Vim's "b" or "ge" (`ends` is True for ends of words, see
+        `previous()`).
+
+        When there are fewer than `count` matches, the motion stops at the
+        start of the line. Like in Vim, it fails (None is returned) if it
+        starts there, or for ends of words, if one of the `count` moves does.
+        """
+        offsets = self.get_offsets(regex, True)
+        index = bisect_left(offsets, cur)
+        count = max(count, 1)
+        if index >= count:
+            return offsets[index - count]
+        if not cur or (ends and index and not offsets[0]):
+            return None
+        return 0
+
+    def quoted_strings(self, quote):
+        """Return the positions of the opening and closing quotes of the
+        strings quoted with `quote`, as two sorted lists.
+
+        Strings pair up from the start of the line, like in Vim: an opening
+        quote can't be escaped, a closing one can (see
+        `find_closing_quote()`).
+        """
+        strings = self.offsets.get(quote)
+        if strings is None:
+            starts, ends = [], []
+            start = self.input_line.find(quote)
+            while start != -1:
+                end = find_closing_quote(self.input_line, start + 1, quote)
+                if end == -1:
+                    break
+                starts.append(start)
+                ends.append(end)
+                start = self.input_line.find(quote, end + 1)
+            strings = self.offsets[quote] = (starts, ends)
+        return strings
+
+    def even_quotes(self):
+        """Return True if the line has an even number of double quotes, not
+        counting escaped ones and '"' (see `find_closing_bracket()`)."""
+        even = self.offsets.get('even "')
+        if even is None:
+            line = self.input_line
+            quotes = 0
+            for match in re.finditer(r'\\[\s\S]|"', line):
+                pos = match.start()
+                if match.group() == '"' and (not pos or line[pos - 1] != "'" or
+                                             line[pos + 1:pos + 2] != "'"):
+                    quotes += 1
+            even = self.offsets['even "'] = quotes % 2 == 0
+        return even
+
+def get_word_boundaries(input_line):
+    """Return the (cached) `WordBoundaries` for `input_line`."""
+    boundaries = word_boundaries_cache.get(input_line)
+    if boundaries is None:
+        # Keep the boundaries of a few lines around (e.g. one per recently
+        # used buffer), but don't let the cache grow forever.
+        if len(word_boundaries_cache) >= 8:
+            word_boundaries_cache.clear()
+        boundaries = WordBoundaries(input_line)
+        word_boundaries_cache[input_line] = boundaries
+    return boundaries
+
+def find_char(motion, char, input_line, cur, count):
+    """Return the cursor's position after the f/F/t/T `motion` to `char`,
+    or None if there's no `count`'th occurrence of `char`.
+
+    Like in Vim, t/T don't move when `char` is next to the cursor.
+    """
+    pattern = re.escape(char)
+    if motion == "f":
+        pos = get_pos(input_line, pattern, cur, True, count)
+        return cur + pos if pos >= 0 else None
+    if motion == "F":
+        pos = get_pos(input_line, pattern, cur, True, count, True)
+        return cur - pos if pos >= 0 else None
+    if motion == "t":
+        pos = get_pos(input_line, pattern, cur + 1, False, count)
+        return cur + pos if pos >= 0 else None
+    if cur == 0:
+        return None
+    pos = get_pos(input_line, pattern, cur - 1, False, count, True)
+    return cur - pos if pos >= 0 else None
+
+def get_pos(data, regex, cur, ignore_cur=False, count=0, backward=False):
     """Return the position of `regex` match in `data`, starting at `cur`.
 
+    The search stops as soon as the match we're looking for is found. Note
+    that `data` isn't sliced, so lookbehind assertions can see the text before
+    `cur`.
+
     Args:
         data (str): the data to search in.
         regex (pattern): regex pattern to search for.
@@ -1942,27 +3445,56 @@ def get_pos(data, regex, cur, ignore_cur=False, count=0):
             also the character at `cur`?
             Defaults to False.
         count (int, optional): the index of the match to return. Defaults to 0.
+        backward (bool, optional): if True, search for matches starting
+            before `cur` (or at `cur`, see `ignore_cur`), going to the left.
+            Defaults to False.
 
     Returns:
-        int: position of the match. -1 if no matches are found.
+        int: position of the match relative to `cur` (i.e. the distance to
+            `cur` when searching backward). -1 if no matches are found.
     """
-    # List of the *positions* of the found patterns.
-    matches = [m.start() for m in re.finditer(regex, data[cur:])]
-    pos = -1
-    if count:
-        if len(matches) > count - 1:
-            if ignore_cur and matches[0] == 0:
-                if len(matches) > count:
-                    pos = matches[count]
-            else:
-                pos = matches[count - 1]
-    elif matches:
-        if ignore_cur and matches[0] == 0:
-            if len(matches) > 1:
-                pos = matches[1]
-        else:
-            pos = matches[0]
-    return pos
+    pattern = re.compile(regex)
+    count = max(count, 1)
+    if backward:
+        return get_pos_backward(data, pattern, cur, ignore_cur, count)
+    for match in pattern.finditer(data, cur):
+        if ignore_cur and match.start() == cur:
+            continue
+        count -= 1
+        if not count:
+            return match.start() - cur
+    return -1
+
+def get_pos_backward(data, pattern, cur, ignore_cur, count):
+    """Search `data` backward from `cur` for `get_pos()`.
+
+    Windows of doubling size to the left of `cur` are searched in turn, so
+    the cost depends on the distance to the match rather than on the length
+    of `data`.
+    """
+    # Matches must start before `end`.
+    end = cur if ignore_cur else cur + 1
+    size = 64
+    while end > 0:
+        start = max(0, end - size)
+        matches = []
+        # Where the search stopped past `end`.
+        overshoot = len(data)
+        for match in pattern.finditer(data, start):
+            if match.start() >= end:
+                overshoot = match.start()
+                break
+            matches.append(match.start())
+        if len(matches) >= count:
+            return cur - matches[-count]
+        count -= len(matches)
+        size *= 2
+        # Each search also goes over the text up to `overshoot`. If that's
+        # more than the next window, search all that's left at once instead.
+        if overshoot - end > size:
+            size = start
+        end = start
+    return -1
 
 def set_cur(buf, input_line, pos, cap=True):
     """Set the cursor's position.
@@ -1976,7 +3508,73 @@ def set_cur(buf, input_line, pos, cap=True):
     """
     if cap:
         pos = min(pos, len(input_line) - 1)
-    weechat.buffer_set(buf, "input_pos", str(pos))
+    if edit_depth:
+        pending_input.setdefault(buf, [None, None])[1] = pos
+    else:
+        weechat.buffer_set(buf, "input_pos", str(pos))
+
+def set_input(buf, input_line):
+    """Set the content of the input line.
+
+    Inside an `edit_transaction()`, the change is only sent to WeeChat when
+    the transaction ends.
+    """
+    if edit_depth:
+        pending_input.setdefault(buf, [None, None])[0] = input_line
+    else:
+        weechat.buffer_set(buf, "input", input_line)
+
+def get_input(buf):
+    """Get the content of the input line, including pending changes."""
+    pending = pending_input.get(buf)
+    if pending and pending[0] is not None:
+        return pending[0]
+    return weechat.buffer_get_string(buf, "input")
+
+def get_cur(buf):
+    """Get the cursor's position, including pending changes."""
+    pending = pending_input.get(buf)
+    if pending:
+        if pending[1] is not None:
+            return pending[1]
+        if pending[0] is not None:
+            # WeeChat keeps the cursor within the new text.
+            return min(weechat.buffer_get_integer(buf, "input_pos"),
+                       len(pending[0]))
+    return weechat.buffer_get_integer(buf, "input_pos")
+
+@contextmanager
+def edit_transaction():
+    """Hold back input line writes until the outermost transaction ends.
+
+    Every write to the input line redraws it and sends an input_text_changed
+    signal to all scripts, so handlers that change the line several times
+    (counts, user mappings...) only send the final text and cursor position.
+    Use `get_input()`/`get_cur()` to see pending changes, and
+    `flush_input()` before running commands that work on the input line.
+
+    Bar item refreshes are held back as well, see `update_bar_item()`.
+    """
+    global edit_depth
+    edit_depth += 1
+    try:
+        yield
+    finally:
+        edit_depth -= 1
+        if not edit_depth:
+            flush_input()
+            flush_bar_items()
+
+def flush_input():
+    """Send pending input line changes to WeeChat, skipping no-op writes."""
+    while pending_input:
+        buf, (input_line, pos) = pending_input.popitem()
+        if (input_line is not None and
+                input_line != weechat.buffer_get_string(buf, "input")):
+            weechat.buffer_set(buf, "input", input_line)
+        if (pos is not None and
+                pos != weechat.buffer_get_integer(buf, "input_pos")):
+            weechat.buffer_set(buf, "input_pos", str(pos))
 
 def start_catching_keys(amount, callback, input_line, cur, count, buf=None):
     """Start catching keys. Used for special commands (e.g. "f", "r").
@@ -1999,19 +3597,19 @@ def start_catching_keys(amount, callback, input_line, cur, count, buf=None):
     Once all keys are caught, the method defined in the "callback" key is
     called, and can use the data in `catching_keys_data` to perform its action.
     """
-    global catching_keys_data
-    if "new_cur" in catching_keys_data:
-        new_cur = catching_keys_data['new_cur']
-        catching_keys_data = {'amount': 0}
-        return cur, new_cur, True, False
-    catching_keys_data = ({'amount': amount,
-                           'callback': callback,
-                           'input_line': input_line,
-                           'cur': cur,
-                           'keys': "",
-                           'count': count,
-                           'new_cur': 0,
-                           'buf': buf})
+    if "new_cur" in state.catching_keys_data:
+        new_cur = state.catching_keys_data['new_cur']
+        state.catching_keys_data = {'amount': 0}
+        # f and t are inclusive, F and T (going left) are exclusive.
+        return cur, new_cur, callback in ["cb_motion_f", "cb_motion_t"], False
+    state.catching_keys_data = ({'amount': amount,
+                                 'callback': callback,
+                                 'input_line': input_line,
+                                 'cur': cur,
+                                 'keys': "",
+                                 'count': count,
+                                 'new_cur': 0,
+                                 'buf': buf})
     return cur, cur, False, True
 
 def get_keys_and_count(combo):
@@ -2046,46 +3644,37 @@ def get_keys_and_count(combo):
     # It's a WeeChat command.
     if not matched and combo.startswith("/"):
         matched = True
-    # Check against defined keys.
-    if not matched:
-        for key in VI_KEYS:
-            if key.startswith(combo):
-                matched = True
-                break
-    # Check against defined motions.
-    if not matched:
-        for motion in VI_MOTIONS:
-            if motion.startswith(combo):
-                matched = True
-                break
-    # Check against defined operators + motions.
-    if not matched:
-        for operator in VI_OPERATORS:
-            if combo.startswith(operator):
-                # Check for counts before the motion (but after the operator).
-                vi_keys_no_op = combo[len(operator):]
-                # There's no motion yet.
-                if vi_keys_no_op.isdigit():
-                    matched = True
-                    break
-                # Get the motion count, then multiply the operator count by
-                # it, similar to vim's behavior.
-                elif vi_keys_no_op and vi_keys_no_op[0].isdigit():
-                    motion_count = ""
-                    for char in vi_keys_no_op:
-                        if char.isdigit():
-                            motion_count += char
-                        else:
-                            break
-                    # Remove counts from `vi_keys_no_op`.
-                    combo = combo.replace(motion_count, "", 1)
-                    motion_count = int(motion_count)
-                    count = max(count, 1) * motion_count
-                # Check against defined motions.
-                for motion in VI_MOTIONS:
-                    if motion.startswith(combo[1:]):
-                        matched = True
+    # It's Alt-j followed by a buffer number.
+    if (not matched and combo.startswith("\x01[j") and
+            re.match(REGEX_ALT_J_BUFFER, combo)):
+        matched = True
+    # Check against defined keys, motions and operators + motions.
+    if not matched and key_index.find(combo) is not None:
+        matched = True
+    # Check against operators followed by a count (e.g. "d2w").
+    if not matched and combo[:1] in VI_OPERATORS:
+        # Check for counts before the motion (but after the operator).
+        vi_keys_no_op = combo[1:]
+        # There's no motion yet.
+        if vi_keys_no_op.isdigit():
+            matched = True
+        else:
+            # Get the motion count, then multiply the operator count by it,
+            # similar to vim's behavior.
+            if vi_keys_no_op and vi_keys_no_op[0].isdigit():
+                motion_count = ""
+                for char in vi_keys_no_op:
+                    if char.isdigit():
+                        motion_count += char
+                    else:
                         break
+                # Remove counts from `vi_keys_no_op`.
+                combo = combo.replace(motion_count, "", 1)
+                motion_count = int(motion_count)
+                count = max(count, 1) * motion_count
+            # Check against defined motions.
+            if motion_index.find(combo[1:]) is not None:
+                matched = True
     return matched, combo, count
 
 
@@ -2093,41 +3682,550 @@ def get_keys_and_count(combo):
 # --------------
 def set_mode(arg):
     """Set the current mode and update the bar mode indicator."""
-    global mode
+    global cmd_mode_hook, insert_start
     buf = weechat.current_buffer()
-    input_line = weechat.buffer_get_string(buf, "input")
-    if mode == "INSERT" and arg == "NORMAL":
+    input_line = get_input(buf)
+    if state.mode == "INSERT" and arg == "NORMAL":
         add_undo_history(buf, input_line)
-    mode = arg
+        record_insert(input_line)
+    elif arg == "INSERT" and state.mode != "INSERT":
+        insert_start = (input_line, change_tick)
+    state.mode = arg
+    # Watch the input line while in command-line mode, to leave it once the
+    # leading ':' is erased.
+    if state.mode == "COMMAND" and not cmd_mode_hook:
+        cmd_mode_hook = weechat.hook_signal("input_text_changed",
+                                            "cb_check_cmd_mode", "")
+        load_history()
+    elif state.mode != "COMMAND" and cmd_mode_hook:
+        weechat.unhook(cmd_mode_hook)
+        cmd_mode_hook = None
     # If we're going to Normal mode, the cursor must move one character to the
     # left.
-    if mode == "NORMAL":
-        cur = weechat.buffer_get_integer(buf, "input_pos")
+    if state.mode == "NORMAL":
+        cur = get_cur(buf)
         set_cur(buf, input_line, cur - 1, False)
-    weechat.bar_item_update("mode_indicator")
+    update_bar_item("mode_indicator")
+
+def record_change(action, count):
+    """Record the last change, to be repeated with . (see `key_dot()`).
+
+    Args:
+        action (callable): called like `key_base()` to repeat the change.
+        count (int): count of the change.
+    """
+    global last_change, change_tick
+    if replaying_change:
+        return
+    change_tick += 1
+    last_change = {'action': action, 'count': count, 'text': None}
+
+def record_insert(input_line):
+    """Record the text inserted since entering Insert mode, if this was done
+    by the last change."""
+    global insert_start
+    if (replaying_change or not insert_start or
+            insert_start[1] != change_tick or last_change is None):
+        insert_start = None
+        return
+    _, removed, inserted = diff_text(insert_start[0], input_line)
+    last_change['text'] = inserted if not removed else ""
+    insert_start = None
+
+def record_key(keys):
+    """Add `keys` to the macro being recorded, if any (see `key_q()`)."""
+    if recording_register is not None and not replaying_macro:
+        recorded_keys.append(keys)
+
+def play_macro(name, count):
+    """Play the macro in register `name` `count` times.
+
+    Keys are fed to `handle_key_combo()` a chunk at a time from a timer (see
+    `cb_play_macro()`), so that long macros don't block WeeChat and can be
+    aborted with Esc. A macro played from a macro is played first, then the
+    rest of the latter.
+    """
+    global last_macro, macro_replay
+    keys = macros.get(name)
+    text = state.registers.get(name)
+    if text is None:
+        return
+    if keys is None or "".join(keys) != text:
+        keys = re.findall(REGEX_KEY_COMBOS, text)
+    last_macro = name
+    keys = itertools.chain.from_iterable(itertools.repeat(keys,
+                                                          max(count, 1)))
+    if macro_replay:
+        macro_replay['keys'] = itertools.chain(keys, macro_replay['keys'])
+        return
+    key_bindings.clear()
+    macro_replay = {'keys': keys,
+                    'hook': weechat.hook_timer(1, 0, 0, "cb_play_macro", "")}
+
+def stop_macro():
+    """Stop playing the current macro."""
+    global macro_replay
+    weechat.unhook(macro_replay['hook'])
+    macro_replay = None
+
+def cb_play_macro(data, remaining_calls):
+    """Play the next `MACRO_CHUNK_SIZE` keys of the current macro."""
+    global esc_pressed, replaying_macro
+    # Keys are fed without the Esc prefix a real key press would have.
+    saved_esc_pressed, esc_pressed = esc_pressed, 0
+    replaying_macro = True
+    try:
+        with edit_transaction():
+            for _ in range(MACRO_CHUNK_SIZE):
+                keys = next(macro_replay['keys'], None)
+                if keys is None:
+                    stop_macro()
+                    break
+                feed_key(keys)
+    finally:
+        replaying_macro = False
+        esc_pressed = saved_esc_pressed
+    return weechat.WEECHAT_RC_OK
+
+def feed_key(keys):
+    """Handle `keys` as if they had been pressed, when playing a macro (or
+    in tests).
 
-def cb_check_cmd_mode(data, remaining_calls):
-    """Exit command mode if user erases the leading ':' character."""
+    Keys that vimode doesn't eat are handled the way WeeChat would: text is
+    inserted and other keys run the command they're bound to.
+    """
     buf = weechat.current_buffer()
-    cmd_text = weechat.buffer_get_string(buf, "input")
-    if not cmd_text:
+    # Command-line mode reads the input line from WeeChat.
+    if state.mode == "COMMAND":
+        flush_input()
+    if keys == "\x01[":
+        press_esc()
+        return
+    if weechat.buffer_get_integer(buf, "text_search"):
+        context = "search"
+        rc = cb_key_combo_search("", "key_combo_search", keys)
+    else:
+        context = "default"
+        rc = handle_key_combo("", "key_combo_default", keys)
+    if rc == weechat.WEECHAT_RC_OK_EAT:
+        return
+    if not keys.startswith("\x01"):
+        input_line, cur = get_input(buf), get_cur(buf)
+        input_line = input_line[:cur] + keys + input_line[cur:]
+        set_input(buf, input_line)
+        set_cur(buf, input_line, cur + len(keys), False)
+        return
+    if context not in key_bindings:
+        key_bindings[context] = get_key_bindings(context)
+    command = key_bindings[context].get(keys)
+    if command:
+        flush_input()
+        weechat.command(buf, command)
+
+def get_key_bindings(context):
+    """Return WeeChat's key bindings for `context`, by key combo."""
+    bindings = {}
+    infolist = weechat.infolist_get("key", "", context)
+    while weechat.infolist_next(infolist):
+        bindings[weechat.infolist_string(infolist, "key_internal")] = (
+            weechat.infolist_string(infolist, "command"))
+    weechat.infolist_free(infolist)
+    return bindings
+
+def update_bar_item(item):
+    """Refresh one of our bar items, once the current event is handled.
+
+    Inside an `edit_transaction()`, the item is only marked as changed.
+    """
+    bar_items_dirty.add(item)
+    if not edit_depth:
+        flush_bar_items()
+
+def flush_bar_items():
+    """Refresh the bar items marked as changed by `update_bar_item()`.
+
+    Items whose content doesn't depend on the window are skipped if they would
+    show the same thing as after their last refresh.
+    """
+    while bar_items_dirty:
+        item = bar_items_dirty.pop()
+        if item != "line_numbers":
+            value = globals()["cb_" + item]("", item, "")
+            if bar_items_shown.get(item) == value:
+                continue
+            bar_items_shown[item] = value
+        weechat.bar_item_update(item)
+
+def cb_check_cmd_mode(data, signal, signal_data):
+    """Exit command mode if user erases the leading ':' character.
+
+    Searches (with search_vim) also use command mode, but an empty search is
+    left to WeeChat's text search.
+    """
+    if (state.mode == "COMMAND" and
+            not weechat.buffer_get_integer(signal_data, "text_search") and
+            not weechat.buffer_get_string(signal_data, "input")):
         set_mode("NORMAL")
     return weechat.WEECHAT_RC_OK
 
+class UndoHistory(object):
+    """Undo history of a buffer's input line.
+
+    Only the latest version of the line (`tip`) and the one currently shown
+    (`current`) are kept in full. Every other version is reached by walking
+    `deltas`: `deltas[i]` is an `(offset, removed, inserted)` tuple turning
+    version `i` of the line into version `i + 1`, so undoing or redoing a
+    change only touches the text that changed.
+
+    Undoing and then changing the line doesn't drop the undone versions: the
+    new version is added after `tip`, like the previous list-based history.
+    """
+
+    def __init__(self, text=""):
+        self.deltas = deque()
+        self.tip = text
+        self.current = text
+        # Index of `current` (between 0 and `len(deltas)`).
+        self.pos = 0
+        # Size of `tip` and `deltas`, in characters.
+        self.size = len(text)
+        self.last_used = time.time()
+
+    def add(self, text):
+        """Add a new version of the line, unless it's already the latest one.
+
+        Returns:
+            int: how much the size of the history grew.
+        """
+        self.last_used = time.time()
+        if text == self.tip:
+            return 0
+        offset, removed, inserted = diff_text(self.tip, text)
+        self.deltas.append((offset, removed, inserted))
+        grown = len(removed) + len(inserted) + len(text) - len(self.tip)
+        self.tip = self.current = text
+        self.pos = len(self.deltas)
+        self.size += grown
+        return grown
+
+    def undo(self):
+        """Go back to the previous version of the line and return it.
+
+        Returns None if there's nothing left to undo.
+        """
+        if not self.pos:
+            return None
+        self.pos -= 1
+        offset, removed, inserted = self.deltas[self.pos]
+        self.current = (self.current[:offset] + removed +
+                        self.current[offset + len(inserted):])
+        return self.current
+
+    def redo(self):
+        """Go forward to the next version of the line and return it.
+
+        Returns None if there's nothing left to redo.
+        """
+        if self.pos == len(self.deltas):
+            return None
+        offset, removed, inserted = self.deltas[self.pos]
+        self.current = (self.current[:offset] + inserted +
+                        self.current[offset + len(removed):])
+        self.pos += 1
+        return self.current
+
+    def drop_oldest(self):
+        """Forget the oldest change.
+
+        Returns:
+            int: how much the size of the history shrank.
+        """
+        if not self.pos:
+            self.redo()
+        offset, removed, inserted = self.deltas.popleft()
+        self.pos -= 1
+        shrunk = len(removed) + len(inserted)
+        self.size -= shrunk
+        return shrunk
+
+def diff_text(old, new):
+    """Find the smallest edit turning `old` into `new`.
+
+    The common prefix and suffix are found with a binary search over slice
+    comparisons, so that the bulk of the work is done in C.
+
+    Returns:
+        tuple: `(offset, removed, inserted)`, such that `new == old[:offset] +
+            inserted + old[offset + len(removed):]`.
+    """
+    limit = min(len(old), len(new))
+    # Length of the common prefix: `old[:lo] == new[:lo]` is always true.
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[lo:mid] == new[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    prefix = lo
+    # Length of the common suffix, not overlapping the prefix.
+    lo, hi = 0, limit - prefix
+    end_old, end_new = len(old), len(new)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[end_old - mid:end_old - lo] == new[end_new - mid:end_new - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return (prefix, old[prefix:end_old - lo], new[prefix:end_new - lo])
+
 def add_undo_history(buf, input_line):
-    """Add an item to the per-buffer undo history."""
-    if buf in undo_history:
-        if not undo_history[buf] or undo_history[buf][-1] != input_line:
-            undo_history[buf].append(input_line)
-            undo_history_index[buf] = -1
-    else:
-        undo_history[buf] = ['', input_line]
-        undo_history_index[buf] = -1
+    """Add an item to the per-buffer undo history.
+
+    The history of each buffer keeps at most `undo_levels` changes, and all
+    histories together are kept under `undo_memory` KB by dropping the oldest
+    changes of the least recently used histories first.
+    """
+    history = state.undo_history.get(buf)
+    if history is None:
+        history = state.undo_history[buf] = UndoHistory()
+        state.undo_history_size += history.size
+    grown = history.add(input_line)
+    if not grown:
+        return
+    state.undo_history_size += grown
+    levels = max(int(vimode_settings['undo_levels']), 1)
+    while len(history.deltas) > levels:
+        state.undo_history_size -= history.drop_oldest()
+    budget = int(vimode_settings['undo_memory']) * 1024
+    if state.undo_history_size > budget:
+        for oldest in sorted(state.undo_history.values(),
+                             key=lambda history: history.last_used):
+            while oldest.deltas and state.undo_history_size > budget:
+                state.undo_history_size -= oldest.drop_oldest()
 
 def clear_undo_history(buf):
     """Clear the undo history for a given buffer."""
-    undo_history[buf] = ['']
-    undo_history_index[buf] = -1
+    history = state.undo_history.pop(buf, None)
+    if history is not None:
+        state.undo_history_size -= history.size
+    state.undo_history[buf] = UndoHistory()
+
+def take_register():
+    """Return the register selected for the current command, and reset it.
+
+    Returns None if no register was selected (i.e. the unnamed register should
+    be used), unless the clipboard option is set to use the "+ register.
+    """
+    name = state.register_name
+    state.register_name = None
+    if name is None and vimode_settings['clipboard'] == "unnamedplus":
+        name = "+"
+    return name
+
+def truncate_register(text):
+    """Return `text` truncated to the `register_size` option, to be stored
+    in a register."""
+    return text[:max(int(vimode_settings['register_size']), 1) * 1024]
+
+def store_register(text, delete=False):
+    """Store yanked (or deleted, if `delete` is True) text in registers.
+
+    Like in vim, the text goes to the selected register if any (appending to
+    it for "A-"Z, copying to the clipboard for "+, or discarding it for "_).
+    Otherwise, yanked text goes to "0 and deleted text is shifted into "1-"9.
+    The unnamed register always holds the last stored text. Registers hold at
+    most `register_size` KB (see `truncate_register()`).
+    """
+    name = take_register()
+    if not text or name == "_":
+        return
+    if name == "+":
+        copy_to_clipboard(text)
+        state.registers['"'] = truncate_register(text)
+        return
+    if name and name.isupper():
+        name = name.lower()
+        text = state.registers.get(name, "") + text
+    text = truncate_register(text)
+    if name and name != '"':
+        state.registers[name] = text
+    elif delete:
+        for i in range(9, 1, -1):
+            if str(i - 1) in state.registers:
+                state.registers[str(i)] = state.registers[str(i - 1)]
+        state.registers['1'] = text
+    else:
+        state.registers['0'] = text
+    state.registers['"'] = text
+
+def put_register(buf, input_line, cur, count, after):
+    """Put the content of the selected register `count` times.
+
+    The "+ register is read using `paste_clipboard_cmd` (see `cb_key_p()`),
+    others are put right away.
+    """
+    name = take_register() or '"'
+    count = max(count, 1)
+    if name == "+":
+        cmd = vimode_settings['paste_clipboard_cmd']
+        weechat.hook_process(cmd, 10 * 1000, "cb_key_p",
+                             "{} {:d} {}".format(buf, after, count))
+    elif state.registers.get(name.lower()):
+        text = state.registers[name.lower()] * count
+        put_text(buf, input_line, cur, text, after)
+
+def put_text(buf, input_line, cur, text, after):
+    """Insert `text` before or `after` the cursor, and move the cursor to the
+    last inserted character."""
+    pos = min(cur + 1, len(input_line)) if after else cur
+    input_line = input_line[:pos] + text + input_line[pos:]
+    set_input(buf, input_line)
+    set_cur(buf, input_line, pos + len(text) - 1)
+
+def copy_to_clipboard(text):
+    """Copy `text` to the clipboard using `copy_clipboard_cmd`.
+
+    The command is run by WeeChat in a child process, so we don't wait for it
+    to complete. It's run through the shell (like `subprocess.Popen()` with
+    ``shell=True``) and reads `text` from its standard input. Its output is
+    discarded: some clipboard tools (e.g. xclip) stay in the background to
+    serve the selection, and WeeChat would otherwise wait for them to close
+    it.
+
+    See Also:
+        `cb_copy_clipboard()`.
+    """
+    cmd = vimode_settings['copy_clipboard_cmd']
+    options = {'arg1': "-c",
+               'arg2': "exec >/dev/null 2>&1; %s" % cmd,
+               'stdin': "1"}
+    hook = weechat.hook_process_hashtable("sh", options, 10 * 1000,
+                                          "cb_copy_clipboard", cmd)
+    if hook:
+        weechat.hook_set(hook, "stdin", text)
+        weechat.hook_set(hook, "stdin_close", "")
+    else:
+        print_warning("Failed to run the copy command: %s" % cmd)
+
+def cb_copy_clipboard(data, command, return_code, output, err):
+    """Report errors from the copy command run by `copy_to_clipboard()`."""
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR:
+        print_warning("Failed to run the copy command: %s" % data)
+    elif return_code > 0:
+        print_warning("The copy command failed with code %d: %s" %
+                      (return_code, data))
+    return weechat.WEECHAT_RC_OK
+
+def get_problematic_keys():
+    """Return the problematic key bindings (see
+    `REGEX_PROBLEMATIC_KEYBINDINGS`) as (key, command) tuples.
+
+    Looking them up means walking all of WeeChat's key bindings, so they're
+    kept in a file along with a fingerprint of the key bindings configuration
+    (see `get_key_config_fingerprint()`), and only looked up again when it
+    changed, or when keys are (un)bound (see `cb_key_bindings_changed()`).
+    """
+    global problematic_keys
+    if problematic_keys is not None:
+        return problematic_keys
+    path = get_key_warnings_file()
+    fingerprint = get_key_config_fingerprint()
+    if path is not None and fingerprint is not None:
+        problematic_keys = read_key_warnings(path, fingerprint)
+        if problematic_keys is not None:
+            return problematic_keys
+    problematic_keys = []
+    infolist = weechat.infolist_get("key", "", "default")
+    while weechat.infolist_next(infolist):
+        key = weechat.infolist_string(infolist, "key")
+        if re.match(REGEX_PROBLEMATIC_KEYBINDINGS, key):
+            problematic_keys.append(
+                (key, weechat.infolist_string(infolist, "command")))
+    weechat.infolist_free(infolist)
+    if path is not None and fingerprint is not None:
+        write_key_warnings(path, fingerprint)
+    return problematic_keys
+
+def get_key_warnings_file():
+    """Return the path of the file problematic key bindings are cached in, or
+    None if they aren't (e.g. outside WeeChat)."""
+    data_dir = (weechat.info_get("weechat_data_dir", "") or
+                weechat.info_get("weechat_dir", ""))
+    if not data_dir:
+        return None
+    return os.path.join(data_dir, "vimode_key_warnings")
+
+def get_key_config_fingerprint():
+    """Return a fingerprint of WeeChat's key bindings configuration, or None.
+
+    Default key bindings depend on WeeChat's version, and the others are
+    saved in weechat.conf, so its size and modification time are used as
+    well. Keys (un)bound while vimode is loaded are handled by
+    `cb_key_bindings_changed()`. Keys (un)bound while it isn't loaded are
+    only noticed once weechat.conf is saved: ``/vimode bind_keys`` looks key
+    bindings up again before unbinding them, in case the cache is stale.
+    """
+    config_dir = (weechat.info_get("weechat_config_dir", "") or
+                  weechat.info_get("weechat_dir", ""))
+    if not config_dir:
+        return None
+    try:
+        stat = os.stat(os.path.join(config_dir, "weechat.conf"))
+    except OSError:
+        return None
+    return "%s %d %d" % (weechat.info_get("version_number", ""),
+                         stat.st_size, int(stat.st_mtime * 1000))
+
+def read_key_warnings(path, fingerprint):
+    """Return the problematic key bindings cached in the file `path`, or None
+    if they were cached for another `fingerprint`.
+
+    The file's first line is the fingerprint, followed by a "key\tcommand"
+    line for each key binding. Other lines (e.g. blank ones) are skipped.
+    """
+    try:
+        with open(path) as f:
+            if f.readline().rstrip("\n") != fingerprint:
+                return None
+            return [tuple(line.rstrip("\n").split("\t", 1)) for line in f
+                    if "\t" in line]
+    except (IOError, OSError):
+        return None
+
+def write_key_warnings(path, fingerprint):
+    """Cache `problematic_keys` in the file `path` (see
+    `read_key_warnings()`)."""
+    try:
+        with open(path + ".tmp", "w") as f:
+            f.write(fingerprint + "\n")
+            for binding in problematic_keys:
+                f.write("%s\t%s\n" % binding)
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError):
+        return
+
+def cb_key_bindings_changed(data, signal, signal_data):
+    """A key was (un)bound: look problematic key bindings up again next time
+    they're needed.
+
+    The cache is removed rather than refreshed right away, as
+    ``/vimode bind_keys`` (un)binds many keys at once.
+    """
+    forget_problematic_keys()
+    return weechat.WEECHAT_RC_OK
+
+def forget_problematic_keys():
+    """Remove the cached problematic key bindings, in memory and in their
+    file, so that they're looked up again by `get_problematic_keys()`."""
+    global problematic_keys
+    problematic_keys = None
+    path = get_key_warnings_file()
+    if path is not None and os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 def print_warning(text):
     """Print warning, in red, to the current buffer."""
@@ -2140,13 +4238,8 @@ def check_warnings():
     # Warn the user about problematic key bindings that may conflict with
     # vimode.
     # The solution is to remove these key bindings, but that's up to the user.
-    infolist = weechat.infolist_get("key", "", "default")
-    problematic_keybindings = []
-    while weechat.infolist_next(infolist):
-        key = weechat.infolist_string(infolist, "key")
-        command = weechat.infolist_string(infolist, "command")
-        if re.match(REGEX_PROBLEMATIC_KEYBINDINGS, key):
-            problematic_keybindings.append("%s -> %s" % (key, command))
+    problematic_keybindings = ["%s -> %s" % binding
+                               for binding in get_problematic_keys()]
     if problematic_keybindings:
         user_warned = True
         print_warning("Problematic keybindings detected:")
@@ -2172,10 +4265,210 @@ def check_warnings():
                       " plugins.var.python.vimode.no_warn to 'on'")
 
 
+# Profiler.
+# =========
+
+# Functions timed by `/vimode profile`: WeeChat callbacks (which WeeChat looks
+# up by name when calling them) and the helpers keys are dispatched to.
+PROFILED_FUNCTIONS = ["cb_key_pressed", "cb_key_combo_default",
+                      "cb_key_combo_search", "cb_check_esc",
+                      "cb_check_imap_esc", "cb_exec_cmd", "cb_play_macro",
+                      "cb_key_p", "cb_copy_clipboard", "cb_check_cmd_mode",
+                      "cb_config", "cb_vi_buffer", "cb_cmd_completion",
+                      "cb_mode_indicator", "cb_line_numbers",
+                      "cb_update_line_numbers",
+                      "cb_timer_update_line_numbers", "cb_buffer_opened",
+                      "cb_buffer_closed", "cb_commands_changed",
+                      "cb_key_bindings_changed",
+                      "handle_key_combo", "get_keys_and_count", "do_command",
+                      "do_motion", "do_operator", "get_pos",
+                      "get_pos_backward", "exec_cmd", "feed_key",
+                      "flush_input", "flush_bar_items", "copy_to_clipboard",
+                      "add_undo_history"]
+# Callbacks handling a key press, whose WeeChat API calls are counted.
+PROFILED_KEY_EVENTS = ["cb_key_pressed", "cb_key_combo_default",
+                       "cb_key_combo_search"]
+# Upper bounds of the latency histogram's buckets, in µs (the last bucket
+# has no bound).
+PROFILE_BUCKETS = [10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000]
+
+class ProfiledWeechat(object):
+    """Wrapper around the `weechat` module counting the calls made to it while
+    profiling."""
+
+    def __init__(self, module):
+        self.module = module
+
+    def __getattr__(self, name):
+        attr = getattr(self.module, name)
+        if callable(attr):
+            attr = self.wrap(name, attr)
+        # Only looked up once.
+        setattr(self, name, attr)
+        return attr
+
+    @staticmethod
+    def wrap(name, func):
+        """Return `func`, counting its calls in `profile`."""
+        def wrapper(*args):
+            profile['weechat_calls'] += 1
+            calls = profile['weechat']
+            calls[name] = calls.get(name, 0) + 1
+            return func(*args)
+        return wrapper
+
+def profiled(name, func):
+    """Return `func` timed and counted in `profile` under `name`."""
+    def wrapper(*args, **kwargs):
+        weechat_calls = profile['weechat_calls']
+        start = monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = (monotonic() - start) * 1e6
+            stats = profile['functions'].get(name)
+            if stats is None:
+                stats = profile['functions'][name] = {
+                    'calls': 0, 'total_us': 0.0, 'max_us': 0.0,
+                    'weechat_calls': 0,
+                    'histogram': [0] * (len(PROFILE_BUCKETS) + 1)}
+            stats['calls'] += 1
+            stats['total_us'] += elapsed
+            stats['max_us'] = max(stats['max_us'], elapsed)
+            stats['histogram'][bisect_left(PROFILE_BUCKETS, elapsed)] += 1
+            stats['weechat_calls'] += profile['weechat_calls'] - weechat_calls
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+def start_profiling():
+    """Start (or restart) profiling: wrap `PROFILED_FUNCTIONS`,
+    `UserMapping.__call__()` and the `weechat` module.
+
+    Nothing is wrapped when not profiling, so that it costs nothing: compiled
+    user mappings, which hold the functions they call, are compiled again
+    when profiling starts or stops.
+    """
+    global profile, weechat
+    stop_profiling()
+    profile = {'start': monotonic(), 'duration': 0, 'functions': {},
+               'weechat': {}, 'weechat_calls': 0}
+    for name in PROFILED_FUNCTIONS:
+        profiled_functions[name] = globals()[name]
+        globals()[name] = profiled(name, globals()[name])
+    call = UserMapping.__dict__['__call__']
+    profiled_functions['UserMapping.__call__'] = call
+    UserMapping.__call__ = profiled("UserMapping", call)
+    profiled_functions['weechat'] = weechat
+    weechat = ProfiledWeechat(weechat)
+    key_tables_changed()
+
+def stop_profiling():
+    """Stop profiling and unwrap the profiled functions. The data collected so
+    far is kept for `profile_report()`."""
+    global weechat
+    if not profiled_functions:
+        return
+    weechat = profiled_functions.pop('weechat')
+    UserMapping.__call__ = profiled_functions.pop('UserMapping.__call__')
+    globals().update(profiled_functions)
+    profiled_functions.clear()
+    key_tables_changed()
+    profile['duration'] = monotonic() - profile['start']
+
+def profile_report():
+    """Return the data collected by `/vimode profile`, or None.
+
+    Returns:
+        dict: the profiling duration in seconds, the number of key events,
+            WeeChat API calls by function, and for each profiled function,
+            its number of calls, cumulative/maximum time (µs), mean/p50/p99
+            time estimated from the histogram, the WeeChat API calls made
+            during it, and its latency histogram (`PROFILE_BUCKETS`).
+    """
+    if profile is None:
+        return None
+    duration = profile['duration']
+    if profiled_functions:
+        duration = monotonic() - profile['start']
+    functions = {}
+    for name, stats in profile['functions'].items():
+        stats = dict(stats)
+        stats['mean_us'] = stats['total_us'] / stats['calls']
+        stats['p50_us'] = histogram_percentile(stats, 0.5)
+        stats['p99_us'] = histogram_percentile(stats, 0.99)
+        stats['weechat_calls_per_call'] = (float(stats['weechat_calls']) /
+                                           stats['calls'])
+        functions[name] = stats
+    key_events = sum(functions[name]['calls'] for name in PROFILED_KEY_EVENTS
+                     if name in functions)
+    return {'duration': duration, 'key_events': key_events,
+            'weechat': dict(profile['weechat']),
+            'histogram_buckets_us': PROFILE_BUCKETS, 'functions': functions}
+
+def histogram_percentile(stats, fraction):
+    """Return an estimate of the `fraction` percentile of a profiled
+    function's times: the upper bound of the bucket it's in (or the maximum
+    time for the last bucket)."""
+    rank = fraction * stats['calls']
+    for i, amount in enumerate(stats['histogram']):
+        rank -= amount
+        if rank <= 0 and i < len(PROFILE_BUCKETS):
+            return min(PROFILE_BUCKETS[i], stats['max_us'])
+    return stats['max_us']
+
+def print_profile_report(report):
+    """Print the profiling `report` to the core buffer, slowest functions
+    first."""
+    weechat.prnt("", "[vimode.py] Profile of %.1fs, %d key events:" %
+                 (report['duration'], report['key_events']))
+    weechat.prnt("", "    %-28s %8s %11s %9s %9s %9s %9s %8s" %
+                 ("function", "calls", "total (ms)", "mean (µs)", "p50 (µs)",
+                  "p99 (µs)", "max (µs)", "API/call"))
+    functions = sorted(report['functions'].items(),
+                       key=lambda item: -item[1]['total_us'])
+    for name, stats in functions:
+        weechat.prnt("", "    %-28s %8d %11.1f %9.1f %9.0f %9.0f %9.0f %8.1f" %
+                     (name, stats['calls'], stats['total_us'] / 1000,
+                      stats['mean_us'], stats['p50_us'], stats['p99_us'],
+                      stats['max_us'], stats['weechat_calls_per_call']))
+    calls = sorted(report['weechat'].items(), key=lambda item: -item[1])
+    if calls:
+        weechat.prnt("", "    WeeChat API calls: %s" %
+                     ", ".join("%s: %d" % call for call in calls))
+
+def cmd_profile(args):
+    """Handle ``/vimode profile start|stop|report [file]``."""
+    action, _, path = args.partition(" ")
+    if action == "start":
+        start_profiling()
+        weechat.prnt("", "[vimode.py] Profiling started.")
+    elif action == "stop":
+        stop_profiling()
+        weechat.prnt("", "[vimode.py] Profiling stopped.")
+    elif action == "report":
+        report = profile_report()
+        if report is None:
+            weechat.prnt("", "[vimode.py] Nothing profiled yet, see"
+                         " /vimode profile start")
+        elif path:
+            try:
+                with open(os.path.expanduser(path.strip()), "w") as f:
+                    json.dump(report, f, indent=2, sort_keys=True)
+            except (IOError, OSError) as error:
+                print_warning("Failed to write the profile to %s: %s" %
+                              (path, error))
+            else:
+                weechat.prnt("", "[vimode.py] Profile written to %s" % path)
+        else:
+            print_profile_report(report)
+    else:
+        print_warning("Usage: /vimode profile start|stop|report [file]")
+
+
 # Main script.
 # ============
 
-if __name__ == "__main__":
+if __name__ == "__main__" and weechat is not None:
     weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION,
                      SCRIPT_LICENSE, SCRIPT_DESC, "", "")
     # Warn the user if he's using an unsupported WeeChat version.
@@ -2213,12 +4506,28 @@ if __name__ == "__main__":
     weechat.hook_signal("key_combo_default", "cb_key_combo_default", "")
     weechat.hook_signal("key_combo_search", "cb_key_combo_search", "")
     weechat.hook_signal("buffer_switch", "cb_update_line_numbers", "")
-    weechat.hook_command("vimode", SCRIPT_DESC, "[help | bind_keys [--list]]",
+    weechat.hook_signal("buffer_opened", "cb_buffer_opened", "")
+    weechat.hook_signal("buffer_renamed", "cb_buffer_opened", "")
+    weechat.hook_signal("buffer_closed", "cb_buffer_closed", "")
+    weechat.hook_signal("key_bind", "cb_key_bindings_changed", "")
+    weechat.hook_signal("key_unbind", "cb_key_bindings_changed", "")
+    for signal in ["plugin_loaded", "plugin_unloaded", "*_script_loaded",
+                   "*_script_unloaded"]:
+        weechat.hook_signal(signal, "cb_commands_changed", "")
+    index_buffers()
+    weechat.hook_command("vimode", SCRIPT_DESC,
+                         "[help | bind_keys [--list] | profile start|stop|"
+                         "report [<file>]]",
                          "     help: show help\n"
                          "bind_keys: unbind problematic keys, and bind"
                          " recommended keys to use in WeeChat\n"
-                         "          --list: only list changes",
-                         "help || bind_keys |--list",
+                         "          --list: only list changes\n"
+                         "  profile: time vimode's callbacks and count"
+                         " WeeChat API calls (start, stop, then report to"
+                         " print the results, or write them to <file> as"
+                         " JSON)",
+                         "help || bind_keys |--list"
+                         " || profile start|stop|report",
                          "cb_vimode_cmd", "")
     weechat.hook_command("vimode_go_to_normal",
                          ("This command can be used for key bindings to go to "